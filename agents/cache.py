@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import time
+from os import getenv
+from pathlib import Path
+from typing import Optional
+
+from utils.store import SQLiteStore
+
+
+class ResponseCache(SQLiteStore):
+    """
+    SQLite cache of chat completion answers keyed by the request payload.
+
+    The key hashes the model, messages (including image data) and sampling
+    parameters. Entries expire after `ttl` seconds, the least recently used
+    ones are evicted past `max_entries`. Hits, misses and the latency and
+    tokens saved are counted per stage.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats: dict[str, dict[str, float]] = {}
+
+        super().__init__(
+            path,
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                response TEXT NOT NULL,
+                latency REAL NOT NULL,
+                tokens INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_responses_accessed
+                ON responses (accessed_at);
+            """,
+        )
+
+    @staticmethod
+    def make_key(payload: dict) -> str:
+        data = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _count(self, stage: str, name: str, amount: float = 1):
+        stage_stats = self.stats.setdefault(
+            stage,
+            {"hits": 0, "misses": 0, "saved_seconds": 0, "saved_tokens": 0},
+        )
+        stage_stats[name] += amount
+
+    async def get(self, key: str, stage: str) -> Optional[str]:
+        row = await self.run(self._get, key)
+        if not row:
+            self._count(stage, "misses")
+            return None
+
+        response, latency, tokens = row
+        self._count(stage, "hits")
+        self._count(stage, "saved_seconds", latency)
+        self._count(stage, "saved_tokens", tokens)
+        logging.debug("LLM cache hit for %s: %s", stage, self.stats[stage])
+        return response
+
+    async def put(
+        self,
+        key: str,
+        stage: str,
+        response: str,
+        latency: float,
+        tokens: int,
+    ):
+        await self.run(self._put, key, stage, response, latency, tokens)
+
+    def _get(self, key: str) -> Optional[tuple[str, float, int]]:
+        row = self.db.execute(
+            "SELECT response, latency, tokens, created_at "
+            "FROM responses WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if not row or time.time() - row[3] > self.ttl:
+            return None
+
+        self.db.execute(
+            "UPDATE responses SET accessed_at = ? WHERE key = ?",
+            (time.time(), key),
+        )
+        self.db.commit()
+        return row[:3]
+
+    def _put(
+        self,
+        key: str,
+        stage: str,
+        response: str,
+        latency: float,
+        tokens: int,
+    ):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses "
+            "(key, stage, response, latency, tokens, created_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, stage, response, latency, tokens, now, now),
+        )
+        self.db.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+        )
+        self.db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed_at DESC "
+            "LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self.db.commit()
+
+
+_cache: Optional[ResponseCache] = None
+
+
+def cache_enabled(stage: Optional[str]) -> bool:
+    """Stages listed in `llm_cache_stages` (comma-separated) are cached."""
+    stages = getenv("llm_cache_stages")
+    if stages is None:
+        stages = "valid_images,check_image"
+    return bool(stage) and stage in stages.split(",")
+
+
+def get_response_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(
+            getenv("llm_cache_path") or "cache/llm.sqlite3",
+            float(getenv("llm_cache_ttl") or 30 * 24 * 3600),
+            int(getenv("llm_cache_entries") or 10000),
+        )
+    return _cache
+
+
+def get_cache_stats() -> dict:
+    """Return hit/miss counters per stage, empty if the cache is unused."""
+    return _cache.stats if _cache else {}
@@ -1,17 +1,23 @@
+from os import getenv
 from typing import Optional
 
 import aiohttp
 
+from agents.limiter import get_openai_scheduler
+
 
 class DalleClient:
-    API_URL = "https://api.openai.com/v1/images/generations"
+    API_URL = "https://api.openai.com"
 
     def __init__(
         self,
         api_key: str,
         session: Optional[aiohttp.ClientSession] = None,
+        api_url: Optional[str] = None,
     ):
         self.api_key = api_key
+        api_url = api_url or getenv("openai_api") or self.API_URL
+        self.url = f"{api_url}/v1/images/generations"
         self._owned_session = session is None
         self.session = session or aiohttp.ClientSession()
 
@@ -50,11 +56,9 @@ class DalleClient:
             "Content-Type": "application/json",
         }
 
-        async with self.session.post(
-            self.API_URL, headers=headers, json=payload
-        ) as resp:
-            resp.raise_for_status()
-            data = await resp.json()
+        data = await get_openai_scheduler().post(
+            self.session, self.url, headers, payload, tokens=0
+        )
 
         if response_format == "url":
             return [img["url"] for img in data["data"]]
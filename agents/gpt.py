@@ -1,9 +1,20 @@
+import asyncio
 import base64
+import json
 import logging
-from typing import List, Optional
+import time
+from os import getenv
+from typing import AsyncIterator, Callable, List, Optional
 
 import aiohttp
 
+from agents.cache import ResponseCache
+from agents.limiter import get_openai_scheduler
+
+
+class IncompleteAnswer(Exception):
+    """A streamed answer broke off after part of it was yielded."""
+
 
 class GPTClient:
     """
@@ -14,21 +25,33 @@ class GPTClient:
     Handles both text-only and text+image prompts.
     """
 
-    API_URL = "https://api.openai.com/v1/chat/completions"
+    API_URL = "https://api.openai.com"
 
     def __init__(
         self,
         api_key: str,
         model: str = "gpt-4o-mini",
         session: Optional[aiohttp.ClientSession] = None,
+        cache: Optional[ResponseCache] = None,
+        stage: str = "default",
+        api_url: Optional[str] = None,
     ):
         """
         :param api_key: Your OpenAI API key.
         :param model: The vision-capable model (e.g., 'gpt-4o', 'gpt-4o-mini').
         :param session: Optional existing aiohttp.ClientSession for reuse.
+        :param cache: Optional cache of answers to requests sampled at
+            temperature 0.
+        :param stage: Pipeline stage name used in cache statistics.
+        :param api_url: Base URL of the API, `openai_api` env by default.
         """
         self.api_key = api_key
         self.model = model
+        self.cache = cache
+        self.stage = stage
+        api_url = api_url or getenv("openai_api") or self.API_URL
+        self.url = f"{api_url}/v1/chat/completions"
+        self.last_timing: dict[str, Optional[float]] = {}
         self._owned_session = session is None
         self.session = session or aiohttp.ClientSession()
         logging.debug("GPTClient initialized")
@@ -50,34 +73,32 @@ class GPTClient:
         """Encode a local image bytes to base64 data URL."""
         logging.debug("Encoding image to base64...")
         encoded = base64.b64encode(image).decode("utf-8")
-        # Guess MIME type from extension (fallback to jpeg)
-        mime_type = {
-            ".png": "image/png",
-            ".jpg": "image/jpeg",
-            ".jpeg": "image/jpeg",
-            ".gif": "image/gif",
-            ".webp": "image/webp",
-        }.get(url[url.rfind("."):], "image/jpeg")
+        # Thumbnails are re-encoded, so the bytes decide the MIME type
+        # before the extension of the source URL (fallback to jpeg)
+        if image.startswith(b"\xff\xd8"):
+            mime_type = "image/jpeg"
+        elif image.startswith(b"\x89PNG"):
+            mime_type = "image/png"
+        elif image.startswith(b"RIFF") and image[8:12] == b"WEBP":
+            mime_type = "image/webp"
+        else:
+            mime_type = {
+                ".png": "image/png",
+                ".jpg": "image/jpeg",
+                ".jpeg": "image/jpeg",
+                ".gif": "image/gif",
+                ".webp": "image/webp",
+            }.get(url[url.rfind("."):], "image/jpeg")
         return f"data:{mime_type};base64,{encoded}"
 
-    async def send_request(
+    def _build_payload(
         self,
         prompt: str,
-        images: Optional[List[tuple[str, str]]] = None,
-        system_prompt: str = "You are a helpful assistant.",
-        max_tokens: int = 500,
-        temperature: float = 0.7,
-    ) -> str:
-        """
-        Send a multimodal request to the GPT vision model.
-
-        :param prompt: The user text prompt.
-        :param images: List of image URLs or local file paths.
-        :param system_prompt: Optional system message.
-        :param max_tokens: Maximum tokens in response.
-        :param temperature: Sampling temperature.
-        :return: The model's text response.
-        """
+        images: Optional[List[tuple[str, str]]],
+        system_prompt: str,
+        max_tokens: int,
+        temperature: float,
+    ) -> dict:
         # Build the content array for the user message
         content: List[dict] = [{"type": "text", "text": prompt}]
         logging.debug("Sending request with prompt: %s", prompt)
@@ -102,22 +123,183 @@ class GPTClient:
         }
         if "search" not in self.model:
             payload["temperature"] = temperature
+        return payload
+
+    def _cache_key(self, payload: dict, temperature: float) -> Optional[str]:
+        """Sampled answers vary between calls, so only cache temperature 0."""
+        if self.cache and temperature == 0:
+            return self.cache.make_key(payload)
 
-        headers = {
+    @staticmethod
+    def _valid(answer: str, validate) -> bool:
+        return bool(answer) and (validate is None or validate(answer))
+
+    @property
+    def _headers(self) -> dict:
+        return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
         }
 
+    async def send_request(
+        self,
+        prompt: str,
+        images: Optional[List[tuple[str, str]]] = None,
+        system_prompt: str = "You are a helpful assistant.",
+        max_tokens: int = 500,
+        temperature: float = 0.7,
+        validate: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        """
+        Send a multimodal request to the GPT vision model.
+
+        :param prompt: The user text prompt.
+        :param images: List of image URLs or local file paths.
+        :param system_prompt: Optional system message.
+        :param max_tokens: Maximum tokens in response.
+        :param temperature: Sampling temperature, only requests at 0 are
+            cached.
+        :param validate: Check an answer before caching it, answers
+            rejected by it are returned but not cached.
+        :return: The model's text response.
+        """
+        payload = self._build_payload(
+            prompt, images, system_prompt, max_tokens, temperature
+        )
+
+        cache_key = self._cache_key(payload, temperature)
+        if cache_key:
+            cached = await self.cache.get(cache_key, self.stage)
+            if cached is not None:
+                return cached
+
         try:
-            async with self.session.post(
-                self.API_URL, headers=headers, json=payload
-            ) as response:
-                response.raise_for_status()
-                data = await response.json()
+            start_time = time.monotonic()
+            data = await get_openai_scheduler().post(
+                self.session, self.url, self._headers, payload
+            )
 
             logging.info("Received response: %s", data)
-            return data["choices"][0]["message"]["content"]
+            content = data["choices"][0]["message"]["content"]
+
+            if cache_key and self._valid(content, validate):
+                await self.cache.put(
+                    cache_key,
+                    self.stage,
+                    content,
+                    time.monotonic() - start_time,
+                    data.get("usage", {}).get("total_tokens", 0),
+                )
+            return content
 
-        except aiohttp.ClientError as e:
-            logging.error("Error sending request: %s", e)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error("Error sending request: %r", e)
             return ""
+
+    async def stream_request(
+        self,
+        prompt: str,
+        images: Optional[List[tuple[str, str]]] = None,
+        system_prompt: str = "You are a helpful assistant.",
+        max_tokens: int = 500,
+        temperature: float = 0.7,
+        validate: Optional[Callable[[str], bool]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Stream the model's answer as text deltas (server-sent events).
+
+        Takes the same parameters as send_request. Closing the iterator
+        early aborts the request. An answer is cached once it ended with a
+        finish reason or [DONE]; one closed early only when `validate`
+        accepts what has arrived. Time to first token and total latency
+        are stored in `last_timing`.
+
+        A request failing before the first token yields nothing, like
+        send_request returns "". Failing later raises IncompleteAnswer,
+        unless `validate` accepts what has arrived.
+        """
+        payload = self._build_payload(
+            prompt, images, system_prompt, max_tokens, temperature
+        )
+
+        cache_key = self._cache_key(payload, temperature)
+        if cache_key:
+            cached = await self.cache.get(cache_key, self.stage)
+            if cached is not None:
+                yield cached
+                return
+
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
+
+        start_time = time.monotonic()
+        first_token = None
+        parts = []
+        tokens = 0
+        complete = False
+
+        try:
+            async with get_openai_scheduler().open(
+                self.session, self.url, self._headers, payload
+            ) as response:
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        complete = True
+                        break
+
+                    try:
+                        event = json.loads(data)
+                    except ValueError:
+                        logging.warning("Skipping bad event %.200r", data)
+                        continue
+                    if event.get("usage"):
+                        tokens = event["usage"].get("total_tokens", 0)
+                    for choice in event.get("choices", []):
+                        if choice.get("finish_reason"):
+                            complete = True
+                        delta = (choice.get("delta") or {}).get("content")
+                        if delta:
+                            if first_token is None:
+                                first_token = time.monotonic() - start_time
+                            parts.append(delta)
+                            yield delta
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error("Error streaming request: %r", e)
+            if parts:
+                if validate is None or not validate("".join(parts)):
+                    # Callers can't tell a cut answer from a short one
+                    raise IncompleteAnswer(
+                        f"{self.stage} answer cut off: {e!r}"
+                    ) from e
+                complete = True
+
+        except GeneratorExit:
+            # The caller has what it needs when its validator accepts it
+            complete = validate is not None
+            raise
+
+        finally:
+            total = time.monotonic() - start_time
+            self.last_timing = {"ttft": first_token, "total": total}
+            logging.info(
+                "Streamed %s (%s): first token %s s, total %.2f s",
+                self.model,
+                self.stage,
+                f"{first_token:.2f}" if first_token is not None else "-",
+                total,
+            )
+            answer = "".join(parts)
+            if cache_key and complete and self._valid(answer, validate):
+                await self.cache.put(
+                    cache_key, self.stage, answer, total, tokens
+                )
+
+
+async def collect(chunks: AsyncIterator[str]) -> str:
+    """Join a streamed answer into one string."""
+    return "".join([chunk async for chunk in chunks])
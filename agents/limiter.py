@@ -0,0 +1,261 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import re
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from os import getenv
+from typing import AsyncIterator, Optional
+
+import aiohttp
+
+# Lower value is served first
+PRIORITY_SLOT = 0
+PRIORITY_BACKGROUND = 10
+
+# Priority of OpenAI calls made from the current task
+openai_priority: ContextVar[int] = ContextVar(
+    "openai_priority", default=PRIORITY_BACKGROUND
+)
+
+# Per-model defaults: (requests per minute, tokens per minute)
+MODEL_LIMITS = {
+    "default": (500, 30_000),
+    "gpt-4o": (500, 30_000),
+    "gpt-4o-mini": (500, 200_000),
+    "gpt-4o-search-preview": (100, 30_000),
+    "dall-e-3": (5, 0),
+}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Tokens counted for every image in a vision request
+IMAGE_TOKENS = 85
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str) -> float:
+    """Parse OpenAI reset durations such as "1s", "6m0s" or "20ms"."""
+    return sum(
+        float(amount) * _DURATION_UNITS[unit]
+        for amount, unit in _DURATION.findall(value or "")
+    )
+
+
+def estimate_tokens(payload: dict) -> int:
+    images = 0
+    text = 0
+    for message in payload.get("messages", []):
+        content = message["content"]
+        if isinstance(content, str):
+            text += len(content)
+            continue
+        for part in content:
+            if part["type"] == "text":
+                text += len(part["text"])
+            else:
+                images += 1
+    return text // 4 + images * IMAGE_TOKENS + payload.get("max_tokens", 0)
+
+
+class TokenBucket:
+    """Bucket refilled continuously up to `per_minute` units."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if not self.capacity:
+            return 0
+        now = time.monotonic()
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        wait = max(self.blocked_until - now, 0)
+        if self.tokens < amount:
+            wait = max(wait, (amount - self.tokens) / self.rate)
+        return wait
+
+    def take(self, amount: float):
+        if self.capacity:
+            self.tokens -= min(amount, self.capacity)
+
+    def sync(self, remaining: Optional[str], reset: Optional[str]):
+        """Align the bucket with the server's x-ratelimit headers."""
+        if not self.capacity or remaining is None:
+            return
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, float(remaining))
+        if float(remaining) <= 0:
+            self.blocked_until = time.monotonic() + parse_duration(reset)
+
+
+class OpenAIScheduler:
+    """
+    Shared gate for all OpenAI requests.
+
+    Every model has a request and a token bucket. Waiting calls are served
+    by priority (see openai_priority), then in arrival order. Responses
+    update the buckets from rate-limit headers, and 429/5xx answers and
+    connection errors are retried with jittered exponential backoff.
+    """
+
+    def __init__(self):
+        self.buckets: dict[str, tuple[TokenBucket, TokenBucket]] = {}
+        self.waiting: dict[str, list] = {}
+        self.condition = asyncio.Condition()
+        self.counter = itertools.count()
+
+    def _buckets(self, model: str) -> tuple[TokenBucket, TokenBucket]:
+        if model not in self.buckets:
+            rpm, tpm = MODEL_LIMITS.get(model, MODEL_LIMITS["default"])
+            self.buckets[model] = (
+                TokenBucket(float(getenv(f"{model}_rpm") or rpm)),
+                TokenBucket(float(getenv(f"{model}_tpm") or tpm)),
+            )
+        return self.buckets[model]
+
+    async def acquire(self, model: str, tokens: int, priority: int):
+        requests_bucket, tokens_bucket = self._buckets(model)
+        waiting = self.waiting.setdefault(model, [])
+        ticket = (priority, next(self.counter))
+
+        async with self.condition:
+            heapq.heappush(waiting, ticket)
+            try:
+                while True:
+                    if waiting[0] != ticket:
+                        await self.condition.wait()
+                        continue
+
+                    wait = max(
+                        requests_bucket.wait_time(1),
+                        tokens_bucket.wait_time(tokens),
+                    )
+                    if wait <= 0:
+                        requests_bucket.take(1)
+                        tokens_bucket.take(tokens)
+                        return
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                waiting.remove(ticket)
+                heapq.heapify(waiting)
+                self.condition.notify_all()
+
+    def update(self, model: str, headers):
+        requests_bucket, tokens_bucket = self._buckets(model)
+        requests_bucket.sync(
+            headers.get("x-ratelimit-remaining-requests"),
+            headers.get("x-ratelimit-reset-requests"),
+        )
+        tokens_bucket.sync(
+            headers.get("x-ratelimit-remaining-tokens"),
+            headers.get("x-ratelimit-reset-tokens"),
+        )
+
+    @staticmethod
+    def retry_delay(attempt: int, headers=None) -> float:
+        if headers:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                try:
+                    return float(headers["retry-after"])
+                except ValueError:
+                    pass
+        return random.uniform(0, min(60, 2 ** attempt))
+
+    @asynccontextmanager
+    async def open(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        headers: dict,
+        payload: dict,
+        tokens: Optional[int] = None,
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        POST payload and yield the successful response unread.
+
+        Failed attempts are retried before the response is handed out,
+        so streaming consumers never see a retried body.
+        """
+        model = payload.get("model", "default")
+        tokens = estimate_tokens(payload) if tokens is None else tokens
+        retries = int(getenv("openai_retries") or 5)
+
+        for attempt in range(retries + 1):
+            await self.acquire(model, tokens, openai_priority.get())
+            try:
+                response = await session.post(
+                    url, headers=headers, json=payload
+                )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == retries:
+                    raise
+                delay = self.retry_delay(attempt)
+                error = repr(e)
+            else:
+                self.update(model, response.headers)
+                if response.status not in RETRY_STATUSES:
+                    try:
+                        response.raise_for_status()
+                        yield response
+                    finally:
+                        response.release()
+                    return
+
+                try:
+                    body = await response.text()
+                finally:
+                    response.release()
+                if attempt == retries or "insufficient_quota" in body:
+                    response.raise_for_status()
+                delay = self.retry_delay(attempt, response.headers)
+                error = f"{response.status} {body[:200]}"
+
+            logging.warning(
+                "OpenAI %s request failed (%s), retry %s in %.1f s",
+                model,
+                error,
+                attempt + 1,
+                delay,
+            )
+            await asyncio.sleep(delay)
+
+    async def post(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        headers: dict,
+        payload: dict,
+        tokens: Optional[int] = None,
+    ) -> dict:
+        """POST payload and return the JSON answer, retrying when allowed."""
+        async with self.open(session, url, headers, payload, tokens) as resp:
+            return await resp.json()
+
+
+_scheduler: Optional[OpenAIScheduler] = None
+
+
+def get_openai_scheduler() -> OpenAIScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = OpenAIScheduler()
+    return _scheduler
@@ -1,13 +1,125 @@
 import logging
-from os.path import join
+import string
+import time
+from pathlib import Path
+
+# Templates inlined into others instead of being rendered on their own
+NESTED = {
+    "choose_theme": {"format": "choose_theme_format"},
+    "choose_themes": {"format": "choose_theme_format"},
+    "write_post": {"format": "post_format"},
+}
+# Placeholders a template must contain after nested templates are inlined
+REQUIRED = {
+    "check_image": {"theme", "recipe"},
+    "check_images": {"theme", "recipe", "count"},
+    "choose_theme": {"theme", "existingThemes"},
+    "choose_themes": {"theme", "existingThemes", "count"},
+    "gen_image": {"text"},
+    "get_photo": {"theme"},
+    "valid_images": {"theme", "images", "max_images"},
+    "write_post": {"theme", "hashtags"},
+}
+# Seconds between checks of template modification times
+RELOAD_INTERVAL = 5
+
+
+def _escape(text: str) -> str:
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+class PromptRegistry:
+    """
+    Prompt templates loaded once from a folder of `.txt` files.
+
+    Nested templates are inlined and required placeholders are checked
+    when the folder is compiled. Files are re-read only when their mtime
+    changes, so rendering is plain str.format without file I/O.
+    """
+
+    def __init__(self, folder: str = "expressions"):
+        self.folder = Path(folder)
+        self.sources: dict[str, tuple[float, str]] = {}
+        self.templates: dict[str, tuple[str, bool]] = {}
+        self.checked_at = time.monotonic()
+        self._read_changed()
+        self.templates = self._compile()
+
+    def _read_changed(self) -> bool:
+        changed = False
+        for path in self.folder.glob("*.txt"):
+            mtime = path.stat().st_mtime
+            if path.stem in self.sources and (
+                self.sources[path.stem][0] == mtime
+            ):
+                continue
+            self.sources[path.stem] = (
+                mtime,
+                path.read_text(encoding="utf-8"),
+            )
+            changed = True
+        return changed
+
+    def _compile(self) -> dict[str, tuple[str, bool]]:
+        """Return name -> (template, is format string)."""
+        raw = {name for nested in NESTED.values() for name in nested.values()}
+        templates = {}
+
+        for name, (_, text) in self.sources.items():
+            if name in raw:
+                templates[name] = (text, False)
+                continue
+
+            for key, nested in NESTED.get(name, {}).items():
+                text = text.replace(
+                    "{" + key + "}", _escape(self.sources[nested][1])
+                )
+
+            fields = {
+                field
+                for _, field, _, _ in string.Formatter().parse(text)
+                if field
+            }
+            missing = REQUIRED.get(name, set()) - fields
+            if missing:
+                raise ValueError(
+                    f"Prompt {name} misses placeholders: {sorted(missing)}"
+                )
+            templates[name] = (text, True)
+
+        logging.debug("Compiled prompts: %s", sorted(templates))
+        return templates
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self.checked_at < RELOAD_INTERVAL:
+            return
+        self.checked_at = now
+
+        try:
+            if self._read_changed():
+                self.templates = self._compile()
+                logging.info("Reloaded prompts from %s", self.folder)
+        except (OSError, ValueError) as e:
+            logging.error("Failed to reload prompts, keeping old ones: %s", e)
+
+    def render(self, name: str, **kwargs) -> str:
+        self.refresh()
+        template, is_format = self.templates[name]
+        if not is_format:
+            return template
+        return template.format(**kwargs)
+
+
+_registries: dict[str, PromptRegistry] = {}
+
+
+def get_registry(folder: str = "expressions") -> PromptRegistry:
+    if folder not in _registries:
+        _registries[folder] = PromptRegistry(folder)
+    return _registries[folder]
 
 
 def get_prompt(name: str, folder: str = "expressions", **kwargs):
-    with open(join(folder, f"{name}.txt"), encoding="utf-8") as file:
-        expression = file.read()
-    logging.debug("Loaded prompt: %s", expression)
-
-    if kwargs:
-        logging.debug("Prompt variables: %s", kwargs)
-        return expression.format(**kwargs)
-    return expression
+    logging.debug("Rendering prompt %s", name)
+    return get_registry(folder).render(name, **kwargs)
@@ -0,0 +1,140 @@
+"""
+Measure recipe history lookups on a database of synthetic articles.
+
+Compares loading every Article to slice the last names in Python (the
+old get_existing_articles) with the indexed ORDER BY/LIMIT query, and
+times the FTS5 near-duplicate check of a candidate name.
+
+Run from the repository root: python -m benchmarks.article_history
+"""
+
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from database.article import find_duplicate, get_existing_articles
+from database.orm import Article, init_db
+from database.session import close_engine, unit_of_work
+
+ARTICLES = 100_000
+HISTORY = 200
+RUNS = 20
+
+DISHES = [
+    "Борщ", "Суп", "Салат", "Пирог", "Омлет", "Плов", "Рагу", "Каша",
+    "Запеканка", "Оладьи", "Котлеты", "Паста", "Ризотто", "Блины",
+]
+INGREDIENTS = [
+    "с говядиной", "с курицей", "с грибами", "с тыквой", "с сыром",
+    "с фасолью", "с лососем", "с овощами", "с яблоками", "с творогом",
+    "со шпинатом", "с индейкой", "с креветками", "с рисом", "с чечевицей",
+]
+STYLES = [
+    "по-домашнему", "классический", "быстрый", "в духовке", "на сковороде",
+    "по-итальянски", "постный", "сливочный", "пряный", "летний",
+]
+
+
+def synthetic_name(rng: random.Random) -> str:
+    return " ".join(
+        [rng.choice(DISHES), rng.choice(INGREDIENTS), rng.choice(STYLES)]
+    )
+
+
+def fill(session, count: int):
+    rng = random.Random(0)
+    start = datetime(2020, 1, 1)
+    rows = [
+        {
+            "name": synthetic_name(rng),
+            "theme": "benchmark",
+            "level": 1,
+            "time": 30,
+            "date": start + timedelta(minutes=index),
+            "is_posted": rng.random() < 0.9,
+            "is_ready": False,
+            "channel": "default",
+        }
+        for index in range(count)
+    ]
+    session.execute(insert(Article), rows)
+    session.commit()
+
+
+def legacy_history(session, maximum: int) -> str:
+    articles = (
+        session.query(Article)
+        .filter(
+            (Article.is_posted == True)  # noqa E712
+            | (Article.is_ready == True)  # noqa E712
+        )
+        .filter(Article.channel == "default")
+        .all()
+    )
+    return "\n".join([article.name for article in articles][-maximum:])
+
+
+async def measure(name: str, func, runs: int = RUNS):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = await func()
+        timings.append((time.perf_counter() - start) * 1000)
+    print(
+        f"{name:>16}: p50 {statistics.median(timings):8.2f} ms, "
+        f"max {max(timings):8.2f} ms"
+    )
+    return result
+
+
+async def main(folder: str):
+    db_path = os.path.join(folder, "db.sqlite3")
+    os.environ["db_path"] = db_path
+    sync_session = init_db(db_path)
+
+    start = time.perf_counter()
+    fill(sync_session, ARTICLES)
+    print(f"Inserted {ARTICLES} articles in "
+          f"{time.perf_counter() - start:.1f} s")
+
+    async def legacy():
+        # Don't let the identity map keep loaded rows between runs
+        sync_session.expunge_all()
+        return legacy_history(sync_session, HISTORY)
+
+    async def history():
+        async with unit_of_work(write=False) as session:
+            return await get_existing_articles(
+                session, maximum=HISTORY, with_ready=True, channel="default"
+            )
+
+    async def duplicate(name):
+        async with unit_of_work(write=False) as session:
+            return await find_duplicate(session, name, "default")
+
+    legacy_names = await measure("full load", legacy, 3)
+    indexed_names = await measure("indexed query", history)
+    assert legacy_names == indexed_names, "history differs"
+
+    rng = random.Random(1)
+    candidates = [synthetic_name(rng) for _ in range(RUNS)]
+    await measure("duplicate check", lambda: duplicate(candidates.pop()))
+    print("Unseen name:", await duplicate("Шакшука с нутом"))
+    print(
+        "Reordered name:",
+        await duplicate("Классический борщ с говядиной"),
+    )
+
+    sync_session.close()
+    await close_engine()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as folder:
+        asyncio.run(main(folder))
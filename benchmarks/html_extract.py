@@ -0,0 +1,151 @@
+"""
+Measure image candidate extraction over a folder of saved recipe pages.
+
+Compares the previous BeautifulSoup extractor with the single-pass
+collector on html.parser and, when installed, lxml. Without a folder a
+set of synthetic pages is generated: a third of them name the hero photo
+in JSON-LD, a third in og:image and the rest only in <img> tags.
+
+Run from the repository root:
+    python -m benchmarks.html_extract [folder with *.html files]
+"""
+
+import os
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+from utils import html_parser
+from utils.html_parser import extract_image_candidates
+
+PAGES = 60
+PARAGRAPHS = 300
+
+
+def synthetic_page(index: int, rng: random.Random) -> str:
+    head = [f"<title>Recipe {index}</title>"]
+    if index % 3 == 0:
+        head.append(
+            '<script type="application/ld+json">{"@context": '
+            '"https://schema.org", "@graph": [{"@type": "Recipe", '
+            f'"name": "Recipe {index}", "image": {{"@type": "ImageObject", '
+            f'"url": "https://cdn.example/{index}/hero.jpg", '
+            '"width": 1600, "height": 1067}}]}</script>'
+        )
+    elif index % 3 == 1:
+        head.append(
+            '<meta property="og:image" '
+            f'content="https://cdn.example/{index}/og.jpg">'
+            '<meta property="og:image:width" content="1200">'
+        )
+
+    body = [
+        "<header><img src='/logo.png' class='logo'><nav>"
+        + "".join(f"<a href='/c/{n}'>Category {n}</a>" for n in range(30))
+        + "</nav></header><article><h1>Recipe</h1>"
+    ]
+    for paragraph in range(PARAGRAPHS):
+        words = " ".join(
+            rng.choice(["salt", "pepper", "stir", "bake", "slice", "simmer"])
+            for _ in range(40)
+        )
+        body.append(f"<p class='step'><span>{paragraph}.</span> {words}</p>")
+        if paragraph % 25 == 0:
+            body.append(
+                f"<figure><img src='/img/{index}/{paragraph}.jpg' "
+                f"srcset='/img/{index}/{paragraph}-640.jpg 640w, "
+                f"/img/{index}/{paragraph}-1280.jpg 1280w' "
+                f"width='1280' height='853' alt='step {paragraph}'>"
+                f"<figcaption>Step {paragraph}</figcaption></figure>"
+            )
+    body.append(
+        "</article><aside class='related'>"
+        + "".join(f"<img src='/related/{n}.jpg'>" for n in range(20))
+        + "</aside><footer>Footer</footer>"
+    )
+    return (
+        f"<html><head>{''.join(head)}</head>"
+        f"<body>{''.join(body)}</body></html>"
+    )
+
+
+def legacy_extract(html: str) -> list:
+    """The BeautifulSoup extractor this benchmark replaces."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup.select((
+        "nav, aside, footer, header, .sidebar, "
+        ".related, .recommend, .promo, .ads, .comments"
+    )):
+        tag.decompose()
+
+    images = []
+    for img in soup.find_all("img"):
+        src = img.get("src")
+        alt = img.get("alt", "").lower()
+        classes = " ".join(img.get("class", [])).lower()
+        if not src or re.search(r"avatar|icon|logo", alt + classes):
+            continue
+        parent_tags = [p.name for p in img.parents if hasattr(p, "name")]
+        caption = ""
+        if img.parent.name == "figure":
+            figcaption = img.parent.find("figcaption")
+            if figcaption:
+                caption = figcaption.get_text(strip=True)
+        p = img.find_parent("p")
+        images.append({
+            "src": src,
+            "caption": caption,
+            "near_text": p.get_text(strip=True) if p else "",
+            "in_article": "article" in parent_tags,
+        })
+    return images
+
+
+def measure(name: str, pages: list[str], extract):
+    start = time.perf_counter()
+    candidates = [extract(page) for page in pages]
+    elapsed = time.perf_counter() - start
+    sized = sum(
+        1 for page in candidates if page and page[0].get("width")
+    )
+    print(
+        f"{name:>22}: {elapsed / len(pages) * 1000:7.2f} ms/page, "
+        f"{sum(map(len, candidates)) / len(pages):5.1f} candidates, "
+        f"{sized}/{len(pages)} pages with a sized top candidate"
+    )
+
+
+def main():
+    if len(sys.argv) > 1:
+        pages = [
+            path.read_text(encoding="utf-8", errors="replace")
+            for path in sorted(Path(sys.argv[1]).glob("*.html"))
+        ]
+    else:
+        rng = random.Random(0)
+        pages = [synthetic_page(index, rng) for index in range(PAGES)]
+    size = sum(map(len, pages)) / len(pages) / 1024
+    print(f"{len(pages)} pages, {size:.0f} KB on average")
+
+    try:
+        measure("beautifulsoup", pages, legacy_extract)
+    except ImportError:
+        print("beautifulsoup4 is not installed, skipping the old extractor")
+
+    backends = ["stdlib"] + (["lxml"] if html_parser.etree else [])
+    for backend in backends:
+        os.environ["html_backend"] = backend
+        measure(
+            f"{backend}, full page",
+            pages,
+            lambda page: extract_image_candidates(page, False),
+        )
+        measure(f"{backend}, structured", pages, extract_image_candidates)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Compare per-call sessions with the shared HTTP pool.
+
+Replays the request pattern of one send_article (two chat completions,
+one image generation, one image download, one sendPhoto) against a local
+server and reports opened connections and wall time per article.
+
+Run from the repository root: python -m benchmarks.http_pool
+"""
+
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+from utils import http_client
+
+ARTICLES = 20
+LATENCY = 0.01
+
+REQUESTS = [
+    ("post", "/v1/chat/completions"),
+    ("post", "/v1/chat/completions"),
+    ("post", "/v1/images/generations"),
+    ("get", "/image.jpg"),
+    ("post", "/bot/sendPhoto"),
+]
+
+
+async def handler(request):
+    await asyncio.sleep(LATENCY)
+    return web.json_response({"ok": True})
+
+
+async def start_server():
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def article_with_fresh_sessions(base_url):
+    for method, path in REQUESTS:
+        async with aiohttp.ClientSession(
+            trace_configs=[http_client._trace_config()]
+        ) as session:
+            async with session.request(method, base_url + path) as resp:
+                await resp.read()
+
+
+async def article_with_pool(base_url):
+    for method, path in REQUESTS:
+        session = http_client.get_session()
+        async with session.request(method, base_url + path) as resp:
+            await resp.read()
+
+
+async def measure(name, article, base_url):
+    http_client.reset_stats()
+    start = time.perf_counter()
+    for _ in range(ARTICLES):
+        await article(base_url)
+    elapsed = time.perf_counter() - start
+    stats = http_client.get_stats()
+    print(
+        f"{name:>8}: {stats['connections'] / ARTICLES:5.2f} connections, "
+        f"{stats['requests'] / ARTICLES:5.2f} requests, "
+        f"{elapsed / ARTICLES * 1000:7.2f} ms per article"
+    )
+
+
+async def main():
+    runner, base_url = await start_server()
+    try:
+        await measure("before", article_with_fresh_sessions, base_url)
+        await measure("after", article_with_pool, base_url)
+    finally:
+        await http_client.close_sessions()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
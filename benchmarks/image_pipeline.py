@@ -0,0 +1,58 @@
+"""
+Measure candidate discovery for one recipe page with injected latency.
+
+Compares sequential probing (probe_concurrency=1) with the default
+bounded-concurrency pipeline. Every run starts with empty image and page
+caches.
+
+Run from the repository root: python -m benchmarks.image_pipeline
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.servers import image_host, start_app
+from utils import concurrency, http_client, image_cache, page_cache
+from utils.html_parser import get_images_by_url
+
+IMAGES = 40
+LATENCY = 0.05
+
+
+async def measure(name, app, base_url, limit):
+    os.environ["probe_concurrency"] = str(limit)
+    concurrency._semaphores.clear()
+    app["stats"].update(requests=0, bytes=0)
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.environ["image_cache_dir"] = f"{folder}/images"
+        os.environ["page_cache_dir"] = f"{folder}/pages"
+        image_cache._cache = None
+        page_cache._cache = None
+
+        start = time.perf_counter()
+        images = await get_images_by_url(f"{base_url}/recipe")
+        elapsed = time.perf_counter() - start
+
+    print(
+        f"{name:>10}: {len(images)} images, "
+        f"{app['stats']['requests']} requests, "
+        f"{app['stats']['bytes'] / 1024:8.1f} KB, {elapsed:6.2f} s"
+    )
+
+
+async def main():
+    app = image_host(latency=LATENCY, images=IMAGES)
+    runner, base_url = await start_app(app)
+    try:
+        await measure("sequential", app, base_url, 1)
+        await measure("concurrent", app, base_url, 8)
+    finally:
+        await http_client.close_sessions()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,437 @@
+"""Local stand-in servers used by the benchmarks."""
+
+import asyncio
+import base64
+import json
+import random
+import re
+import threading
+import time
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image, ImageFilter
+
+# Phrases telling apart the prompts of expressions/, by pipeline stage
+STAGE_MARKERS = {
+    "choose_themes": "разных блюд",
+    "choose_theme": "вспомнить блюдо",
+    "write_post": "Ты шеф-повар, ведущий телеграм канал",
+    "get_photo": "эксперт по поиску рецептов",
+    "valid_images": "эксперт по анализу данных",
+    "check_images": "Тебе предоставлено",
+    "check_image": "Напиши процент",
+}
+EMOJI = ["🍰", "🥕", "🔥", "🧂", "🍋", "⏱", "👩‍🍳", "❤️"]
+WORDS = [
+    "тесто", "мука", "сахар", "взбить", "духовка", "минут", "соль",
+    "масло", "перемешать", "сковорода", "нарезать", "добавить",
+]
+
+
+async def start_app(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+class ServerThread:
+    """
+    Run stand-in apps on their own event loop in a thread, so serving and
+    making up responses doesn't stall the event loop being measured.
+    Apps are started with start() inside the context manager.
+    """
+
+    def __init__(self):
+        self.runners = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, daemon=True
+        )
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def start(self, app: web.Application) -> str:
+        """Start serving an app and return its base URL."""
+        runner, base_url = self._run(start_app(app))
+        self.runners.append(runner)
+        return base_url
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for runner in self.runners:
+            self._run(runner.cleanup())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def make_jpeg(width: int, height: int, seed: int = 0) -> bytes:
+    color = (seed * 37 % 256, seed * 91 % 256, seed * 53 % 256)
+    output = BytesIO()
+    Image.new("RGB", (width, height), color).save(output, format="JPEG")
+    return output.getvalue()
+
+
+def make_photo(width: int, height: int, seed: int = 0) -> bytes:
+    """A JPEG that compresses and hashes like a photo, unlike make_jpeg."""
+    rng = random.Random(seed)
+    small = (max(width // 4, 1), max(height // 4, 1))
+    noise = Image.effect_noise(small, 60 + seed % 40).convert("RGB")
+    tint = Image.new("RGB", small, tuple(rng.randrange(256) for _ in "rgb"))
+    image = Image.blend(noise, tint, 0.5).filter(ImageFilter.GaussianBlur(2))
+    output = BytesIO()
+    image.resize((width, height), Image.Resampling.BILINEAR).save(
+        output, format="JPEG", quality=85
+    )
+    return output.getvalue()
+
+
+def recipe_page(images: int, first: int = 0) -> str:
+    figures = "\n".join(
+        f'<figure><img src="/images/{index}.jpg" alt="step {index}">'
+        f"<figcaption>Step {index}</figcaption></figure>"
+        for index in range(first, first + images)
+    )
+    return (
+        "<html><head><title>Recipe</title></head><body>"
+        "<header><img src='/logo.png' class='logo'></header>"
+        f"<article><h1>Recipe</h1>{figures}</article>"
+        "</body></html>"
+    )
+
+
+def image_host(
+    latency: float = 0.05,
+    images: int = 40,
+    width: int = 1200,
+    height: int = 800,
+    error_rate: float = 0.0,
+    photos: int = 0,
+) -> web.Application:
+    """
+    Serve recipe pages at /recipe and /recipe/<page>, their images at
+    /images/<n>.jpg and generated images at /generated/<n>.jpg.
+
+    Every response is delayed by `latency` seconds and `error_rate` of
+    them fail with a 503. Page <page> shows `images` images starting
+    after those of the previous pages, all of `width` x `height`. Page
+    images cycle through `photos` photo-like JPEGs made up front, so
+    making them isn't timed, or are flat colors made on first request.
+    Generated images are always flat. Pages carry an ETag and must be
+    revalidated, image responses honor simple "bytes=start-end" Range
+    headers. Requests, errors and sent bytes are counted in app["stats"].
+    """
+    app = web.Application()
+    app["stats"] = {"requests": 0, "errors": 0, "bytes": 0}
+    rng = random.Random(0)
+    pages = {}
+    pool = [make_photo(width, height, seed) for seed in range(photos)]
+    bodies = {}
+
+    async def delay(request):
+        app["stats"]["requests"] += 1
+        await asyncio.sleep(latency)
+        if rng.random() < error_rate:
+            app["stats"]["errors"] += 1
+            raise web.HTTPServiceUnavailable()
+
+    async def recipe(request):
+        await delay(request)
+        number = int(request.match_info.get("page", 0))
+        if number not in pages:
+            pages[number] = recipe_page(images, number * images)
+        page = pages[number]
+
+        headers = {"ETag": f'"{images}"', "Cache-Control": "no-cache"}
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            return web.Response(status=304, headers=headers)
+        app["stats"]["bytes"] += len(page)
+        return web.Response(
+            text=page, content_type="text/html", headers=headers
+        )
+
+    async def image(request):
+        await delay(request)
+        index = int(request.match_info["index"])
+        if pool and request.path.startswith("/images/"):
+            body = pool[index % len(pool)]
+        else:
+            if index not in bodies:
+                bodies[index] = make_jpeg(width, height, index)
+            body = bodies[index]
+
+        match = re.fullmatch(
+            r"bytes=(\d+)-(\d*)", request.headers.get("Range", "")
+        )
+        if match:
+            start = int(match[1])
+            end = int(match[2]) if match[2] else len(body) - 1
+            chunk = body[start:end + 1]
+            app["stats"]["bytes"] += len(chunk)
+            return web.Response(
+                body=chunk,
+                status=206,
+                content_type="image/jpeg",
+                headers={
+                    "Content-Range": (
+                        f"bytes {start}-{start + len(chunk) - 1}/{len(body)}"
+                    )
+                },
+            )
+
+        app["stats"]["bytes"] += len(body)
+        return web.Response(body=body, content_type="image/jpeg")
+
+    app.router.add_get("/recipe", recipe)
+    app.router.add_get("/recipe/{page:\\d+}", recipe)
+    app.router.add_get("/images/{index:\\d+}.jpg", image)
+    app.router.add_get("/generated/{index:\\d+}.jpg", image)
+    return app
+
+
+def bot_api(
+    latency: float = 0.05, flood_every: int = 0, error_rate: float = 0.0
+) -> web.Application:
+    """
+    Fake Telegram Bot API answering sendPhoto and sendMessage.
+
+    Every `flood_every`-th call is rejected with a 429 and retry_after=1,
+    `error_rate` of the calls fail with a 500. Calls are recorded in
+    app["calls"] as (method, fields, uploaded bytes).
+    """
+    app = web.Application()
+    app["calls"] = []
+    rng = random.Random(0)
+    message_ids = iter(range(1, 1_000_000))
+
+    async def method(request):
+        await asyncio.sleep(latency)
+        name = request.match_info["method"]
+
+        uploaded = 0
+        if request.content_type == "multipart/form-data":
+            fields = {}
+            async for part in await request.multipart():
+                if part.filename:
+                    uploaded += len(await part.read())
+                else:
+                    fields[part.name] = await part.text()
+        else:
+            fields = await request.json()
+        app["calls"].append((name, fields, uploaded))
+
+        if flood_every and len(app["calls"]) % flood_every == 0:
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                },
+                status=429,
+            )
+        if rng.random() < error_rate:
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 500,
+                    "description": "Internal Server Error",
+                },
+                status=500,
+            )
+
+        result = {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": fields.get("chat_id")},
+        }
+        if name == "sendPhoto":
+            file_id = fields.get("photo") or f"file-{len(app['calls'])}"
+            result["photo"] = [{"file_id": file_id, "width": 1024}]
+        return web.json_response({"ok": True, "result": result})
+
+    app.router.add_post("/bot{token}/{method}", method)
+    return app
+
+
+def prompt_stage(prompt: str) -> str:
+    for stage, marker in STAGE_MARKERS.items():
+        if marker in prompt:
+            return stage
+    return "default"
+
+
+def synthetic_post(rng: random.Random, length: int) -> str:
+    """An HTML post shaped like post_format.txt, about `length` long."""
+    lines = [
+        f"<b>{rng.choice(WORDS).title()}</b> {rng.choice(EMOJI)}",
+        "<b>Сложность:</b> 🟡🟡⚪️⚪️⚪️\n"
+        "<b>Время приготовления:</b> <i>40 минут</i>",
+        "<b>Рецепт:</b>",
+    ]
+    step = 1
+    while sum(map(len, lines)) < length:
+        words = " ".join(
+            rng.choice(WORDS + EMOJI) for _ in range(rng.randint(8, 20))
+        )
+        lines.append(f"{step}. {words}")
+        step += 1
+    lines.append("#рецепт | #ужин | #домашняя_кухня")
+    return "\n\n".join(lines)
+
+
+def openai_api(
+    latency: float = 0.05,
+    error_rate: float = 0.0,
+    chunk_delay: float = 0.0,
+    post_length: int = 1500,
+    host_url: str = "",
+    image_size: tuple[int, int] = (1024, 1024),
+) -> web.Application:
+    """
+    Fake OpenAI API answering chat completions and image generations.
+
+    Chat answers are made up for the stage of the prompt (see
+    STAGE_MARKERS): new dish names, posts of `post_length` characters,
+    recipe pages and image links of `host_url`, random scores. Streamed
+    answers are sent as 16-character deltas `chunk_delay` seconds apart.
+    Generated images are links to /generated/ of `host_url`, or photos
+    of `image_size` for b64_json. Every response is delayed by `latency`
+    seconds and `error_rate` of them fail with a 500 to be retried.
+    Requests, errors and received bytes are counted in app["stats"],
+    requests by stage in app["stages"].
+    """
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["stats"] = {"requests": 0, "errors": 0, "bytes": 0}
+    app["stages"] = {}
+    rng = random.Random(0)
+    names = iter(range(1, 1_000_000))
+    image_ids = iter(range(1, 1_000_000))
+
+    def idea(prompt):
+        section = re.search(r"из раздела (\S+)", prompt)
+        return {
+            "name": f"Блюдо номер {next(names):06d}",
+            "level": rng.randint(1, 5),
+            "theme": section[1] if section else "benchmark",
+            "time": rng.choice([15, 30, 45, 60, 90]),
+        }
+
+    def answer(stage, prompt, images):
+        if stage == "choose_themes":
+            count = int(re.search(r"вспомнить (\d+)", prompt)[1])
+            return json.dumps(
+                [idea(prompt) for _ in range(count)], ensure_ascii=False
+            )
+        if stage == "choose_theme":
+            return json.dumps(idea(prompt), ensure_ascii=False)
+        if stage == "write_post":
+            return synthetic_post(rng, post_length)
+        if stage == "get_photo":
+            return json.dumps([f"{host_url}/recipe/{page}" for page in "0123"])
+        if stage == "valid_images":
+            limit = int(re.search(r"не более (\d+)", prompt)[1])
+            sources = re.findall(r'"src": "([^"]+)"', prompt)
+            return json.dumps(sources[:limit])
+        if stage == "check_images":
+            return json.dumps([rng.randint(0, 100) for _ in range(images)])
+        if stage == "check_image":
+            return str(rng.randint(0, 100))
+        return "OK"
+
+    async def delay(request):
+        app["stats"]["requests"] += 1
+        app["stats"]["bytes"] += request.content_length or 0
+        await asyncio.sleep(latency)
+        if rng.random() < error_rate:
+            app["stats"]["errors"] += 1
+            return web.json_response(
+                {"error": {"message": "Stand-in failure", "type": "server"}},
+                status=500,
+                headers={"retry-after-ms": "10"},
+            )
+
+    async def completions(request):
+        payload = await request.json()
+        failure = await delay(request)
+        if failure:
+            return failure
+
+        content = payload["messages"][-1]["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        prompt = "".join(
+            part["text"] for part in content if part["type"] == "text"
+        )
+        images = sum(1 for part in content if part["type"] == "image_url")
+        stage = prompt_stage(prompt)
+        app["stages"][stage] = app["stages"].get(stage, 0) + 1
+
+        text = answer(stage, prompt, images)
+        usage = {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": len(text) // 4,
+            "total_tokens": (len(prompt) + len(text)) // 4,
+        }
+        if not payload.get("stream"):
+            return web.json_response(
+                {
+                    "object": "chat.completion",
+                    "model": payload["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": text},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream"}
+        )
+        await response.prepare(request)
+        events = [
+            {"choices": [{"index": 0, "delta": {"content": text[i:i + 16]}}]}
+            for i in range(0, len(text), 16)
+        ]
+        events.append({"choices": [], "usage": usage})
+        for event in events:
+            data = json.dumps(event, ensure_ascii=False)
+            await response.write(f"data: {data}\n\n".encode("utf-8"))
+            if chunk_delay:
+                await asyncio.sleep(chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def generations(request):
+        payload = await request.json()
+        failure = await delay(request)
+        if failure:
+            return failure
+
+        data = []
+        for _ in range(payload.get("n", 1)):
+            index = next(image_ids)
+            if payload.get("response_format") == "b64_json":
+                photo = make_photo(*image_size, index)
+                data.append({"b64_json": base64.b64encode(photo).decode()})
+            else:
+                url = f"{host_url}/generated/{index}.jpg"
+                data.append({"url": url})
+        return web.json_response({"created": int(time.time()), "data": data})
+
+    app.router.add_post("/v1/chat/completions", completions)
+    app.router.add_post("/v1/images/generations", generations)
+    return app
@@ -0,0 +1,443 @@
+"""
+End-to-end benchmarks against local stand-ins of OpenAI, Telegram and
+recipe sites, so they run offline and cost nothing.
+
+Times the whole send_article path (ideas, post, DALL-E image, upload,
+export and photo index), get_image on fresh recipe pages, format_text
+and export_article (which replaced write_to_articles) on archives of
+several sizes of posted articles, and reports p50/p95 latency and
+throughput. Latency, error rates and payload sizes of the stand-ins are
+set by the options.
+
+--save stores the results in benchmarks/baselines.json; otherwise
+results are compared with the baselines saved with the same options, and
+a p50/p95 above or a throughput below them by more than --tolerance (and
+a millisecond per operation) fails the run. Baselines are only comparable
+on the same machine.
+
+Run from the repository root:
+    python -m benchmarks.suite [--save] [--archives 0,1000,10000]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import NamedTuple
+
+from sqlalchemy import func, insert, select
+
+from agents import limiter
+from benchmarks.article_history import synthetic_name
+from benchmarks.servers import (
+    ServerThread,
+    bot_api,
+    image_host,
+    openai_api,
+    synthetic_post,
+)
+from database import hashtag, photo_hash
+from database.orm import Article, Link, PhotoHash, init_db
+from database.session import close_engine, unit_of_work
+from generators import buffer, ideas
+from generators.channels import Channel
+from generators.images import get_image
+from generators.sender import send_article
+from telegram.formatter import format_text
+from utils import file_handler, http_client, image_cache, page_cache
+from utils.file_handler import export_article
+from utils.image_hash import to_signed
+from utils.thumbnail import close_thumbnail_pool
+
+BASELINES = Path(__file__).with_name("baselines.json")
+CHANNEL = Channel("benchmark", "@benchmark", "TOKEN")
+# Distinct post texts of the archive, cycled
+ARCHIVE_POSTS = 50
+FORMAT_RUNS = 2000
+EXPORT_RUNS = 50
+# Slowdowns below this many milliseconds per operation are noise
+NOISE_MS = 1.0
+
+
+class Result(NamedTuple):
+    scenario: str
+    archive: int
+    runs: int
+    failures: int
+    # Milliseconds
+    p50: float
+    p95: float
+    # Operations per second
+    throughput: float
+
+    @property
+    def key(self) -> str:
+        return f"{self.scenario}@{self.archive}"
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+async def measure(
+    scenario: str, archive: int, operation, runs: int, concurrency: int
+) -> Result:
+    """
+    Run `operation` `runs` times on `concurrency` workers after one
+    warm-up run. The operation returns False or raises when it fails.
+    """
+    await operation()
+    timings = []
+    failures = 0
+    remaining = iter(range(runs))
+
+    async def worker():
+        nonlocal failures
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                ok = await operation()
+            except Exception as e:
+                print(f"{scenario} failed: {e!r}", file=sys.stderr)
+                ok = False
+            timings.append((time.perf_counter() - start) * 1000)
+            failures += ok is False
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return Result(
+        scenario,
+        archive,
+        runs,
+        failures,
+        percentile(timings, 0.5),
+        percentile(timings, 0.95),
+        runs / elapsed,
+    )
+
+
+def fill_archive(session, size: int):
+    """Insert `size` posted articles with their photo hashes."""
+    rng = random.Random(0)
+    posts = [synthetic_post(rng, 1500) for _ in range(ARCHIVE_POSTS)]
+    start = datetime(2020, 1, 1)
+    rows = [
+        {
+            "name": synthetic_name(rng),
+            "theme": "benchmark",
+            "level": 1,
+            "time": 30,
+            "text": posts[index % ARCHIVE_POSTS],
+            "photo": f"https://example.com/{index}.jpg",
+            "date": start + timedelta(minutes=index),
+            "is_posted": True,
+            "posted_id": index + 1,
+            "posted_channel": CHANNEL.chat,
+            "posted_photo": f"file-{index}",
+            "posted_time": start + timedelta(minutes=index),
+            "is_ready": False,
+            "channel": CHANNEL.name,
+        }
+        for index in range(size)
+    ]
+    if rows:
+        session.execute(insert(Article), rows)
+        session.execute(
+            insert(PhotoHash),
+            [
+                {
+                    "article_id": article_id,
+                    "dhash": to_signed(rng.getrandbits(64)),
+                    "phash": to_signed(rng.getrandbits(64)),
+                }
+                for article_id in session.scalars(select(Article.id))
+            ],
+        )
+    session.commit()
+
+
+def use_folder(folder: str):
+    """Point the database, caches and export at a new folder."""
+    os.environ["db_path"] = f"{folder}/db.sqlite3"
+    os.environ["recipes_export"] = f"{folder}/recipes.jsonl"
+    os.environ["image_cache_dir"] = f"{folder}/images"
+    os.environ["page_cache_dir"] = f"{folder}/pages"
+    buffer.ARTICLE_IMAGES = Path(folder, "articles")
+    # Singletons opened on the previous folder
+    file_handler._export = None
+    image_cache._cache = None
+    page_cache._cache = None
+    photo_hash._posted = None
+    hashtag._registry = None
+
+
+async def count_posted() -> int:
+    async with unit_of_work(write=False) as session:
+        return await session.scalar(
+            select(func.count()).where(Article.is_posted == True)  # noqa E712
+        )
+
+
+async def run_archive(
+    folder: str, size: int, host_url: str, options
+) -> list[Result]:
+    use_folder(folder)
+    session = init_db(os.environ["db_path"])
+    fill_archive(session, size)
+    session.close()
+    await file_handler.rebuild_export()
+
+    results = []
+    texts = random.Random(size)
+
+    async def post():
+        await send_article(datetime.now(), CHANNEL)
+
+    before = await count_posted()
+    result = await measure(
+        "send_article", size, post, options.runs, options.concurrency
+    )
+    posted = await count_posted() - before
+    # The warm-up run posts too
+    results.append(result._replace(failures=result.runs + 1 - posted))
+
+    pages = iter(range(10_000))
+
+    async def image():
+        # Fresh pages every run, as for a new article
+        links = [
+            Link(link=f"{host_url}/recipe/{next(pages)}")
+            for _ in range(options.links)
+        ]
+        text = synthetic_post(texts, options.post_length)
+        return await get_image("Борщ", text, links, CHANNEL) is not None
+
+    results.append(await measure(
+        "get_image", size, image, options.runs, options.concurrency
+    ))
+
+    ids = iter(range(10_000_000, 20_000_000))
+
+    async def export():
+        article_id = next(ids)
+        await export_article(Article(
+            id=article_id,
+            name=f"Блюдо номер {article_id}",
+            photo=f"https://example.com/{article_id}.jpg",
+            posted_id=article_id,
+            posted_channel=CHANNEL.chat,
+            posted_photo=f"file-{article_id}",
+            text=synthetic_post(texts, options.post_length),
+        ))
+
+    results.append(
+        await measure("export_article", size, export, EXPORT_RUNS, 1)
+    )
+
+    # Background idea refills started by send_article use this database
+    await asyncio.gather(*ideas._refills.values(), return_exceptions=True)
+    ideas._refills.clear()
+    await close_engine()
+    return results
+
+
+async def run_suite(options) -> list[Result]:
+    rng = random.Random(0)
+    posts = [synthetic_post(rng, options.post_length) for _ in range(100)]
+    cycle = iter(posts * (FORMAT_RUNS // len(posts) + 2))
+
+    async def format_post():
+        format_text(next(cycle))
+
+    # Doesn't depend on the archive
+    results = [await measure("format_text", 0, format_post, FORMAT_RUNS, 1)]
+
+    with ServerThread() as servers:
+        images = image_host(
+            latency=options.latency,
+            images=options.images,
+            width=options.image_width,
+            height=options.image_width * 2 // 3,
+            error_rate=options.error_rate,
+            photos=options.photos,
+        )
+        host_url = servers.start(images)
+        openai = openai_api(
+            latency=options.latency,
+            error_rate=options.error_rate,
+            chunk_delay=options.chunk_delay,
+            post_length=options.post_length,
+            host_url=host_url,
+        )
+        os.environ["openai_api"] = servers.start(openai)
+        telegram = bot_api(
+            latency=options.latency, error_rate=options.error_rate
+        )
+        os.environ["telegram_api"] = servers.start(telegram)
+
+        try:
+            for size in options.archives:
+                with tempfile.TemporaryDirectory() as folder:
+                    results += await run_archive(
+                        folder, size, host_url, options
+                    )
+        finally:
+            await http_client.close_sessions()
+            close_thumbnail_pool()
+
+    print(
+        f"OpenAI stand-in: {openai['stats']}, by stage {openai['stages']}\n"
+        f"Recipe sites: {images['stats']}\n"
+        f"Bot API: {len(telegram['calls'])} calls"
+    )
+    return results
+
+
+def settings(options) -> dict:
+    """Options that change the results, baselines are kept per settings."""
+    return {
+        name: getattr(options, name)
+        for name in (
+            "latency", "error_rate", "chunk_delay", "post_length", "images",
+            "image_width", "photos", "links", "runs", "concurrency",
+        )
+    }
+
+
+def compare(results: list[Result], baseline: dict, tolerance: float):
+    """Print the results next to the baseline, return the regressions."""
+    regressions = []
+    print(
+        f"{'scenario':>24} {'runs':>5} {'fail':>5} {'p50 ms':>10} "
+        f"{'p95 ms':>10} {'ops/s':>9}  baseline p50/p95, ops/s"
+    )
+    for result in results:
+        line = (
+            f"{result.key:>24} {result.runs:5d} {result.failures:5d} "
+            f"{result.p50:10.2f} {result.p95:10.2f} "
+            f"{result.throughput:9.2f}"
+        )
+        previous = baseline.get(result.key)
+        if previous:
+            line += (
+                f"  {previous['p50']:.2f}/{previous['p95']:.2f}, "
+                f"{previous['throughput']:.2f}"
+            )
+            # Throughput as milliseconds per operation
+            pairs = [
+                (result.p50, previous["p50"]),
+                (result.p95, previous["p95"]),
+                (1000 / result.throughput, 1000 / previous["throughput"]),
+            ]
+            if any(
+                value > old * (1 + tolerance) and value - old > NOISE_MS
+                for value, old in pairs
+            ):
+                line += "  REGRESSION"
+                regressions.append(result.key)
+        print(line)
+    return regressions
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--archives",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[0, 1000, 10000],
+        help="comma-separated numbers of archived articles",
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--latency", type=float, default=0.05,
+        help="seconds before every stand-in response",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0,
+        help="share of stand-in responses that fail",
+    )
+    parser.add_argument(
+        "--chunk-delay", type=float, default=0.0,
+        help="seconds between streamed deltas",
+    )
+    parser.add_argument("--post-length", type=int, default=1500)
+    parser.add_argument(
+        "--images", type=int, default=8, help="images per recipe page"
+    )
+    parser.add_argument("--image-width", type=int, default=1200)
+    parser.add_argument(
+        "--photos", type=int, default=64,
+        help="distinct photos the recipe pages cycle through",
+    )
+    parser.add_argument(
+        "--links", type=int, default=2, help="recipe pages per get_image"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25,
+        help="allowed slowdown against the baseline, 0.25 is 25%%",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="store results as baselines"
+    )
+    return parser.parse_args()
+
+
+def main():
+    options = parse_options()
+    # Stand-ins, so the account limits of the real API don't apply
+    for model in limiter.MODEL_LIMITS:
+        os.environ[f"{model}_rpm"] = "1000000"
+        os.environ[f"{model}_tpm"] = "1000000000"
+    os.environ.update(
+        api_key="benchmark",
+        telegram_interval="0",
+        llm_cache_stages="",
+    )
+    random.seed(0)
+
+    results = asyncio.run(run_suite(options))
+
+    stored = json.loads(BASELINES.read_text()) if BASELINES.exists() else []
+    current = settings(options)
+    baseline = next(
+        (entry for entry in stored if entry["settings"] == current), None
+    )
+    regressions = compare(
+        results, baseline["results"] if baseline else {}, options.tolerance
+    )
+
+    if options.save:
+        stored = [entry for entry in stored if entry is not baseline]
+        stored.append({
+            "settings": current,
+            "results": {
+                result.key: {
+                    "p50": round(result.p50, 3),
+                    "p95": round(result.p95, 3),
+                    "throughput": round(result.throughput, 3),
+                }
+                for result in results
+            },
+        })
+        BASELINES.write_text(json.dumps(stored, indent=2) + "\n")
+        print(f"Saved baselines to {BASELINES}")
+    elif baseline is None:
+        print("No baselines for these options, save them with --save")
+    elif regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
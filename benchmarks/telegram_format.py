@@ -0,0 +1,125 @@
+"""
+Measure formatting of generated posts for Telegram.
+
+Compares the previous SelectiveStripper, which only produced HTML, with
+the single-pass formatter producing HTML, plain text and entities, and
+the cost of splitting long posts. Posts are synthetic, emoji-heavy and
+near the caption limit, and the report counts the posts the previous
+len(html) <= 1024 rule got wrong against Telegram's UTF-16 count.
+
+Run from the repository root: python -m benchmarks.telegram_format
+"""
+
+import random
+import time
+from html.parser import HTMLParser
+
+from telegram.formatter import format_text
+from telegram.poster import CAPTION_LIMIT, MESSAGE_LIMIT
+
+POSTS = 2000
+ROUNDS = 5
+EMOJI = ["🍰", "🥕", "🔥", "🧂", "🍋", "⏱", "👩‍🍳", "❤️"]
+WORDS = ["тесто", "мука", "сахар", "взбить", "духовка", "минут", "соль"]
+
+
+class SelectiveStripper(HTMLParser):
+    """The formatter this benchmark replaces."""
+
+    ALLOWED = {
+        "b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "code",
+        "pre", "blockquote", "tg-spoiler",
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.result = []
+        self.stack = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs_dict = {k.lower(): v for k, v in attrs if k is not None}
+        if tag == "br":
+            self.result.append("\n")
+            return
+        if tag in self.ALLOWED or (tag == "a" and "href" in attrs_dict):
+            attr_parts = [
+                k if v is None else f'{k}="{v}"' for k, v in attrs
+            ]
+            attr_str = (" " + " ".join(attr_parts)) if attr_parts else ""
+            self.result.append(f"<{tag}{attr_str}>")
+            self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if self.stack and self.stack[-1] == tag:
+            self.stack.pop()
+            self.result.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        self.result.append(data.replace("*", ""))
+
+    def get_cleaned(self):
+        return "".join(self.result).replace("\n\n\n", "\n\n")
+
+
+def legacy_format(text: str) -> str:
+    parser = SelectiveStripper()
+    parser.feed(text)
+    parser.close()
+    return parser.get_cleaned()
+
+
+def synthetic_post(rng: random.Random, paragraphs: int) -> str:
+    lines = []
+    for _ in range(paragraphs):
+        words = " ".join(
+            rng.choice(WORDS + EMOJI * 4) for _ in range(rng.randint(8, 30))
+        )
+        title = rng.choice(WORDS).title()
+        if rng.random() < 0.3:
+            title = f"<b>{title}</b>"
+        lines.append(f"{rng.choice(EMOJI)} {title}: {words}")
+    lines.append("<a href='https://example.com/recipe?a=1&b=2'>Рецепт</a>")
+    lines.append("#выпечка #десерт")
+    return "\n\n".join(lines)
+
+
+def measure(name: str, posts: list[str], run):
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for post in posts:
+            run(post)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:>24}: {best / len(posts) * 1e6:8.1f} us/post")
+
+
+def main():
+    rng = random.Random(0)
+    posts = [synthetic_post(rng, rng.randint(4, 12)) for _ in range(POSTS)]
+    long_posts = [synthetic_post(rng, 150) for _ in range(POSTS // 20)]
+
+    measure("legacy, html only", posts, legacy_format)
+    measure("single pass, entities", posts, format_text)
+    measure(
+        "single pass + split",
+        long_posts,
+        lambda post: format_text(post).split(MESSAGE_LIMIT),
+    )
+
+    # The previous rule sent a caption when len(html) <= CAPTION_LIMIT
+    rejected = separate = 0
+    for post in posts:
+        fits = len(legacy_format(post)) <= CAPTION_LIMIT
+        if fits and format_text(post).length > CAPTION_LIMIT:
+            rejected += 1
+        elif not fits and format_text(post).length <= CAPTION_LIMIT:
+            separate += 1
+    print(
+        f"previous caption rule: {rejected}/{len(posts)} posts rejected "
+        f"as too long, {separate}/{len(posts)} sent as a separate message "
+        "although they fit a caption"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Measure thumbnailing of candidate photos for the vision model.
+
+Compares the previous full decode + LANCZOS resize with draft-mode
+decoding and thumbnail(), in process and in the process pool. Pass a
+folder of real recipe photos (*.jpg, *.jpeg, *.png, *.webp); without one,
+photo-like 2000x1333 JPEGs are generated.
+
+Run from the repository root:
+    python -m benchmarks.thumbnails [folder with photos]
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageFilter
+
+from utils import thumbnail as thumbnails
+from utils.thumbnail import make_thumbnail, thumbnail, thumbnail_target
+
+PHOTOS = 24
+SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def synthetic_photo(seed: int) -> bytes:
+    # Blurred noise compresses like a photo, unlike flat colors
+    rng = random.Random(seed)
+    noise = Image.effect_noise((500, 333), 60 + seed % 40).convert("RGB")
+    tint = Image.new("RGB", noise.size, tuple(
+        rng.randrange(256) for _ in range(3)
+    ))
+    image = Image.blend(noise, tint, 0.5).filter(ImageFilter.GaussianBlur(2))
+    image = image.resize((2000, 1333), Image.Resampling.BICUBIC)
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def legacy_resize(image: bytes, max_width: int = 120) -> bytes:
+    """The resize_image this benchmark replaces."""
+    with Image.open(BytesIO(image)) as img:
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGB")
+        if img.width > max_width:
+            img = img.resize(
+                (max_width, int(img.height * max_width / img.width)),
+                Image.Resampling.LANCZOS,
+            )
+        output = BytesIO()
+        img.save(output, format="JPEG", quality=95)
+        return output.getvalue()
+
+
+def measure_cpu(name: str, photos: list[bytes], run):
+    start = time.process_time()
+    outputs = [run(photo) for photo in photos]
+    elapsed = time.process_time() - start
+    print(
+        f"{name:>28}: {elapsed / len(photos) * 1000:7.2f} ms CPU/image, "
+        f"{sum(map(len, outputs)) / len(outputs) / 1024:5.1f} KB output"
+    )
+
+
+async def measure_pool(photos: list[bytes], workers: int):
+    os.environ["thumbnail_workers"] = str(workers)
+    thumbnails.close_thumbnail_pool()
+    # Start the workers before timing
+    await asyncio.gather(*(thumbnail(photo) for photo in photos[:workers]))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(thumbnail(photo) for photo in photos))
+    elapsed = time.perf_counter() - start
+    thumbnails.close_thumbnail_pool()
+    print(
+        f"{f'pool of {workers}':>28}: {elapsed / len(photos) * 1000:7.2f} "
+        "ms wall/image"
+    )
+
+
+def main():
+    if len(sys.argv) > 1:
+        photos = [
+            path.read_bytes()
+            for path in sorted(Path(sys.argv[1]).iterdir())
+            if path.suffix.lower() in SUFFIXES
+        ]
+    else:
+        photos = [synthetic_photo(seed) for seed in range(PHOTOS)]
+    size = sum(map(len, photos)) / len(photos) / 1024
+    print(f"{len(photos)} photos, {size:.0f} KB on average")
+
+    target = thumbnail_target()
+    measure_cpu("full decode + LANCZOS", photos, legacy_resize)
+    measure_cpu(
+        "draft + thumbnail()",
+        photos,
+        lambda photo: make_thumbnail(photo, target),
+    )
+    for workers in sorted({1, os.cpu_count() or 1}):
+        asyncio.run(measure_pool(photos, workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,162 @@
-from sqlalchemy.orm import Session
+import itertools
+import logging
+import math
+import re
 
-from .orm import Article
+from sqlalchemy import select, text, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from .orm import DEFAULT_CHANNEL, Article
 
-def get_existing_articles(
-    session: Session,
+# Length of the word prefix compared by find_duplicate
+STEM_LENGTH = 5
+# Above this many stem groups the FTS query matches any single stem
+MAX_MATCH_GROUPS = 20
+
+_WORD = re.compile(r"\w+")
+
+
+def _history_condition(exist=True, with_ready=False):
+    condition = Article.is_posted == exist
+    if with_ready:
+        condition = condition | (Article.is_ready == True)  # noqa E712
+    return condition
+
+
+async def get_existing_articles(
+    session: AsyncSession,
     exist=True,
     enumerate_=False,
     maximum=10,
+    with_ready=False,
+    channel=None,
 ):
-    articles = session.query(Article).filter(Article.is_posted == exist).all()
-    if not articles:
-        return "отсутствуют"
+    query = select(Article.name).where(_history_condition(exist, with_ready))
+    if channel:
+        query = query.where(Article.channel == channel)
+    rows = (
+        await session.execute(
+            query.order_by(Article.date.desc(), Article.id.desc())
+            .limit(maximum)
+        )
+    ).all()
+    if not rows:
+        return ""
 
-    articles = [article.name for article in articles][-maximum:]
+    # Oldest first, as the prompt lists the history chronologically
+    articles = [row.name for row in reversed(rows)]
     if enumerate_:
         for index, article in enumerate(articles):
             articles[index] = f"{index + 1}. {article}"
     return "\n".join(articles)
 
 
-def add_article(session: Session, **kwargs):
-    article = Article(**kwargs, is_posted=False)
-    session.add(article)
-    session.commit()
-    return article
+def prompt_names(*names: str) -> str:
+    """Join names for a prompt, one per line, saying so if there are none."""
+    return "\n".join(name for name in names if name) or "отсутствуют"
+
+
+def name_stems(name: str) -> set[str]:
+    """Lowercased word prefixes, a crude stemmer for Russian names."""
+    words = _WORD.findall(name.lower().replace("ё", "е"))
+    return {word[:STEM_LENGTH] for word in words if len(word) > 2}
+
+
+def name_similarity(first: str, second: str) -> float:
+    first_stems, second_stems = name_stems(first), name_stems(second)
+    if not first_stems or not second_stems:
+        return 0.0
+    return len(first_stems & second_stems) / len(first_stems | second_stems)
+
+
+async def find_duplicate(
+    session: AsyncSession,
+    name: str,
+    channel=None,
+    threshold: float = 0.75,
+    candidates: int = 20,
+) -> str | None:
+    """
+    Return the name of an existing article similar to `name`, if any.
+
+    Candidates sharing enough word stems are found through the
+    articles_fts index and compared by the overlap of their stems.
+    """
+    stems = sorted(name_stems(name))
+    if not stems:
+        return None
+
+    # A match has to share at least `shared` of the stems to reach the
+    # threshold, so only such names are fetched from the index
+    shared = max(1, math.ceil(threshold * len(stems)))
+    groups = list(itertools.combinations(stems, shared))
+    if len(groups) > MAX_MATCH_GROUPS:
+        groups = [(stem,) for stem in stems]
+    query = " OR ".join(
+        "(" + " AND ".join(f'"{stem}"*' for stem in group) + ")"
+        for group in groups
+    )
+    sql = (
+        "SELECT articles.name FROM articles_fts "
+        "JOIN articles ON articles.id = articles_fts.rowid "
+        "WHERE articles_fts MATCH :query "
+        "AND (articles.is_posted OR articles.is_ready) "
+    )
+    params = {"query": query, "limit": candidates}
+    if channel:
+        sql += "AND articles.channel = :channel "
+        params["channel"] = channel
+    sql += "ORDER BY articles_fts.rank LIMIT :limit"
+
+    try:
+        rows = (await session.execute(text(sql), params)).all()
+    except OperationalError as e:
+        logging.debug(f"Duplicate search skipped: {e}")
+        return None
+
+    scored = [(name_similarity(name, row.name), row.name) for row in rows]
+    score, best = max(scored, default=(0.0, None))
+    return best if score >= threshold else None
+
+
+async def get_ready_articles(
+    session: AsyncSession,
+    day_time: str,
+    channel: str = DEFAULT_CHANNEL,
+) -> list[Article]:
+    articles = await session.scalars(
+        select(Article)
+        .where(
+            Article.is_ready == True,  # noqa E712
+            Article.is_posted == False,  # noqa E712
+            Article.day_time == day_time,
+            Article.channel == channel,
+        )
+        .order_by(Article.ready_time)
+    )
+    return list(articles)
+
+
+async def claim_ready_article(
+    session: AsyncSession,
+    day_time: str,
+    channel: str = DEFAULT_CHANNEL,
+) -> Article | None:
+    """
+    Take the oldest ready article out of the buffer. The conditional
+    update succeeds for one caller only, the others move on to the next
+    article.
+    """
+    for article in await get_ready_articles(session, day_time, channel):
+        result = await session.execute(
+            update(Article)
+            .where(
+                Article.id == article.id,
+                Article.is_ready == True,  # noqa E712
+            )
+            .values(is_ready=False)
+        )
+        if result.rowcount:
+            return article
+    return None
@@ -0,0 +1,153 @@
+import heapq
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from sqlalchemy import literal_column, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .article import name_stems
+from .orm import Hashtag
+from .session import unit_of_work
+
+
+class HashtagStats(NamedTuple):
+    # Channel of the stored row, None for a shared hashtag
+    channel: Optional[str]
+    usage_count: int
+    last_used: Optional[datetime]
+    stems: frozenset[str]
+
+
+def _stems(name: str) -> frozenset[str]:
+    return frozenset(name_stems(name.replace("_", " ")))
+
+
+class HashtagRegistry:
+    """
+    In-memory index of the hashtags available to each channel.
+
+    A channel's hashtags are read from the database once, then usage is
+    counted both in memory and through bulk upserts, so choosing hashtags
+    for a prompt doesn't touch the database.
+    """
+
+    def __init__(self):
+        self.channels: dict[str, dict[str, HashtagStats]] = {}
+
+    async def load(self, channel: str) -> dict[str, HashtagStats]:
+        if channel in self.channels:
+            return self.channels[channel]
+
+        async with unit_of_work(write=False) as session:
+            rows = await session.execute(
+                select(
+                    Hashtag.name,
+                    Hashtag.channel,
+                    Hashtag.usage_count,
+                    Hashtag.last_used,
+                ).where(
+                    (Hashtag.channel == channel) | Hashtag.channel.is_(None)
+                )
+            )
+        tags = {}
+        # Shared rows first, so the channel's own row of a name wins
+        for row in sorted(rows, key=lambda row: row.channel is not None):
+            tags[row.name] = HashtagStats(
+                row.channel, row.usage_count, row.last_used, _stems(row.name)
+            )
+        self.channels[channel] = tags
+        return tags
+
+    def top(self, channel: str, theme: str, limit: int) -> list[str]:
+        """
+        Return up to `limit` hashtags for a post about `theme`.
+
+        Hashtags sharing a word stem with the theme come first, then the
+        most used and the most recently used ones.
+        """
+        theme_stems = _stems(theme)
+
+        def relevance(item):
+            name, stats = item
+            return (
+                bool(stats.stems & theme_stems),
+                stats.usage_count,
+                stats.last_used or datetime.min,
+            )
+
+        tags = self.channels.get(channel, {})
+        return [
+            name for name, _ in heapq.nlargest(limit, tags.items(), relevance)
+        ]
+
+    def _usage(self, names, channel: str):
+        tags = self.channels.get(channel, {})
+        for name in dict.fromkeys(names):
+            stats = tags.get(name)
+            yield name, stats.channel if stats else channel
+
+    async def save_usage(
+        self,
+        session: AsyncSession,
+        names,
+        channel: str,
+        moment: datetime,
+    ):
+        """Upsert used hashtags in a unit of work, new ones included."""
+        rows = [
+            {
+                "name": name,
+                "channel": row_channel,
+                "usage_count": 1,
+                "last_used": moment,
+            }
+            for name, row_channel in self._usage(names, channel)
+        ]
+        if not rows:
+            return
+
+        statement = insert(Hashtag).values(rows)
+        await session.execute(
+            statement.on_conflict_do_update(
+                # Must match ux_hashtags_name_channel literally
+                index_elements=[
+                    Hashtag.name,
+                    literal_column("coalesce(channel, '')"),
+                ],
+                set_={
+                    "usage_count": Hashtag.usage_count + 1,
+                    "last_used": statement.excluded.last_used,
+                },
+            )
+        )
+
+    def count_usage(self, names, channel: str, moment: datetime):
+        """Apply saved usage to the loaded index after the commit."""
+        for name, row_channel in self._usage(names, channel):
+            # A shared hashtag is listed in every loaded channel
+            if row_channel is None:
+                channels = list(self.channels.values())
+            elif channel in self.channels:
+                channels = [self.channels[channel]]
+            else:
+                channels = []
+
+            for tags in channels:
+                stats = tags.get(name)
+                if stats and stats.channel == row_channel:
+                    tags[name] = stats._replace(
+                        usage_count=stats.usage_count + 1, last_used=moment
+                    )
+                elif stats is None and row_channel == channel:
+                    tags[name] = HashtagStats(channel, 1, moment, _stems(name))
+
+
+_registry: Optional[HashtagRegistry] = None
+
+
+def get_hashtag_registry() -> HashtagRegistry:
+    global _registry
+    if _registry is None:
+        _registry = HashtagRegistry()
+    return _registry
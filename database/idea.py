@@ -0,0 +1,76 @@
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .orm import Idea
+
+
+async def count_ideas(session: AsyncSession, channel: str) -> dict[str, int]:
+    """Return the number of waiting ideas per section of a channel."""
+    rows = await session.execute(
+        select(Idea.section, func.count())
+        .where(Idea.channel == channel)
+        .group_by(Idea.section)
+    )
+    return dict(rows.all())
+
+
+async def get_idea_names(session: AsyncSession, channel: str) -> list[str]:
+    names = await session.scalars(
+        select(Idea.name).where(Idea.channel == channel)
+    )
+    return list(names)
+
+
+async def add_ideas(
+    session: AsyncSession,
+    channel: str,
+    section: str,
+    ideas: list[dict],
+):
+    """Add validated ideas, skipping names already in the backlog."""
+    if not ideas:
+        return
+    await session.execute(
+        insert(Idea)
+        .values([
+            {"channel": channel, "section": section, **idea}
+            for idea in ideas
+        ])
+        .on_conflict_do_nothing()
+    )
+
+
+async def pop_idea(
+    session: AsyncSession,
+    channel: str,
+    section: str,
+) -> Idea | None:
+    """Remove and return the oldest idea of a section."""
+    idea = await session.scalar(
+        select(Idea)
+        .where(Idea.channel == channel, Idea.section == section)
+        .order_by(Idea.id)
+        .limit(1)
+    )
+    if idea:
+        await session.execute(delete(Idea).where(Idea.id == idea.id))
+    return idea
+
+
+async def restore_idea(session: AsyncSession, idea: Idea):
+    """Put back a popped idea with its id, so it's the next one again."""
+    await session.execute(
+        insert(Idea)
+        .values(
+            id=idea.id,
+            channel=idea.channel,
+            section=idea.section,
+            name=idea.name,
+            level=idea.level,
+            theme=idea.theme,
+            time=idea.time,
+            created_at=idea.created_at,
+        )
+        .on_conflict_do_nothing()
+    )
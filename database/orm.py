@@ -6,17 +6,42 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
+    UniqueConstraint,
     create_engine,
+    event,
     func,
+    inspect,
+    text,
 )
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, relationship, sessionmaker
 
 # Base model
 Base = declarative_base()
 
+# Channel name of articles created before channels were configurable
+DEFAULT_CHANNEL = "default"
+DB_PATH = "database/db.sqlite3"
+
+# Applied to every connection, see set_pragmas
+PRAGMAS = {
+    # Readers don't block the writer and the writer doesn't block readers
+    "journal_mode": "WAL",
+    # Durable at checkpoints, enough for WAL and much cheaper per commit
+    "synchronous": "NORMAL",
+    # Wait for a lock held by another process instead of failing at once
+    "busy_timeout": 5000,
+    "foreign_keys": "ON",
+    "temp_store": "MEMORY",
+    # 20 MB page cache per connection
+    "cache_size": -20000,
+}
+
 
 # Articles model
 class Article(Base):
@@ -41,8 +66,21 @@ class Article(Base):
     posted_photo = Column(String, nullable=True)
     posted_time = Column(DateTime(timezone=True), nullable=True)
 
+    channel = Column(String, nullable=False, server_default=DEFAULT_CHANNEL)
+    day_time = Column(String, nullable=True)
+    is_ready = Column(Boolean, default=False)
+    ready_time = Column(DateTime(timezone=True), nullable=True)
+    photo_path = Column(String, nullable=True)
+
     links = relationship("Link", back_populates="article")
 
+    __table_args__ = (
+        # Newest articles first, see get_existing_articles
+        Index("ix_articles_channel_date", "channel", "date"),
+        Index("ix_articles_posted_date", "is_posted", "date"),
+        Index("ix_articles_posted_time", "posted_time"),
+    )
+
 
 class Link(Base):
     __tablename__ = "links"
@@ -52,7 +90,9 @@ class Link(Base):
         primary_key=True,
         autoincrement=True,
     )
-    article_id = Column(ForeignKey("articles.id"), nullable=False)
+    article_id = Column(
+        ForeignKey("articles.id"), nullable=False, index=True
+    )
     link = Column(String, nullable=False)
 
     article = relationship("Article", back_populates="links")
@@ -67,6 +107,19 @@ class Hashtag(Base):
         autoincrement=True,
     )
     name = Column(String, nullable=False)
+    # None for hashtags shared by all channels
+    channel = Column(String, nullable=True)
+    usage_count = Column(Integer, nullable=False, server_default="0")
+    last_used = Column(DateTime, nullable=True)
+
+
+# A hashtag is stored once per channel, NULL (shared) included
+Index(
+    "ux_hashtags_name_channel",
+    Hashtag.name,
+    func.coalesce(Hashtag.channel, ""),
+    unique=True,
+)
 
 
 class Theme(Base):
@@ -82,6 +135,59 @@ class Theme(Base):
     probability = Column(Integer, nullable=False)
 
 
+class Idea(Base):
+    """Recipe idea generated ahead of time, removed once it's used."""
+
+    __tablename__ = "ideas"
+
+    id = Column(  # noqa VNE003
+        Integer,
+        primary_key=True,
+        autoincrement=True,
+    )
+    channel = Column(String, nullable=False)
+    # Theme.name the idea was generated for
+    section = Column(String, nullable=False)
+    name = Column(String, nullable=False)
+    level = Column(Integer, nullable=False)
+    theme = Column(String, nullable=False)
+    time = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("channel", "name"),
+        Index("ix_ideas_section", "channel", "section", "id"),
+    )
+
+
+class PhotoHash(Base):
+    """Perceptual hashes of a posted photo, see utils/image_hash.py."""
+
+    __tablename__ = "photo_hashes"
+
+    id = Column(  # noqa VNE003
+        Integer,
+        primary_key=True,
+        autoincrement=True,
+    )
+    article_id = Column(ForeignKey("articles.id"), nullable=False, unique=True)
+    # 64-bit hashes stored as signed SQLite integers
+    dhash = Column(Integer, nullable=False)
+    phash = Column(Integer, nullable=False)
+
+
+class SlotRun(Base):
+    __tablename__ = "slot_runs"
+
+    id = Column(  # noqa VNE003
+        Integer,
+        primary_key=True,
+        autoincrement=True,
+    )
+    slot = Column(String, nullable=False, unique=True)
+    last_run = Column(DateTime, nullable=False)
+
+
 def seed_themes(session):
     if session.query(Theme).first():
         logging.debug("Themes table already seeded, skipping.")
@@ -110,12 +216,113 @@ def seed_hashtags(session):
     logging.info(f"Seeded {len(themes)} hashtags.")
 
 
+def set_pragmas(connection, _):
+    cursor = connection.cursor()
+    for name, value in PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def dedupe_hashtags(engine):
+    """Drop repeated hashtags so the unique index can be created."""
+    with engine.begin() as connection:
+        deleted = connection.execute(text(
+            "DELETE FROM hashtags WHERE id NOT IN ("
+            "SELECT min(id) FROM hashtags "
+            "GROUP BY name, coalesce(channel, ''))"
+        )).rowcount
+    if deleted:
+        logging.info(f"Removed {deleted} duplicate hashtags")
+
+
+def migrate(engine):
+    """
+    Add columns and indexes that are missing from tables created by
+    older versions.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {
+            column["name"] for column in inspector.get_columns(table.name)
+        }
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            definition = column.type.compile(engine.dialect)
+            if column.server_default is not None:
+                definition += f" DEFAULT '{column.server_default.arg}'"
+            with engine.begin() as connection:
+                connection.execute(text(
+                    f"ALTER TABLE {table.name} "
+                    f"ADD COLUMN {column.name} {definition}"
+                ))
+            logging.info(f"Added column {table.name}.{column.name}")
+
+    dedupe_hashtags(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def create_name_index(engine) -> bool:
+    """
+    Create the FTS5 index over article names, kept in sync by triggers.
+
+    Returns False if SQLite was built without FTS5.
+    """
+    with engine.begin() as connection:
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'articles_fts'"
+        )).first()
+        if exists:
+            return True
+
+        try:
+            connection.execute(text(
+                "CREATE VIRTUAL TABLE articles_fts USING fts5("
+                "name, content='articles', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2')"
+            ))
+        except OperationalError as e:
+            logging.warning(f"Article name search is unavailable: {e}")
+            return False
+
+        connection.execute(text(
+            "CREATE TRIGGER articles_fts_insert AFTER INSERT ON articles "
+            "BEGIN INSERT INTO articles_fts(rowid, name) "
+            "VALUES (new.id, new.name); END"
+        ))
+        connection.execute(text(
+            "CREATE TRIGGER articles_fts_delete AFTER DELETE ON articles "
+            "BEGIN INSERT INTO articles_fts(articles_fts, rowid, name) "
+            "VALUES ('delete', old.id, old.name); END"
+        ))
+        connection.execute(text(
+            "CREATE TRIGGER articles_fts_update "
+            "AFTER UPDATE OF name ON articles "
+            "BEGIN INSERT INTO articles_fts(articles_fts, rowid, name) "
+            "VALUES ('delete', old.id, old.name); "
+            "INSERT INTO articles_fts(rowid, name) "
+            "VALUES (new.id, new.name); END"
+        ))
+        # Index the articles written before the table existed
+        connection.execute(text(
+            "INSERT INTO articles_fts(articles_fts) VALUES ('rebuild')"
+        ))
+    logging.info("Created article name index")
+    return True
+
+
 # Init DB
-def init_db(db_path="database/db.sqlite3") -> Session:
+def init_db(db_path=DB_PATH) -> Session:
     logging.info("Initializing DB...")
 
     engine = create_engine(f"sqlite:///{db_path}", echo=False)
+    event.listen(engine, "connect", set_pragmas)
     Base.metadata.create_all(engine)
+    migrate(engine)
+    create_name_index(engine)
     session_maker = sessionmaker(bind=engine)
     Session = session_maker()
     seed_themes(Session)
@@ -0,0 +1,91 @@
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from utils.image_hash import HashIndex, ImageHashes, to_signed, to_unsigned
+
+from .orm import Article, PhotoHash
+from .session import unit_of_work
+
+
+class PostedPhotos:
+    """
+    Hash indexes of posted photos per channel, keyed by the chat as text
+    (Article.posted_channel, str(Channel.chat)) and then by article id.
+
+    Hashes are stored in photo_hashes as soon as an article's photo is
+    known, see save(). The index of a channel is read from the rows of
+    its posted articles once, photos posted afterwards are added to it.
+    """
+
+    def __init__(self):
+        self.indexes: dict[str, HashIndex] = {}
+
+    async def load(self, channel: str) -> HashIndex:
+        if channel in self.indexes:
+            return self.indexes[channel]
+
+        async with unit_of_work(write=False) as session:
+            rows = await session.execute(
+                select(PhotoHash.article_id, PhotoHash.dhash, PhotoHash.phash)
+                .join(Article, Article.id == PhotoHash.article_id)
+                .where(
+                    Article.is_posted == True,  # noqa E712
+                    Article.posted_channel == channel,
+                )
+            )
+        index = HashIndex()
+        for article_id, dhash, phash in rows:
+            index.add(
+                article_id, ImageHashes(to_unsigned(dhash), to_unsigned(phash))
+            )
+        self.indexes[channel] = index
+        return index
+
+    async def stored(
+        self, session: AsyncSession, article_id: int
+    ) -> Optional[ImageHashes]:
+        row = (
+            await session.execute(
+                select(PhotoHash.dhash, PhotoHash.phash)
+                .where(PhotoHash.article_id == article_id)
+            )
+        ).first()
+        if row:
+            return ImageHashes(to_unsigned(row.dhash), to_unsigned(row.phash))
+
+    async def save(
+        self, session: AsyncSession, article_id: int, hashes: ImageHashes
+    ) -> bool:
+        """
+        Store the hashes of an article's photo in a unit of work. Returns
+        False when the article already has them.
+        """
+        result = await session.execute(
+            insert(PhotoHash)
+            .values(
+                article_id=article_id,
+                dhash=to_signed(hashes.dhash),
+                phash=to_signed(hashes.phash),
+            )
+            .on_conflict_do_nothing()
+        )
+        return bool(result.rowcount)
+
+    def add(self, channel: str, article_id: int, hashes: ImageHashes):
+        """Add the hashes of a photo to a loaded index once it's posted."""
+        index = self.indexes.get(channel)
+        if index is not None:
+            index.add(article_id, hashes)
+
+
+_posted: Optional[PostedPhotos] = None
+
+
+def get_posted_photos() -> PostedPhotos:
+    global _posted
+    if _posted is None:
+        _posted = PostedPhotos()
+    return _posted
@@ -0,0 +1,67 @@
+import asyncio
+from contextlib import asynccontextmanager
+from os import getenv
+from typing import AsyncIterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from .orm import DB_PATH, set_pragmas
+
+_engine: Optional[AsyncEngine] = None
+_session_maker: Optional[async_sessionmaker] = None
+_write_lock: Optional[asyncio.Lock] = None
+
+
+def get_engine() -> AsyncEngine:
+    """Return the shared aiosqlite engine, creating it lazily."""
+    global _engine, _session_maker
+    if _engine is None:
+        db_path = getenv("db_path") or DB_PATH
+        _engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        event.listen(_engine.sync_engine, "connect", set_pragmas)
+        # Objects stay usable after the unit of work, e.g. while posting
+        _session_maker = async_sessionmaker(_engine, expire_on_commit=False)
+    return _engine
+
+
+async def close_engine():
+    global _engine
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+
+
+@asynccontextmanager
+async def unit_of_work(write: bool = True) -> AsyncIterator[AsyncSession]:
+    """
+    Open a session that is committed once when the block succeeds and
+    rolled back when it raises.
+
+    SQLite has a single writer, so write units of this process take turns
+    on a lock instead of failing with "database is locked"; read units
+    (write=False) never wait for it thanks to WAL. Keep network calls out
+    of a unit, it should only persist the results of a pipeline stage.
+    """
+    global _write_lock
+    get_engine()
+    if _write_lock is None:
+        _write_lock = asyncio.Lock()
+
+    if not write:
+        async with _session_maker() as session:
+            yield session
+        return
+
+    async with _write_lock, _session_maker() as session:
+        try:
+            yield session
+            await session.commit()
+        except BaseException:
+            await session.rollback()
+            raise
@@ -1,36 +1,99 @@
+from contextlib import aclosing
 from os import getenv
 
+from agents.cache import cache_enabled, get_response_cache
 from agents.dalle import DalleClient
 from agents.gpt import GPTClient
+from utils.http_client import get_session
+
+
+def gpt_client(model, stage=None):
+    return GPTClient(
+        api_key=getenv("api_key"),
+        model=model,
+        session=get_session("openai"),
+        cache=get_response_cache() if cache_enabled(stage) else None,
+        stage=stage or "default",
+    )
 
 
 async def gpt_request(
     prompt,
     model="gpt-4o-mini",
     system_prompt="You are a helpful assistant.",
+    stage=None,
 ):
-    async with GPTClient(api_key=getenv("api_key"), model=model) as client:
+    async with gpt_client(model, stage) as client:
         return await client.send_request(
             prompt,
             system_prompt=system_prompt,
         )
 
 
+async def gpt_stream(
+    prompt,
+    model="gpt-4o-mini",
+    system_prompt="You are a helpful assistant.",
+    stage=None,
+    max_tokens=500,
+    temperature=0.7,
+    validate=None,
+):
+    async with gpt_client(model, stage) as client:
+        async with aclosing(client.stream_request(
+            prompt,
+            system_prompt=system_prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            validate=validate,
+        )) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+
 async def gpt_image(
     prompt,
     image,
     url,
     model="gpt-4o-mini",
+    stage="check_image",
+    validate=None,
 ):
-    async with GPTClient(api_key=getenv("api_key"), model=model) as client:
+    async with gpt_client(model, stage) as client:
         return await client.send_request(
             prompt,
             [(image, url)],
             max_tokens=800,
+            temperature=0,
+            validate=validate,
         )
 
 
-async def gen_image(prompt, model="dall-e-3"):
-    async with DalleClient(api_key=getenv("api_key")) as client:
-        urls = await client.generate_image(prompt, model=model)
-        return urls[0]
+async def gen_image(prompt, model="dall-e-3", response_format="url"):
+    async with DalleClient(
+        api_key=getenv("api_key"),
+        session=get_session("openai"),
+    ) as client:
+        images = await client.generate_image(
+            prompt,
+            model=model,
+            response_format=response_format,
+        )
+        return images[0]
+
+
+async def gpt_images(
+    prompt,
+    images,
+    model="gpt-4o-mini",
+    stage="check_image",
+    validate=None,
+):
+    async with gpt_client(model, stage) as client:
+        return await client.send_request(
+            prompt,
+            images,
+            max_tokens=100 + 10 * len(images),
+            temperature=0,
+            validate=validate,
+        )
@@ -1,63 +1,121 @@
 import logging
+from os import getenv
 
 from agents.prompt import get_prompt
-from database.article import add_article, get_existing_articles
-from database.orm import Hashtag
-from generators.ai import gpt_request
-from generators.config import session
+from database.article import (
+    find_duplicate,
+    get_existing_articles,
+    prompt_names,
+)
+from database.hashtag import get_hashtag_registry
+from database.orm import Article, Idea
+from database.session import unit_of_work
+from generators.ai import gpt_stream
+from generators.channels import Channel
+from generators.ideas import (
+    backlog_enabled,
+    duplicate_threshold,
+    history_size,
+    take_idea,
+)
 from generators.theme import choose_theme
-from telegram.formatter import format_text
-from utils.json_parser import parse_text
+from telegram.formatter import format_stream
+from utils.hashtags import extract_hashtags
+from utils.json_parser import parse_json_stream
 
+# Names asked from GPT before giving up on near-duplicates
+NAME_ATTEMPTS = 3
 
-async def create_new_article(day_time):
-    theme = choose_theme(day_time)
+
+async def create_new_article(
+    day_time, channel: Channel
+) -> tuple[Article, Idea | None] | None:
+    """
+    Take a recipe from the idea backlog or ask GPT for one. The article
+    isn't saved yet, it's added by the unit of work that marks it ready.
+    Returned with the idea it's made from, to put back if preparing fails.
+    """
+    async with unit_of_work(write=False) as session:
+        theme = await choose_theme(
+            session, day_time, probabilities=channel.themes
+        )
     logging.info(f"Chosen theme: {theme.name}")
 
-    existing_themes = get_existing_articles(session, maximum=200)
+    if backlog_enabled():
+        idea = await take_idea(channel, theme.name)
+        if idea:
+            return Article(
+                name=idea.name,
+                level=idea.level,
+                theme=idea.theme,
+                time=idea.time,
+                day_time=day_time,
+                channel=channel.name,
+                is_posted=False,
+            ), idea
+        logging.info("No %s ideas for %s, asking for one", theme.name, channel)
 
-    choose_prompt = get_prompt(
-        "choose_theme",
-        theme=theme.name,
-        existingThemes=existing_themes,
-        format=get_prompt("choose_theme_format"),
-    )
+    async with unit_of_work(write=False) as session:
+        existing_themes = await get_existing_articles(
+            session,
+            maximum=history_size(),
+            with_ready=True,
+            channel=channel.name,
+        )
+    threshold = duplicate_threshold()
 
-    response = await gpt_request(choose_prompt, "gpt-4o")
-    article_dict = parse_text(response, {})
+    rejected = []
+    for _ in range(NAME_ATTEMPTS):
+        choose_prompt = get_prompt(
+            "choose_theme",
+            theme=theme.name,
+            existingThemes=prompt_names(existing_themes, *rejected),
+        )
 
-    if article_dict:
-        article = add_article(
-            session,
-            name=article_dict["name"],
-            level=int(article_dict["level"]),
-            theme=article_dict["theme"],
-            time=int(article_dict["time"]),
+        article_dict = await parse_json_stream(
+            gpt_stream(choose_prompt, "gpt-4o", stage="choose_theme"), {}
         )
-        return article
+        if not article_dict:
+            return
 
-    return
+        async with unit_of_work(write=False) as session:
+            duplicate = await find_duplicate(
+                session, article_dict["name"], channel.name, threshold
+            )
+        if not duplicate:
+            break
+        logging.info(
+            "Rejected %r, too close to %r", article_dict["name"], duplicate
+        )
+        rejected.append(article_dict["name"])
+    else:
+        return
+
+    return Article(
+        name=article_dict["name"],
+        level=int(article_dict["level"]),
+        theme=article_dict["theme"],
+        time=int(article_dict["time"]),
+        day_time=day_time,
+        channel=channel.name,
+        is_posted=False,
+    ), None
 
 
-async def generate_post(theme):
-    hashtags = session.query(Hashtag).all()
-    hashtag_names = [hashtag.name for hashtag in hashtags]
+async def generate_post(theme, channel: Channel) -> tuple[str, list[str]]:
+    """Write the post text, return it with the hashtags it uses."""
+    registry = get_hashtag_registry()
+    await registry.load(channel.name)
+    hashtag_names = registry.top(
+        channel.name, theme, int(getenv("hashtag_prompt_size") or 30)
+    )
 
     article_text_prompt = get_prompt(
         "write_post",
         theme=theme,
         hashtags="\n".join(hashtag_names),
-        format=get_prompt("post_format"),
     )
-    response = await gpt_request(article_text_prompt, "gpt-4o")
-
-    formatted = format_text(response)
-
-    for word in formatted.split():
-        if word.startswith("#"):
-            if not word[1:] in hashtag_names:
-                hashtag = Hashtag(name=word[1:])
-                session.add(hashtag)
-    session.commit()
-
-    return formatted
+    formatted = await format_stream(
+        gpt_stream(article_text_prompt, "gpt-4o", stage="write_post")
+    )
+    return formatted.html, extract_hashtags(formatted.html)
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+from datetime import datetime
+from functools import partial
+from os import getenv
+from pathlib import Path
+from typing import Callable
+from uuid import uuid4
+
+from agents.prompt import get_prompt
+from database.article import claim_ready_article, get_ready_articles
+from database.hashtag import get_hashtag_registry
+from database.orm import Article
+from database.photo_hash import get_posted_photos
+from database.session import unit_of_work
+from generators.ai import gen_image
+from generators.article import create_new_article, generate_post
+from generators.channels import Channel
+from generators.images import photo_hashes
+from generators.ideas import backlog_enabled, refill_ideas, return_idea
+from utils.check_image import save_b64_image, save_image, stream_image
+
+ARTICLE_IMAGES = Path("cache/articles")
+
+_refill_latency: dict[tuple[str, str], float] = {}
+_generation_limit: asyncio.Semaphore | None = None
+
+
+def buffer_size() -> int:
+    return int(getenv("buffer_size") or 2)
+
+
+def generation_limit() -> asyncio.Semaphore:
+    """Shared limit of articles refilled at once across all channels."""
+    global _generation_limit
+    if _generation_limit is None:
+        _generation_limit = asyncio.Semaphore(
+            int(getenv("generation_limit") or 2)
+        )
+    return _generation_limit
+
+
+async def prepare_article(
+    channel: Channel,
+    day_time="any",
+    slot: bool = False,
+) -> Article | None:
+    """
+    Generate text and image of a new article and mark it ready, or for a
+    slot as already taken (see take_ready_article).
+
+    Buffer refills take turns on generation_limit(); an article needed
+    for a slot right now (`slot`) doesn't wait behind them.
+    """
+    if slot:
+        return await _prepare_article(channel, day_time, slot)
+    async with generation_limit():
+        return await _prepare_article(channel, day_time, slot)
+
+
+async def _prepare_article(channel: Channel, day_time: str, slot: bool):
+    start_time = datetime.now()
+
+    created = await create_new_article(day_time, channel)
+    if not created:
+        logging.error("Failed to create article for %s", channel)
+        return
+    article, idea = created
+
+    try:
+        article.text, hashtags = await generate_post(article.name, channel)
+
+        await attach_image(article, slot)
+        # Hashed ahead for the posted photos index, unless it's posted now
+        hashes = None if slot else await photo_hashes(article)
+
+        # An article for a slot is saved claimed, it's posted right away
+        article.is_ready = not slot
+        article.ready_time = datetime.now()
+        registry = get_hashtag_registry()
+        # The whole preparation is saved at once, a failed one leaves no rows
+        async with unit_of_work() as session:
+            session.add(article)
+            await registry.save_usage(
+                session, hashtags, channel.name, article.ready_time
+            )
+            if hashes:
+                await session.flush()
+                await get_posted_photos().save(session, article.id, hashes)
+    except Exception:
+        if idea:
+            await return_idea(idea)
+        raise
+    registry.count_usage(hashtags, channel.name, article.ready_time)
+
+    elapsed = (datetime.now() - start_time).total_seconds()
+    _refill_latency[channel.name, day_time] = elapsed
+    logging.info("Article ready in %s", elapsed)
+    return article
+
+
+async def attach_image(article: Article, slot: bool = False):
+    """
+    Generate the article image and store it according to image_transport.
+
+    "file" (default) streams the image to ARTICLE_IMAGES, "stream" keeps
+    only the URL and pipes it to Telegram at posting time. DALL-E URLs
+    expire after a while, so only an article posted right away (`slot`)
+    is streamed, buffered ones always get a file. Images returned as
+    b64_json (dalle_format) are always decoded to a file.
+    """
+    image_format = getenv("dalle_format") or "url"
+    prompt = get_prompt("gen_image", text=article.text)
+    image = await gen_image(prompt, response_format=image_format)
+    if not image:
+        return
+
+    path = ARTICLE_IMAGES / f"{uuid4().hex}.jpg"
+    try:
+        if image_format == "b64_json":
+            await asyncio.to_thread(save_b64_image, image, path)
+            article.photo_path = str(path)
+            return
+
+        article.photo = image
+        if not slot or (getenv("image_transport") or "file") == "file":
+            await save_image(image, path)
+            article.photo_path = str(path)
+    except Exception as e:
+        logging.warning(e)
+
+
+def article_image(article: Article) -> Path | Callable | None:
+    """Return the local image file, or a factory streaming the image URL."""
+    if article.photo_path and Path(article.photo_path).exists():
+        return Path(article.photo_path)
+    if article.photo:
+        return partial(stream_image, article.photo)
+
+
+async def take_ready_article(
+    channel: Channel,
+    day_time: str,
+) -> Article | None:
+    """
+    Claim the oldest ready article, see claim_ready_article. One that
+    fails to post goes back to the buffer in send_article.
+    """
+    async with unit_of_work() as session:
+        return await claim_ready_article(session, day_time, channel.name)
+
+
+async def get_buffer_stats(channel: Channel, day_times) -> dict:
+    """Return depth, oldest age in seconds and last refill latency."""
+    now = datetime.now()
+    stats = {}
+    for day_time in day_times:
+        async with unit_of_work(write=False) as session:
+            articles = await get_ready_articles(
+                session, day_time, channel.name
+            )
+        ages = [
+            (now - article.ready_time.replace(tzinfo=None)).total_seconds()
+            for article in articles
+            if article.ready_time
+        ]
+        stats[day_time] = {
+            "depth": len(articles),
+            "oldest_age": max(ages, default=0),
+            "refill_latency": _refill_latency.get((channel.name, day_time)),
+        }
+    return stats
+
+
+async def refill(channel: Channel, day_time: str):
+    while True:
+        async with unit_of_work(write=False) as session:
+            articles = await get_ready_articles(
+                session, day_time, channel.name
+            )
+        if len(articles) >= buffer_size():
+            break
+        if not await prepare_article(channel, day_time):
+            break
+
+
+async def producer(channel: Channel, day_times, interval: float = 60):
+    """Keep buffer_size() ready articles of a channel for every day time."""
+    while True:
+        if backlog_enabled():
+            try:
+                await refill_ideas(channel)
+            except Exception as e:
+                logging.exception("Failed to refill %s ideas: %s", channel, e)
+        for day_time in day_times:
+            try:
+                await refill(channel, day_time)
+            except Exception as e:
+                logging.exception(
+                    "Failed to refill %s %s buffer: %s", channel, day_time, e
+                )
+        logging.info(
+            "Article buffer of %s: %s",
+            channel,
+            await get_buffer_stats(channel, day_times),
+        )
+        await asyncio.sleep(interval)
@@ -0,0 +1,106 @@
+import json
+import logging
+from os import getenv
+from pathlib import Path
+
+from database.orm import DEFAULT_CHANNEL
+from utils.cron import Cron
+
+
+class Channel:
+    """
+    Posting target with its own schedule, themes, signature and bot token.
+
+    :param name: Key that scopes articles and hashtags in the database.
+    :param chat: Telegram chat username or ID.
+    :param token: Telegram bot token.
+    :param article_end: Signature appended to every post.
+    :param slots: List of (day_time, Cron) pairs.
+    :param themes: Theme probabilities overriding the themes table.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        chat: str | int,
+        token: str,
+        article_end: str = "",
+        slots: list[tuple[str, Cron]] | None = None,
+        themes: dict[str, int] | None = None,
+    ):
+        self.name = name
+        # Stored as text: Article.posted_channel and the photo index key
+        # channels by it
+        self.chat = str(chat)
+        self.token = token
+        self.article_end = article_end
+        self.slots = slots or []
+        self.themes = themes or {}
+
+    def __repr__(self):
+        return f"Channel({self.name!r})"
+
+
+def parse_slots(definition: str) -> list[tuple[str, Cron]]:
+    """Parse "breakfast=30 8 * * *;dinner=0 19 * * 1-5" into slots."""
+    slots = []
+    for item in definition.split(";"):
+        if item.strip():
+            day_time, expression = item.split("=", 1)
+            slots.append((day_time.strip(), Cron(expression)))
+    return slots
+
+
+def env_slots() -> list[tuple[str, Cron]]:
+    if getenv("slots"):
+        return parse_slots(getenv("slots"))
+
+    return [
+        (day_time, Cron(f"0 {getenv(day_time)} * * *"))
+        for day_time in ["breakfast", "launch", "dinner"]
+        if getenv(day_time)
+    ]
+
+
+def load_channels() -> list[Channel]:
+    """
+    Load channels from the JSON file in `channels_file` (channels.json).
+
+    Without the file a single channel is built from the `channel`,
+    `token`, `article_end` and schedule env variables.
+    """
+    path = Path(getenv("channels_file") or "channels.json")
+    if not path.exists():
+        return [
+            Channel(
+                DEFAULT_CHANNEL,
+                getenv("channel"),
+                getenv("token"),
+                (getenv("article_end") or "").replace("\\n", "\n"),
+                env_slots(),
+            )
+        ]
+
+    with open(path, encoding="utf-8") as file:
+        data = json.load(file)
+
+    channels = [
+        Channel(
+            item["name"],
+            item["chat"],
+            item.get("token") or getenv("token"),
+            item.get("article_end", ""),
+            [
+                (day_time, Cron(expression))
+                for day_time, expressions in item["slots"].items()
+                for expression in (
+                    [expressions] if isinstance(expressions, str)
+                    else expressions
+                )
+            ],
+            item.get("themes"),
+        )
+        for item in data
+    ]
+    logging.info("Loaded channels: %s", channels)
+    return channels
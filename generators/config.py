@@ -1,11 +1,16 @@
 import logging
+from os import getenv
 from sys import stdout
 
 from dotenv import load_dotenv
 
-from database.orm import Session, init_db
+from agents.prompt import get_registry
+from database.orm import DB_PATH, init_db
 
 logging.basicConfig(level=logging.DEBUG, stream=stdout)
 load_dotenv()
 
-session: Session = init_db()
+# Create and migrate the schema, the app itself uses database.session
+init_db(getenv("db_path") or DB_PATH).close()
+# Load prompts at startup so broken templates fail fast
+get_registry()
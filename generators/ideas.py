@@ -0,0 +1,200 @@
+import asyncio
+import logging
+from os import getenv
+
+from agents.limiter import PRIORITY_BACKGROUND, openai_priority
+from agents.prompt import get_prompt
+from database.article import (
+    find_duplicate,
+    get_existing_articles,
+    name_similarity,
+    prompt_names,
+)
+from database.idea import (
+    add_ideas,
+    count_ideas,
+    get_idea_names,
+    pop_idea,
+    restore_idea,
+)
+from database.orm import Idea
+from database.session import unit_of_work
+from generators.ai import gpt_stream
+from generators.channels import Channel
+from utils.json_parser import parse_json_stream
+
+# Fields of choose_theme_format and their types
+IDEA_FIELDS = {"name": str, "level": int, "theme": str, "time": int}
+
+# Running background refills by (channel, section)
+_refills: dict[tuple[str, str], asyncio.Task] = {}
+# Sections being refilled by any caller, see refill_ideas
+_refilling: set[tuple[str, str]] = set()
+
+
+def backlog_enabled() -> bool:
+    return (getenv("idea_backlog") or "1") == "1"
+
+
+def idea_batch_size() -> int:
+    return int(getenv("idea_batch_size") or 10)
+
+
+def idea_backlog_min() -> int:
+    return int(getenv("idea_backlog_min") or 3)
+
+
+def history_size() -> int:
+    return int(getenv("history_size") or 200)
+
+
+def duplicate_threshold() -> float:
+    return float(getenv("duplicate_threshold") or 0.75)
+
+
+def validate_idea(item) -> dict | None:
+    """Return an idea matching choose_theme_format, or None."""
+    if not isinstance(item, dict):
+        return None
+    try:
+        idea = {
+            field: kind(item[field]) for field, kind in IDEA_FIELDS.items()
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    idea["name"] = idea["name"].strip()
+    if not idea["name"] or not 1 <= idea["level"] <= 5 or idea["time"] <= 0:
+        return None
+    return idea
+
+
+async def generate_ideas(channel: Channel, section: str, count: int) -> int:
+    """
+    Ask GPT for `count` ideas of a section in one request and add those
+    that aren't close to a posted article, a waiting idea or each other.
+    """
+    async with unit_of_work(write=False) as session:
+        history = await get_existing_articles(
+            session,
+            maximum=history_size(),
+            with_ready=True,
+            channel=channel.name,
+        )
+        waiting = await get_idea_names(session, channel.name)
+
+    prompt = get_prompt(
+        "choose_themes",
+        theme=section,
+        existingThemes=prompt_names(history, *waiting),
+        count=count,
+    )
+    items = await parse_json_stream(
+        gpt_stream(
+            prompt,
+            "gpt-4o",
+            stage="choose_themes",
+            max_tokens=100 + 60 * count,
+        ),
+        [],
+    )
+    if not isinstance(items, list):
+        items = []
+
+    threshold = duplicate_threshold()
+    accepted = []
+    async with unit_of_work(write=False) as session:
+        for item in items:
+            idea = validate_idea(item)
+            if not idea:
+                logging.warning("Skipping malformed idea %.200r", item)
+                continue
+
+            known = waiting + [other["name"] for other in accepted]
+            if any(
+                name_similarity(idea["name"], name) >= threshold
+                for name in known
+            ) or await find_duplicate(
+                session, idea["name"], channel.name, threshold
+            ):
+                logging.debug("Skipping duplicate idea %r", idea["name"])
+                continue
+            accepted.append(idea)
+
+    async with unit_of_work() as session:
+        await add_ideas(session, channel.name, section, accepted)
+    logging.info(
+        "Added %s of %s %s ideas for %s",
+        len(accepted),
+        len(items),
+        section,
+        channel,
+    )
+    return len(accepted)
+
+
+async def refill_ideas(channel: Channel, sections=None):
+    """
+    Refill sections whose backlog is below idea_backlog_min(), by default
+    those that have one. A section is only refilled by one caller at a
+    time, the others skip it. Sections get their first ideas when one is
+    taken from them, see take_idea.
+    """
+    async with unit_of_work(write=False) as session:
+        counts = await count_ideas(session, channel.name)
+    if sections is None:
+        sections = list(counts)
+
+    for section in sections:
+        key = (channel.name, section)
+        if counts.get(section, 0) >= idea_backlog_min() or key in _refilling:
+            continue
+        _refilling.add(key)
+        try:
+            await generate_ideas(channel, section, idea_batch_size())
+        finally:
+            _refilling.discard(key)
+
+
+async def _refill_section(channel: Channel, section: str):
+    openai_priority.set(PRIORITY_BACKGROUND)
+    try:
+        await refill_ideas(channel, [section])
+    except Exception as e:
+        logging.exception("Failed to refill %s ideas: %s", section, e)
+
+
+def schedule_refill(channel: Channel, section: str):
+    """Refill a section in the background unless it's already running."""
+    key = (channel.name, section)
+    task = _refills.get(key)
+    if task is None or task.done():
+        _refills[key] = asyncio.create_task(_refill_section(channel, section))
+
+
+async def take_idea(channel: Channel, section: str) -> Idea | None:
+    """
+    Pop the oldest idea of a section that is still unique. Ideas that
+    became duplicates of articles posted since are dropped.
+    """
+    threshold = duplicate_threshold()
+    async with unit_of_work() as session:
+        while idea := await pop_idea(session, channel.name, section):
+            duplicate = await find_duplicate(
+                session, idea.name, channel.name, threshold
+            )
+            if not duplicate:
+                break
+            logging.info("Dropped idea %r, close to %r", idea.name, duplicate)
+        remaining = (await count_ideas(session, channel.name)).get(section, 0)
+
+    if remaining < idea_backlog_min():
+        schedule_refill(channel, section)
+    return idea
+
+
+async def return_idea(idea: Idea):
+    """Put back the idea of an article that failed to be prepared."""
+    async with unit_of_work() as session:
+        await restore_idea(session, idea)
+    logging.info("Returned idea %r to the %s backlog", idea.name, idea.section)
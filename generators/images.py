@@ -1,73 +1,328 @@
+import asyncio
 import json
 import logging
+import math
+from functools import partial
+from os import getenv
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import exists, select
 
 from agents.prompt import get_prompt
-from generators.ai import gpt_image, gpt_request
-from utils.check_image import download_image, resize_image
+from database.orm import Article, PhotoHash
+from database.photo_hash import get_posted_photos
+from database.session import unit_of_work
+from generators.ai import gpt_image, gpt_images, gpt_stream
+from generators.channels import Channel
+from telegram.poster import TelegramClient
+from utils.check_image import download_image
+from utils.concurrency import map_limited
 from utils.html_parser import get_image_size, get_images_by_url
-from utils.json_parser import parse_text
+from utils.image_hash import (
+    ImageHashes,
+    group_duplicates,
+    hash_distance,
+    image_hashes,
+)
+from utils.json_parser import parse_json_stream, parse_text
+from utils.thumbnail import image_tokens, run_in_pool, thumbnail
+
+
+# Bounds of the images of one vision request: base64 bytes and tokens
+BATCH_PAYLOAD = 4 * 1024 * 1024
+BATCH_TOKENS = 8000
+
+
+def chunk_images(
+    images,
+    batch_size,
+    max_bytes=BATCH_PAYLOAD,
+    max_tokens=BATCH_TOKENS,
+):
+    """
+    Split (image, url) pairs into batches bounded by count, size of the
+    base64-encoded images and their input tokens.
+    """
+    batch = []
+    batch_bytes = 0
+    batch_tokens = 0
+    for image in images:
+        size = 4 * math.ceil(len(image[0]) / 3)
+        tokens = image_tokens(image[0])
+        if batch and (
+            len(batch) >= batch_size
+            or batch_bytes + size > max_bytes
+            or batch_tokens + tokens > max_tokens
+        ):
+            yield batch
+            batch = []
+            batch_bytes = 0
+            batch_tokens = 0
+        batch.append(image)
+        batch_bytes += size
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def parse_scores(response, count):
+    scores = parse_text(response, None)
+    if (
+        not isinstance(scores, list)
+        or len(scores) != count
+        or not all(isinstance(score, (int, float)) for score in scores)
+    ):
+        return
+    return scores
+
+
+def is_score(response):
+    return isinstance(parse_text(response), (int, float))
+
+
+async def score_images(theme, text, images):
+    """
+    Score a batch of (image, url) pairs in one request. Returns the
+    (score, url) pairs and the images left to score one by one because
+    the answer was malformed. A failed request scores nothing.
+    """
+    check_images_prompt = get_prompt(
+        "check_images",
+        theme=theme,
+        recipe=text,
+        count=len(images),
+    )
+    response = await gpt_images(
+        check_images_prompt,
+        images,
+        validate=lambda answer: parse_scores(answer, len(images)) is not None,
+    )
+    if not response:
+        logging.warning("Scoring failed, skipping %s images", len(images))
+        return [], []
+
+    scores = parse_scores(response, len(images))
+    if scores is None:
+        logging.warning("Malformed batch scores, scoring images one by one")
+        return [], images
+    return list(zip(scores, (image[1] for image in images))), []
 
 
-async def find_best_image(theme, text, image_links):
+async def score_image(theme, text, image):
     check_image_prompt = get_prompt(
         "check_image",
         theme=theme,
         recipe=text,
     )
-    images = []
+    response = await gpt_image(
+        check_image_prompt, *image, validate=is_score
+    )
+    if response:
+        return parse_text(response, 0), image[1]
+
+
+def dedup_enabled() -> bool:
+    return (getenv("image_dedup") or "1") == "1"
+
+
+async def dedup_candidates(prepared, all_hashes, channel: Channel):
+    """
+    Drop candidates that were already posted to the channel and collapse
+    near-duplicate copies of a photo. Takes (thumbnail, url) pairs with
+    their hashes, returns the first pair of every photo and the urls of
+    all its copies.
+    """
+    distance = hash_distance()
+    posted = await get_posted_photos().load(str(channel.chat))
+    fresh = []
+    for image, hashes in zip(prepared, all_hashes):
+        article_id = hashes and posted.find(hashes, distance)
+        if article_id:
+            logging.info("%s was posted with article %s", image[1], article_id)
+        else:
+            fresh.append((image, hashes))
+
+    groups = group_duplicates([item[1] for item in fresh], distance)
+    unique = [fresh[group[0]][0] for group in groups]
+    copies = {
+        fresh[group[0]][0][1]: [fresh[index][0][1] for index in group]
+        for group in groups
+    }
+    logging.info("%s of %s candidates are unique", len(unique), len(prepared))
+    return unique, copies
+
+
+async def _hashes(image: bytes, image_link: str) -> Optional[ImageHashes]:
+    try:
+        return await run_in_pool(image_hashes, image)
+    except Exception as e:
+        logging.warning("Can't hash %s: %s", image_link, e)
+
+
+async def find_best_image(theme, text, image_links, channel: Channel):
     logging.info(image_links)
+    dedup = dedup_enabled()
+
+    async def prepare(image_link):
+        downloaded = await download_image(image_link)
+        # Hashes come from the full image, thumbnails lose too much
+        hashes = await _hashes(downloaded, image_link) if dedup else None
+        return await thumbnail(downloaded), image_link, hashes
 
-    for image_link in image_links:
-        try:
-            downloaded = await download_image(image_link)
-            resized = resize_image(downloaded)
+    prepared = [
+        image
+        for image in await map_limited(prepare, image_links, "probe")
+        if image
+    ]
+    all_hashes = [image[2] for image in prepared]
+    prepared = [image[:2] for image in prepared]
+    copies = {image_link: [image_link] for _, image_link in prepared}
+    if dedup:
+        prepared, copies = await dedup_candidates(
+            prepared, all_hashes, channel
+        )
 
-            response = await gpt_image(check_image_prompt, resized, image_link)
-            image_percentage = parse_text(response, 0)
-            images.append((image_percentage, image_link))
-        except Exception as e:
-            logging.warning(e)
+    batch_size = int(getenv("image_batch_size") or 8)
+    batches = chunk_images(prepared, max(batch_size, 1))
+    scored = await map_limited(
+        partial(score_images, theme, text), batches, "score"
+    )
+    images = [image for batch in scored if batch for image in batch[0]]
 
+    # Out of the batch's timeout, with a limit and timeout of their own
+    unscored = [image for batch in scored if batch for image in batch[1]]
+    if unscored:
+        images += await map_limited(
+            partial(score_image, theme, text), unscored, "score_image"
+        )
+    images = [image for image in images if image]
     logging.info(images)
+    if not images:
+        return
 
     max_value = max(images, key=lambda x: x[0])[0]
-    images_with_max = [image[1] for image in images if image[0] == max_value]
+    # Every copy of the best photos competes on size
+    images_with_max = [
+        copy
+        for image in images
+        if image[0] == max_value
+        for copy in copies.get(image[1], [image[1]])
+    ]
     logging.info(images_with_max)
 
     max_size = 0
     post_image = None
 
-    for image in images_with_max:
-        size = await get_image_size(image)
-        if size >= max_size:
+    sizes = await map_limited(get_image_size, images_with_max, "probe")
+    for image, size in zip(images_with_max, sizes):
+        if size is not None and size >= max_size:
             max_size = size
             post_image = image
 
     return post_image
 
 
-async def get_image(theme, text, links):
-    links = [link.link for link in links]
-    image_links = []
+async def photo_hashes(article: Article) -> Optional[ImageHashes]:
+    """Hashes of the photo file of an article being prepared."""
+    if article.photo_path and Path(article.photo_path).exists():
+        image = await asyncio.to_thread(Path(article.photo_path).read_bytes)
+        return await _hashes(image, article.photo_path)
+
 
-    for link in links:
-        url_images = await get_images_by_url(link)
+async def remember_photo(article: Article, token: Optional[str] = None):
+    """
+    Add the photo of a posted article to the posted photos index. Hashes
+    stored while preparing the article are used as they are, otherwise
+    the photo is read from its file, from Telegram when the bot token is
+    given, or from its source URL.
+    """
+    posted = get_posted_photos()
+    async with unit_of_work(write=False) as session:
+        hashes = await posted.stored(session, article.id)
 
-        if url_images:
-            image_prompt = get_prompt(
-                "valid_images",
-                theme=theme,
-                images=json.dumps(url_images),
-                max_images=min(4, len(url_images)),
+    if hashes is None:
+        if article.photo_path and Path(article.photo_path).exists():
+            image = await asyncio.to_thread(
+                Path(article.photo_path).read_bytes
             )
+        elif article.posted_photo and token:
+            image = await TelegramClient(token).get_file(article.posted_photo)
+        elif article.photo:
+            image = await download_image(article.photo, cache=False)
+        else:
+            return False
+
+        hashes = await run_in_pool(image_hashes, image)
+        async with unit_of_work() as session:
+            if not await posted.save(session, article.id, hashes):
+                # Remembered by another caller meanwhile
+                return False
+
+    posted.add(str(article.posted_channel), article.id, hashes)
+    return True
+
+
+async def backfill_photo_hashes(channels: list[Channel]):
+    """Index the photos of articles posted before the index existed."""
+    tokens = {str(channel.chat): channel.token for channel in channels}
+    async with unit_of_work(write=False) as session:
+        articles = list(await session.scalars(
+            select(Article).where(
+                Article.is_posted == True,  # noqa E712
+                ~exists().where(PhotoHash.article_id == Article.id),
+            )
+        ))
+
+    async def remember(article):
+        return await remember_photo(
+            article, tokens.get(str(article.posted_channel))
+        )
+
+    remembered = await map_limited(remember, articles, "probe")
+    logging.info(
+        "Indexed photos of %s of %s posted articles",
+        sum(1 for result in remembered if result),
+        len(articles),
+    )
+
+
+async def get_valid_images(theme, link):
+    url_images = await get_images_by_url(link)
+    if not url_images:
+        return []
+
+    image_prompt = get_prompt(
+        "valid_images",
+        theme=theme,
+        images=json.dumps(url_images),
+        max_images=min(4, len(url_images)),
+    )
+
+    return await parse_json_stream(
+        gpt_stream(
+            image_prompt,
+            stage="valid_images",
+            temperature=0,
+            validate=lambda answer: isinstance(parse_text(answer), list),
+        ),
+        [],
+    )
+
+
+async def get_image(theme, text, links, channel: Channel):
+    links = [link.link for link in links]
+    image_links = []
 
-            response = await gpt_request(image_prompt)
-            image_links.extend(parse_text(response, []))
+    valid_images = partial(get_valid_images, theme)
+    for link_images in await map_limited(valid_images, links, "links"):
+        if link_images:
+            image_links.extend(link_images)
 
     if not image_links:
         return
 
-    image = await find_best_image(theme, text, image_links)
+    image = await find_best_image(theme, text, image_links, channel)
     logging.info(image)
 
     return image
@@ -1,7 +1,6 @@
-from config import session
-
 from agents.prompt import get_prompt
 from database.orm import Link
+from database.session import unit_of_work
 from generators.ai import gpt_request
 from utils.json_parser import parse_text
 
@@ -18,5 +17,7 @@ async def add_article_links(article):
 
     links = parse_text(response, [])
 
-    for link in links:
-        session.add(Link(article_id=article.id, link=link))
+    async with unit_of_work() as session:
+        session.add_all(
+            [Link(article_id=article.id, link=link) for link in links]
+        )
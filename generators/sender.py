@@ -1,59 +1,69 @@
 import asyncio
 import logging
 from datetime import datetime
-from os import getenv
+from pathlib import Path
 
-from agents.prompt import get_prompt
-from generators.ai import gen_image
-from generators.article import create_new_article, generate_post
-from generators.config import session
+from agents.cache import get_cache_stats
+from agents.limiter import PRIORITY_SLOT, openai_priority
+from database.session import unit_of_work
+from generators.buffer import (
+    prepare_article,
+    article_image,
+    take_ready_article,
+)
+from generators.channels import Channel
+from generators.images import remember_photo
 from telegram.poster import post_and_database
-from utils.check_image import download_image
-from utils.file_handler import write_to_articles
+from utils.file_handler import export_article
 
 
-async def send_article(post_time: datetime, day_time="any"):
-    start_time = datetime.now()
-
-    article = await create_new_article(day_time)
+async def send_article(
+    post_time: datetime,
+    channel: Channel,
+    day_time="any",
+):
+    article = await take_ready_article(channel, day_time)
     if not article:
-        logging.error("Failed to create article")
-        return
-
-    article.text = await generate_post(article.name)
-
-    prompt = get_prompt("gen_image", text=article.text)
-    image = await gen_image(prompt)
+        logging.info(
+            "No buffered %s article for %s, generating now",
+            day_time,
+            channel,
+        )
+        # Generation on the slot path goes ahead of buffer refills
+        openai_priority.set(PRIORITY_SLOT)
+        article = await prepare_article(channel, day_time, slot=True)
+        if not article:
+            return
 
-    if image:
-        article.photo = image
-    session.commit()
+    text = article.text + channel.article_end
+    image = article_image(article)
 
-    text = article.text + getenv("article_end").replace("\\n", "\n")
-    image = article.photo
-
-    image_bytes = None
-    if image:
-        try:
-            image_bytes = await download_image(image)
-        except Exception as e:
-            logging.warning(e)
-
-    logging.info(
-        "Article ready in %s",
-        (datetime.now() - start_time).total_seconds(),
-    )
     if datetime.now() < post_time:
         await asyncio.sleep((post_time - datetime.now()).total_seconds())
 
-    await post_and_database(
-        article,
-        getenv("channel"),
-        getenv("token"),
-        text,
-        image_bytes,
-    )
-    session.commit()
+    try:
+        await post_and_database(
+            article,
+            channel.chat,
+            channel.token,
+            text,
+            image,
+        )
+    finally:
+        if not article.is_posted:
+            # Back to the buffer for the next slot, also when posting raised
+            article.is_ready = True
+        async with unit_of_work() as session:
+            # The article was loaded in another unit, copy it into this one
+            await session.merge(article)
     logging.info("Article sent")
+    logging.info("LLM cache: %s", get_cache_stats())
 
-    write_to_articles()
+    if article.is_posted:
+        try:
+            await remember_photo(article, channel.token)
+        except Exception as e:
+            logging.warning("Can't remember the posted photo: %s", e)
+        if article.photo_path:
+            Path(article.photo_path).unlink(missing_ok=True)
+        await export_article(article)
@@ -1,75 +1,171 @@
 import asyncio
+import heapq
 import logging
 from datetime import datetime, timedelta
 from os import getenv
 from sys import argv
 
+from sqlalchemy import select
+
+from database.orm import SlotRun
+from database.session import unit_of_work
+from generators.buffer import producer
+from generators.channels import Channel, load_channels
+from generators.images import backfill_photo_hashes
 from generators.sender import send_article
+from utils.cron import Cron
+from utils.file_handler import rebuild_export
+
+# Slots are woken up this long before posting to pick or prepare an article
+PREPARE_LEAD = timedelta(minutes=5)
+# Upper bound of a single sleep so wall-clock jumps are noticed quickly
+MAX_SLEEP = 60
+
+# Keeps references to background tasks so they are not garbage collected
+background_tasks = set()
+
+
+class Slot:
+    def __init__(self, channel: Channel, day_time: str, cron: Cron):
+        self.channel = channel
+        self.day_time = day_time
+        self.cron = cron
+
+    @property
+    def key(self) -> str:
+        return f"{self.channel.name}:{self.day_time}@{self.cron.expression}"
+
+    def __repr__(self):
+        return f"Slot({self.key!r})"
+
+
+def apply_catch_up(missed: list[datetime]) -> list[datetime]:
+    """Choose which missed runs to post according to `catch_up`."""
+    policy = getenv("catch_up") or "compress"
+    if policy == "skip":
+        return []
+    if policy == "compress":
+        return missed[-1:]
+    return missed
+
+
+async def get_missed_runs(slot: Slot, now: datetime) -> list[datetime]:
+    async with unit_of_work(write=False) as session:
+        state = await session.scalar(
+            select(SlotRun).where(SlotRun.slot == slot.key)
+        )
+    if not state:
+        await record_run(slot, now)
+        return []
+
+    window = timedelta(hours=float(getenv("catch_up_window") or 12))
+    return slot.cron.between(max(state.last_run, now - window), now)
+
+
+async def record_run(slot: Slot, moment: datetime):
+    async with unit_of_work() as session:
+        state = await session.scalar(
+            select(SlotRun).where(SlotRun.slot == slot.key)
+        )
+        if state:
+            state.last_run = max(state.last_run, moment)
+        else:
+            session.add(SlotRun(slot=slot.key, last_run=moment))
+
+
+async def run_slot(slot: Slot, moments: list[datetime]):
+    for moment in moments:
+        try:
+            await send_article(moment, slot.channel, slot.day_time)
+        except Exception as e:
+            logging.exception("Failed to post %s at %s: %s", slot, moment, e)
+        await record_run(slot, moment)
+
+
+def start_slot(slot: Slot, moments: list[datetime]):
+    if not moments:
+        return
+    logging.info("Running %s for %s", slot, moments)
+    task = asyncio.create_task(run_slot(slot, moments))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def run_schedule(slots: list[Slot]):
+    """
+    Post every slot on time using a heap ordered by the next run.
+
+    Sleeps in short steps against the wall clock, so a clock jump or a
+    suspended machine is handled like downtime: runs that are late by
+    more than PREPARE_LEAD go through the catch-up policy.
+    """
+    now = datetime.now()
+    heap = []
+    for index, slot in enumerate(slots):
+        missed = await get_missed_runs(slot, now)
+        start_slot(slot, apply_catch_up(missed))
+        heapq.heappush(heap, (slot.cron.next_after(now), index, slot))
+
+    while heap:
+        target, index, slot = heap[0]
+        now = datetime.now()
+        wake_time = target - PREPARE_LEAD
+        if now < wake_time:
+            await asyncio.sleep(
+                min((wake_time - now).total_seconds(), MAX_SLEEP)
+            )
+            continue
 
+        heapq.heappop(heap)
+        if now <= target + PREPARE_LEAD:
+            start_slot(slot, [target])
+            next_run = slot.cron.next_after(target)
+        else:
+            missed = [target] + slot.cron.between(target, now)
+            start_slot(slot, apply_catch_up(missed))
+            next_run = slot.cron.next_after(now)
+
+        logging.info("Next run of %s at %s", slot, next_run)
+        heapq.heappush(heap, (next_run, index, slot))
 
-async def main():
-    if "send_now" in argv:
-        logging.info("Sending article now")
-        await send_article(datetime.now())
-
-    else:
-        food_times = {}
-        send_times = []
-        for time in ["breakfast", "launch", "dinner"]:
-            times = [int(time) for time in getenv(time).split(",")]
-            food_times[time] = times
-            send_times = send_times + times
-
-        logging.info(send_times)
-
-        while True:
-            now = datetime.now()
-            current_hour = now.hour
-
-            future_hours_today = [h for h in send_times if h > current_hour]
-
-            if future_hours_today:
-                next_hour = future_hours_today[0]
-                next_day_offset = 0
-            else:
-                next_hour = send_times[0]
-                next_day_offset = 1
-
-            for key in food_times:
-                if next_hour in food_times[key]:
-                    break
-
-            target_time = datetime(
-                year=now.year,
-                month=now.month,
-                day=now.day,
-                hour=next_hour,
-                minute=0,
-                second=0,
-                microsecond=0,
-            )
 
-            target_time += timedelta(days=next_day_offset)
+async def run_channel(channel: Channel):
+    slots = [Slot(channel, day_time, cron) for day_time, cron in channel.slots]
+    day_times = list(dict.fromkeys(slot.day_time for slot in slots))
 
-            if target_time <= now:
-                target_time += timedelta(days=1)
-                target_time = target_time.replace(hour=send_times[0])
+    background_tasks.add(asyncio.create_task(producer(channel, day_times)))
+    await run_schedule(slots)
 
-            wait_seconds = (
-                target_time - timedelta(minutes=5) - now,
-            ).total_seconds()
-            if wait_seconds < 0:
-                wait_seconds = 0
 
+async def main():
+    if "export" in argv:
+        logging.info("Rebuilding recipe export")
+        await rebuild_export()
+        return
+
+    channels = load_channels()
+
+    if "hashes" in argv:
+        logging.info("Indexing posted photos")
+        await backfill_photo_hashes(channels)
+        return
+
+    if "send_now" in argv:
+        logging.info("Sending article now")
+        await asyncio.gather(*(
+            send_article(datetime.now(), channel) for channel in channels
+        ))
+        return
+
+    now = datetime.now()
+    for channel in channels:
+        for day_time, cron in channel.slots:
             logging.info(
-                f"Next send scheduled for {target_time} "
-                f"(in {wait_seconds:.0f} seconds)"
+                "%s %s next run at %s", channel, day_time, cron.next_after(now)
             )
 
-            if "debug" in argv:
-                logging.info("Prepared to send article")
-                return
-            else:
-                await asyncio.sleep(wait_seconds)
+    if "debug" in argv:
+        logging.info("Prepared to send article")
+        return
 
-                await send_article(target_time, key)
+    await asyncio.gather(*(run_channel(channel) for channel in channels))
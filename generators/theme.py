@@ -1,13 +1,23 @@
 import random
 
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
 from database.orm import Theme
-from generators.config import session
 
 
-def choose_theme(boost_name: str, boost_amount: int = 150):
-    themes = session.query(Theme).all()
+async def choose_theme(
+    session: AsyncSession,
+    boost_name: str,
+    boost_amount: int = 150,
+    probabilities: dict[str, int] | None = None,
+):
+    themes = list(await session.scalars(select(Theme)))
 
-    weights = [theme.probability for theme in themes]
+    probabilities = probabilities or {}
+    weights = [
+        probabilities.get(theme.name, theme.probability) for theme in themes
+    ]
 
     for i, theme in enumerate(themes):
         if theme.name == boost_name:
@@ -1,7 +1,20 @@
 import asyncio
 
 import generators.config  # noqa F401
+from database.session import close_engine
 from generators.sheduler import main
+from utils.http_client import close_sessions
+from utils.thumbnail import close_thumbnail_pool
+
+
+async def run():
+    try:
+        await main()
+    finally:
+        await close_sessions()
+        await close_engine()
+        close_thumbnail_pool()
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(run())
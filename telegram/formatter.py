@@ -1,78 +1,363 @@
+import re
+from html import escape
 from html.parser import HTMLParser
+from typing import AsyncIterator, NamedTuple, Optional
 
+# Telegram HTML tags and the MessageEntity types they produce
+ENTITY_TYPES = {
+    "b": "bold",
+    "strong": "bold",
+    "i": "italic",
+    "em": "italic",
+    "u": "underline",
+    "ins": "underline",
+    "s": "strikethrough",
+    "strike": "strikethrough",
+    "del": "strikethrough",
+    "code": "code",
+    "pre": "pre",
+    "blockquote": "blockquote",
+    "tg-spoiler": "spoiler",
+}
+# Tags rendering each entity type, see render_html
+ENTITY_TAGS = {
+    "bold": "b",
+    "italic": "i",
+    "underline": "u",
+    "strikethrough": "s",
+    "code": "code",
+    "pre": "pre",
+    "blockquote": "blockquote",
+    "spoiler": "tg-spoiler",
+}
+NEWLINES = re.compile(r"(\n+)")
+# UTF-16 code units of separators where a long post may be split
+SEPARATORS = ("\n\n".encode("utf-16-le"), b"\n\x00", b" \x00")
+WHITESPACE = {b"\n\x00", b" \x00"}
 
-def format_text(text: str) -> str:
-    class SelectiveStripper(HTMLParser):
-        def __init__(self):
-            super().__init__()
-            self.result = []
-            self.stack = []  # Tracks open allowed tags
-
-        def handle_starttag(self, tag, attrs):
-            tag = tag.lower()
-            attrs_dict = {k.lower(): v for k, v in attrs if k is not None}
-
-            allowed = False
-            if tag in {
-                "b",
-                "strong",
-                "i",
-                "em",
-                "u",
-                "ins",
-                "s",
-                "strike",
-                "del",
-                "code",
-                "pre",
-                "blockquote",
-                "tg-spoiler",
-            }:
-                allowed = True
-            elif tag == "a" and "href" in attrs_dict:
-                allowed = True
-            elif tag == "span" and attrs_dict.get("class") == "tg-spoiler":
-                allowed = True
-            elif tag == "tg-emoji" and "emoji-id" in attrs_dict:
-                allowed = True
-
-            if allowed:
-                # Rebuild the tag with original attribute formatting (approx)
-                attr_parts = []
-                for k, v in attrs:
-                    if v is None:
-                        attr_parts.append(k)
-                    else:
-                        attr_parts.append(f'{k}="{v}"')
-                attr_str = (" " + " ".join(attr_parts)) if attr_parts else ""
-                self.result.append(f"<{tag}{attr_str}>")
-                self.stack.append(tag)
-
-        def handle_endtag(self, tag):
-            tag = tag.lower()
-            # Only output closing if it matches an open allowed tag
-            if self.stack and self.stack[-1] == tag:
-                self.stack.pop()
-                self.result.append(f"</{tag}>")
-
-        def handle_data(self, data):
-            self.result.append(data)
-
-        def handle_entityref(self, name):
-            self.result.append(f"&{name};")
-
-        def handle_charref(self, name):
-            self.result.append(f"&#{name};")
-
-        # Comments, PIs, etc., are ignored/skipped
-
-        def get_cleaned(self):
-            return "".join(self.result)
-
-    text = text.replace("<br>", "\n").replace("*", "")
-    text = text.replace("\n\n\n", "\n\n")
-
-    parser = SelectiveStripper()
-    parser.feed(text)
-    parser.close()
-    return parser.get_cleaned()
+
+def utf16_length(text: str) -> int:
+    """Length of a text as Telegram counts it, in UTF-16 code units."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _open_tag(entity: dict) -> str:
+    kind = entity["type"]
+    if kind == "text_link":
+        return f'<a href="{escape(entity["url"])}">'
+    if kind == "custom_emoji":
+        return f'<tg-emoji emoji-id="{escape(entity["custom_emoji_id"])}">'
+    if kind == "expandable_blockquote":
+        return "<blockquote expandable>"
+    if kind == "pre" and entity.get("language"):
+        return f'<pre><code class="language-{escape(entity["language"])}">'
+    return f"<{ENTITY_TAGS[kind]}>"
+
+
+def _close_tag(entity: dict) -> str:
+    kind = entity["type"]
+    if kind == "pre" and entity.get("language"):
+        return "</code></pre>"
+    return {
+        "text_link": "</a>",
+        "custom_emoji": "</tg-emoji>",
+        "expandable_blockquote": "</blockquote>",
+    }.get(kind) or f"</{ENTITY_TAGS[kind]}>"
+
+
+def _to_utf16(text: str, positions) -> dict[int, int]:
+    """Map code point positions of a text to UTF-16 offsets."""
+    offsets = {}
+    previous = offset = 0
+    for position in sorted(set(positions)):
+        offset += utf16_length(text[previous:position])
+        previous = position
+        offsets[position] = offset
+    return offsets
+
+
+def _from_utf16(units: bytes, offsets) -> dict[int, int]:
+    """Map UTF-16 offsets of encoded text to code point positions."""
+    positions = {}
+    previous = position = 0
+    for offset in sorted(set(offsets)):
+        position += len(units[previous * 2:offset * 2].decode("utf-16-le"))
+        previous = offset
+        positions[offset] = position
+    return positions
+
+
+def _render(text: str, spans: list[tuple[int, int, dict]]) -> str:
+    # Spans are (start, end, entity) in code points of text
+    tags = []
+    for index, (start, end, entity) in enumerate(spans):
+        # Closing tags go before opening ones at the same position, outer
+        # entities open first and close last
+        tags.append((start, 1, -end, index, _open_tag(entity)))
+        tags.append((end, 0, -start, -index, _close_tag(entity)))
+    tags.sort()
+
+    parts = []
+    position = 0
+    for offset, *_, tag in tags:
+        parts.append(escape(text[position:offset], False))
+        parts.append(tag)
+        position = offset
+    parts.append(escape(text[position:], False))
+    return "".join(parts)
+
+
+def render_html(text: str, entities: list[dict]) -> str:
+    """Render a text with entities as Telegram HTML."""
+    ends = [entity["offset"] + entity["length"] for entity in entities]
+    positions = _from_utf16(
+        text.encode("utf-16-le"),
+        [entity["offset"] for entity in entities] + ends,
+    )
+    return _render(
+        text,
+        [
+            (positions[entity["offset"]], positions[end], entity)
+            for entity, end in zip(entities, ends)
+        ],
+    )
+
+
+def _rfind_unit(units: bytes, separator: bytes, start: int, end: int) -> int:
+    """Last code unit where separator starts within units[start:end]."""
+    found = units.rfind(separator, start * 2, end * 2)
+    # Matches must be aligned to code units
+    while found >= 0 and found % 2:
+        found = units.rfind(
+            separator, start * 2, found + len(separator) - 1
+        )
+    return found // 2 if found >= 0 else -1
+
+
+class FormattedText(NamedTuple):
+    # Sanitized Telegram HTML
+    html: str
+    # The same text without markup, as Telegram shows it
+    text: str
+    # MessageEntity objects of the text, offsets in UTF-16 code units
+    entities: list[dict]
+    # Length of text in UTF-16 code units
+    length: int
+
+    def _slice(self, units: bytes, start: int, end: int) -> "FormattedText":
+        # Separators at the edges of a part are dropped
+        while end > start and units[end * 2 - 2:end * 2] in WHITESPACE:
+            end -= 1
+        while start < end and units[start * 2:start * 2 + 2] in WHITESPACE:
+            start += 1
+
+        entities = []
+        for entity in self.entities:
+            entity_start = max(entity["offset"], start)
+            entity_end = min(entity["offset"] + entity["length"], end)
+            if entity_end > entity_start:
+                entities.append({
+                    **entity,
+                    "offset": entity_start - start,
+                    "length": entity_end - entity_start,
+                })
+
+        text = units[start * 2:end * 2].decode("utf-16-le")
+        return FormattedText(
+            render_html(text, entities), text, entities, end - start
+        )
+
+    def split(self, limit: int) -> list["FormattedText"]:
+        """
+        Split the text into parts of at most `limit` UTF-16 code units.
+
+        Parts end at the last paragraph break that fits, then at a line
+        break, then at a space. Entities crossing a break are continued
+        in the next part, so no tag is left open.
+        """
+        if self.length <= limit:
+            return [self]
+
+        units = self.text.encode("utf-16-le")
+        parts = []
+        start = 0
+        while self.length - start > limit:
+            end = start + limit
+            for separator in SEPARATORS:
+                found = _rfind_unit(units, separator, start + 1, end)
+                if found > 0:
+                    cut = found + len(separator) // 2
+                    break
+            else:
+                cut = end
+                # Don't cut between the halves of a surrogate pair
+                if 0xD8 <= units[cut * 2 - 1] <= 0xDB:
+                    cut -= 1
+            part = self._slice(units, start, cut)
+            if part.length:
+                parts.append(part)
+            start = cut
+
+        part = self._slice(units, start, self.length)
+        if part.length:
+            parts.append(part)
+        return parts
+
+
+class TelegramFormatter(HTMLParser):
+    """
+    Sanitizes generated HTML to the tags Telegram supports in one pass.
+
+    The pass builds the plain text and its MessageEntity list. Offsets
+    are kept in code points while parsing and moved to UTF-16 code units
+    at the end by encoding the text between entity edges, and the
+    sanitized HTML is rendered from the entities. Unsupported
+    tags are dropped with their text kept, "*" is removed, runs of blank
+    lines are collapsed and leading and trailing line breaks are dropped.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.text = []
+        self.entities = []
+        # Open tags with their entity, None for an inner <code> of <pre>
+        self.stack = []
+        # Length of the text in code points
+        self.length = 0
+        self.newlines = 0
+
+    def _flush_newlines(self):
+        # Line breaks are held back until more text follows, so that
+        # they never end a post or an entity
+        if self.length:
+            newlines = "\n" * min(self.newlines, 2)
+            self.text.append(newlines)
+            self.length += len(newlines)
+        self.newlines = 0
+
+    def _entity(self, tag: str, attrs: dict) -> Optional[dict]:
+        if tag in ENTITY_TYPES:
+            kind = ENTITY_TYPES[tag]
+            if tag == "blockquote" and "expandable" in attrs:
+                kind = "expandable_blockquote"
+            return {"type": kind}
+        if tag == "a" and attrs.get("href"):
+            return {"type": "text_link", "url": attrs["href"]}
+        if tag == "span" and attrs.get("class") == "tg-spoiler":
+            return {"type": "spoiler"}
+        if tag == "tg-emoji" and attrs.get("emoji-id"):
+            return {
+                "type": "custom_emoji",
+                "custom_emoji_id": attrs["emoji-id"],
+            }
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "br":
+            self.newlines += 1
+            return
+
+        attrs = dict(attrs)
+        entity = self._entity(tag, attrs)
+        if entity is None:
+            return
+        if self.newlines:
+            self._flush_newlines()
+
+        parent = self.stack[-1][1] if self.stack else None
+        language = (attrs.get("class") or "").removeprefix("language-")
+        if (
+            tag == "code"
+            and parent
+            and parent["type"] == "pre"
+            and parent["offset"] == self.length
+            and language
+        ):
+            # <pre><code class="language-x"> is a pre entity with language
+            parent["language"] = language
+            self.stack.append((tag, None))
+            return
+
+        entity["offset"] = self.length
+        self.stack.append((tag, entity))
+
+    def handle_endtag(self, tag):
+        if not any(name == tag for name, _ in self.stack):
+            return
+        # Tags left open inside are closed with this one
+        while self.stack:
+            name, entity = self.stack.pop()
+            self._close(entity)
+            if name == tag:
+                break
+
+    def _close(self, entity: Optional[dict]):
+        if entity is None:
+            return
+        entity["length"] = self.length - entity["offset"]
+        if entity["length"]:
+            self.entities.append(entity)
+
+    def handle_data(self, data):
+        if "*" in data:
+            data = data.replace("*", "")
+        if "\n" not in data:
+            if data:
+                if self.newlines:
+                    self._flush_newlines()
+                self.text.append(data)
+                self.length += len(data)
+            return
+
+        for index, piece in enumerate(NEWLINES.split(data)):
+            if index % 2:
+                self.newlines += len(piece)
+            elif piece:
+                if self.newlines:
+                    self._flush_newlines()
+                self.text.append(piece)
+                self.length += len(piece)
+
+    def close(self):
+        super().close()
+        while self.stack:
+            self._close(self.stack.pop()[1])
+        self.newlines = 0
+
+    def result(self) -> FormattedText:
+        text = "".join(self.text)
+        entities = sorted(
+            self.entities,
+            key=lambda entity: (entity["offset"], -entity["length"]),
+        )
+        spans = [
+            (entity["offset"], entity["offset"] + entity["length"], entity)
+            for entity in entities
+        ]
+        html = _render(text, spans)
+
+        offsets = _to_utf16(
+            text, [edge for start, end, _ in spans for edge in (start, end)]
+        )
+        for start, end, entity in spans:
+            entity["offset"] = offsets[start]
+            entity["length"] = offsets[end] - offsets[start]
+        return FormattedText(html, text, entities, utf16_length(text))
+
+
+def format_text(text: str) -> FormattedText:
+    formatter = TelegramFormatter()
+    formatter.feed(text)
+    formatter.close()
+    return formatter.result()
+
+
+async def format_stream(chunks: AsyncIterator[str]) -> FormattedText:
+    """Format a streamed answer while it is still being generated."""
+    formatter = TelegramFormatter()
+    async for chunk in chunks:
+        formatter.feed(chunk)
+    formatter.close()
+    return formatter.result()
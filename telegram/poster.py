@@ -1,10 +1,187 @@
+import asyncio
+import json
 import logging
+import time
 from datetime import datetime
-from typing import Optional
+from os import getenv
+from pathlib import Path
+from typing import AsyncIterator, Callable, Optional
 
 import aiohttp
 
 from database.orm import Article
+from telegram.formatter import FormattedText, format_text
+from utils.http_client import get_session
+
+# Photo bytes, a local file, or a factory of an async stream of chunks
+PhotoSource = bytes | Path | Callable[[], AsyncIterator[bytes]]
+
+# Bot API limits in UTF-16 code units of the text after entity parsing
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+
+
+class ChatLimiter:
+    """
+    Keeps a minimum interval between messages to the same chat and
+    pauses a chat for `retry_after` seconds after Telegram's flood control.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_time: dict[str, float] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    async def wait(self, chat: str):
+        lock = self.locks.setdefault(chat, asyncio.Lock())
+        async with lock:
+            delay = self.next_time.get(chat, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_time[chat] = time.monotonic() + self.interval
+
+    def pause(self, chat: str, seconds: float):
+        self.next_time[chat] = max(
+            self.next_time.get(chat, 0), time.monotonic() + seconds
+        )
+
+
+_limiter: Optional[ChatLimiter] = None
+
+
+def get_chat_limiter() -> ChatLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = ChatLimiter(float(getenv("telegram_interval") or 1))
+    return _limiter
+
+
+class TelegramClient:
+    """
+    Minimal Bot API client on the shared "telegram" HTTP pool.
+
+    Requests are sent as POST bodies (JSON, or multipart for uploads),
+    paced per chat by ChatLimiter and retried after 429 `retry_after`.
+    """
+
+    API_URL = "https://api.telegram.org"
+
+    def __init__(
+        self,
+        token: str,
+        session: Optional[aiohttp.ClientSession] = None,
+        api_url: Optional[str] = None,
+        retries: int = 3,
+    ):
+        self.token = token
+        self.session = session or get_session("telegram")
+        self.api_url = api_url or getenv("telegram_api") or self.API_URL
+        self.retries = retries
+        self.limiter = get_chat_limiter()
+
+    async def call(
+        self,
+        method: str,
+        chat: str | int,
+        fields: dict,
+        files: Optional[dict[str, tuple[PhotoSource, str]]] = None,
+    ) -> dict:
+        """
+        Call a Bot API method for a chat.
+
+        Files are (content, filename) pairs. Content is bytes, a Path that
+        is streamed from disk, or a factory returning an async iterator of
+        chunks that is piped into the upload.
+        """
+        url = f"{self.api_url}/bot{self.token}/{method}"
+        fields = {"chat_id": str(chat), **fields}
+
+        for attempt in range(self.retries + 1):
+            await self.limiter.wait(str(chat))
+
+            opened = []
+            if files:
+                # FormData can't be sent twice, so it is built per attempt
+                data = aiohttp.FormData()
+                for name, value in fields.items():
+                    if not isinstance(value, str):
+                        value = json.dumps(value)
+                    data.add_field(name, value)
+                for name, (content, filename) in files.items():
+                    if isinstance(content, Path):
+                        content = content.open("rb")
+                        opened.append(content)
+                    elif callable(content):
+                        content = content()
+                    data.add_field(name, content, filename=filename)
+                request = self.session.post(url, data=data)
+            else:
+                request = self.session.post(url, json=fields)
+
+            try:
+                async with request as resp:
+                    response = await resp.json()
+            finally:
+                for file in opened:
+                    file.close()
+
+            retry_after = response.get("parameters", {}).get("retry_after")
+            if response.get("ok") or not retry_after:
+                return response
+            if attempt == self.retries:
+                return response
+
+            logging.warning(
+                "Telegram flood control for %s, retry in %s s",
+                chat,
+                retry_after,
+            )
+            self.limiter.pause(str(chat), retry_after)
+
+    async def get_file(self, file_id: str) -> bytes:
+        """Download a file the bot sent or received, such as a photo."""
+        async with self.session.post(
+            f"{self.api_url}/bot{self.token}/getFile",
+            json={"file_id": file_id},
+        ) as resp:
+            response = await resp.json()
+        if not response.get("ok"):
+            raise ValueError(f"Can't get file {file_id}: {response}")
+
+        path = response["result"]["file_path"]
+        async with self.session.get(
+            f"{self.api_url}/file/bot{self.token}/{path}"
+        ) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def send_photo(
+        self,
+        chat: str | int,
+        photo: PhotoSource | str,
+        caption: Optional[FormattedText] = None,
+    ) -> dict:
+        """Send a photo, or a file_id of an already uploaded photo."""
+        fields = {}
+        if caption:
+            fields["caption"] = caption.text
+            if caption.entities:
+                fields["caption_entities"] = caption.entities
+
+        if isinstance(photo, str):
+            fields["photo"] = photo
+            return await self.call("sendPhoto", chat, fields)
+        return await self.call(
+            "sendPhoto", chat, fields, {"photo": (photo, "image.jpg")}
+        )
+
+    async def send_message(
+        self, chat: str | int, text: FormattedText
+    ) -> dict:
+        fields = {"text": text.text, "disable_web_page_preview": True}
+        if text.entities:
+            fields["entities"] = text.entities
+        return await self.call("sendMessage", chat, fields)
 
 
 async def post_and_database(
@@ -12,19 +189,24 @@ async def post_and_database(
     channel: str | int,
     token: str,
     text: str,
-    image: Optional[bytes] = None,
+    image: Optional[PhotoSource] = None,
 ):
+    # Reuse the photo uploaded by an earlier attempt instead of the bytes
+    photo = article.posted_photo or image
+
     logging.info("Posting to channel %s: %s", channel, text)
-    post = await post_to_channel(channel, token, text, image)
+    post = await post_to_channel(channel, token, text, photo)
+
+    if post.get("uploaded_photo"):
+        article.posted_photo = post["uploaded_photo"]
 
     if post.get("ok"):
         logging.info(post)
         article.is_posted = True
-        article.posted_channel = channel
+        # Text like the column, numeric chat IDs included
+        article.posted_channel = str(channel)
         article.posted_id = post["result"]["message_id"]
         article.posted_time = datetime.fromtimestamp(post["result"]["date"])
-        if image:
-            article.posted_photo = post["result"]["photo"][-1]["file_id"]
     else:
         logging.error(post)
 
@@ -33,54 +215,49 @@ async def post_to_channel(
     channel: str | int,
     token: str,
     text: str,
-    image: Optional[bytes] = None,
+    image: Optional[PhotoSource | str] = None,
 ):
     """
     Posts a message to a Telegram channel using the Bot API.
+
+    `image` is a photo source (see TelegramClient.call) or the file_id of
+    an uploaded photo. The HTML text is sent as plain text with entities,
+    as a caption when it fits, otherwise in as many messages as needed.
+    If a streamed photo can't be read, the text is posted alone. The
+    file_id of the posted photo is returned as "uploaded_photo".
     """
-    base_url = f"https://api.telegram.org/bot{token}"
+    client = TelegramClient(token)
+    formatted = format_text(text)
     photo = None
 
     if image:
-        method = "sendPhoto"
-        url = f"{base_url}/{method}"
-
-        form = aiohttp.FormData()
-        form.add_field("chat_id", str(channel))
+        caption = formatted if formatted.length <= CAPTION_LIMIT else None
+        try:
+            response = await client.send_photo(channel, image, caption)
+        except (aiohttp.ClientError, OSError, ValueError) as e:
+            logging.warning("Failed to upload photo, posting text: %s", e)
+        else:
+            if not response.get("ok"):
+                return response
 
-        if len(text) <= 1024:
-            form.add_field("caption", text)
-            text = None
+            photo = response["result"]["photo"]
+            response["uploaded_photo"] = photo[-1]["file_id"]
+            if caption:
+                return response
 
-        form.add_field("parse_mode", "HTML")
-        form.add_field(
-            "photo",
-            image,
-            filename="image.jpg",
-        )
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=form) as resp:
-                response = await resp.json()
-                if not text:
-                    return response
-                photo = response["result"]["photo"]
-
-    method = "sendMessage"
-    url = f"{base_url}/{method}"
-
-    params = {
-        "chat_id": str(channel),
-        "text": text,
-        "disable_web_page_preview": 1,
-        "parse_mode": "HTML",
-    }
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as resp:
-            response = await resp.json()
+    first, *rest = formatted.split(MESSAGE_LIMIT)
+    response = await client.send_message(channel, first)
+    if response.get("ok"):
+        # The post counts as sent with its first part, the rest follow
+        for part in rest:
+            continued = await client.send_message(channel, part)
+            if not continued.get("ok"):
+                logging.error("Failed to post the rest: %s", continued)
+                break
 
     if photo:
-        response["result"]["photo"] = photo
+        response["uploaded_photo"] = photo[-1]["file_id"]
+        if response.get("ok"):
+            response["result"]["photo"] = photo
 
     return response
@@ -1,33 +1,116 @@
-from io import BytesIO
+import asyncio
+import base64
+from functools import partial
+from os import getenv
+from pathlib import Path
+from typing import AsyncIterator
 
-import aiohttp
-from PIL import Image
+from utils.file_handler import atomic_file
+from utils.http_client import get_session
+from utils.image_cache import CachedImage, get_image_cache
 
+CHUNK_SIZE = 64 * 1024
 
-async def download_image(url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            image = await response.read()
-            return image
+_in_flight: dict[str, asyncio.Task] = {}
 
 
-def resize_image(image: bytes, max_width: int = 120):
-    with Image.open(BytesIO(image)) as img:
-        if img.mode in ("RGBA", "LA", "P"):
-            img = img.convert("RGB")
+def max_image_bytes() -> int:
+    """Size cap of streamed images, 10 MB is Telegram's photo limit."""
+    return int(float(getenv("image_max_mb") or 10) * 1024 * 1024)
 
-        if img.width <= max_width:
-            output = BytesIO()
-            img.save(output, format="JPEG", quality=95)
-            return output.getvalue()
 
-        ratio = max_width / img.width
-        new_height = int(img.height * ratio)
-        resized_img = img.resize(
-            (max_width, new_height),
-            Image.Resampling.LANCZOS,
-        )
+async def _fetch(url) -> bytes:
+    async with get_session().get(url) as response:
+        response.raise_for_status()
+        return await response.read()
 
-        output = BytesIO()
-        resized_img.save(output, format="JPEG", quality=95)
-        return output.getvalue()
+
+async def _download(cache, url) -> CachedImage:
+    return await cache.put(url, await _fetch(url))
+
+
+async def get_cached_image(url) -> CachedImage:
+    """
+    Return the image for url from the cache, downloading it on a miss.
+
+    Concurrent requests for the same url share a single download, which
+    runs in its own task: cancelling one caller doesn't cancel it for the
+    others.
+    """
+    cache = get_image_cache()
+    cached = await cache.get(url)
+    if cached:
+        return cached
+
+    task = _in_flight.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_download(cache, url))
+        _in_flight[url] = task
+        task.add_done_callback(partial(_download_done, url))
+    return await asyncio.shield(task)
+
+
+def _download_done(url, task: asyncio.Task):
+    del _in_flight[url]
+    if not task.cancelled():
+        task.exception()  # mark as retrieved when nobody is waiting
+
+
+async def download_image(url, cache: bool = True) -> bytes:
+    if not cache:
+        return await _fetch(url)
+    return (await get_cached_image(url)).data
+
+
+async def stream_image(url) -> AsyncIterator[bytes]:
+    """Yield the image body in chunks, failing once it exceeds the cap."""
+    limit = max_image_bytes()
+    async with get_session().get(url) as response:
+        response.raise_for_status()
+        if (response.content_length or 0) > limit:
+            raise ValueError(f"Image {url} is larger than {limit} bytes")
+
+        total = 0
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            total += len(chunk)
+            if total > limit:
+                raise ValueError(f"Image {url} is larger than {limit} bytes")
+            yield chunk
+
+
+async def save_image(url, path: Path) -> int:
+    """
+    Stream an image to a file without holding it in memory.
+
+    The file only appears once the whole image arrived, a failed or
+    oversized download leaves nothing behind.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    size = 0
+    with atomic_file(path) as file:
+        async for chunk in stream_image(url):
+            file.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def save_b64_image(data: str, path: Path) -> int:
+    """
+    Decode a base64 image (DALL-E b64_json) to a file chunk by chunk.
+
+    Blocks on decoding and disk writes, run it in a thread.
+    """
+    # Multiple of 4 characters, so every slice decodes on its own
+    step = CHUNK_SIZE // 3 * 4
+    if len(data) * 3 // 4 > max_image_bytes():
+        raise ValueError("Image is larger than the size cap")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    size = 0
+    with atomic_file(path) as file:
+        # Only one slice of the encoded image is copied at a time
+        for start in range(0, len(data), step):
+            chunk = base64.b64decode(data[start:start + step])
+            file.write(chunk)
+            size += len(chunk)
+    return size
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from os import getenv
+from typing import Any, Awaitable, Callable, Iterable
+
+# Per-stage defaults: (concurrent tasks, timeout per task in seconds)
+STAGE_SETTINGS = {
+    "default": (4, 60),
+    "links": (4, 120),
+    "probe": (8, 15),
+    "score": (4, 60),
+    "score_image": (4, 30),
+}
+
+_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+def stage_settings(stage: str) -> tuple[int, float]:
+    limit, timeout = STAGE_SETTINGS.get(stage, STAGE_SETTINGS["default"])
+    return (
+        int(getenv(f"{stage}_concurrency") or limit),
+        float(getenv(f"{stage}_timeout") or timeout),
+    )
+
+
+def stage_semaphore(stage: str) -> asyncio.Semaphore:
+    """
+    Shared limit of a stage's tasks, so concurrent and nested calls (e.g.
+    probes of every page of the links stage) don't multiply it. A task
+    must not wait for tasks of its own stage.
+    """
+    semaphore = _semaphores.get(stage)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(stage_settings(stage)[0])
+        _semaphores[stage] = semaphore
+    return semaphore
+
+
+async def map_limited(
+    func: Callable[[Any], Awaitable[Any]],
+    items: Iterable,
+    stage: str = "default",
+) -> list:
+    """
+    Run func over items within the stage's shared concurrency limit and
+    with its timeout per task.
+
+    Results keep the order of items. A task that fails or times out is
+    logged and yields None, so callers always get the partial result.
+    """
+    _, timeout = stage_settings(stage)
+    semaphore = stage_semaphore(stage)
+
+    async def run(item):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(func(item), timeout)
+            except asyncio.TimeoutError:
+                logging.warning("%s task timed out: %.200r", stage, item)
+            except Exception as e:
+                logging.warning("%s task failed: %.200r: %s", stage, item, e)
+        return None
+
+    return await asyncio.gather(*(run(item) for item in items))
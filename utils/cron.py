@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+# (lowest, highest) value of every cron field, weekday 0 and 7 are Sunday
+FIELDS = (
+    (0, 59),
+    (0, 23),
+    (1, 31),
+    (1, 12),
+    (0, 7),
+)
+
+
+def parse_field(field: str, low: int, high: int) -> set[int]:
+    """Parse one cron field with `*`, lists, ranges and steps."""
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/")
+            step = int(step_text)
+
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-"))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+
+        if start < low or end > high or step < 1:
+            raise ValueError(f"Cron field out of range: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Cron:
+    """Minute-precision cron expression: "minute hour day month weekday"."""
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression}")
+
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_field(part, low, high)
+            for part, (low, high) in zip(parts, FIELDS)
+        )
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    def __repr__(self):
+        return f"Cron({self.expression!r})"
+
+    def matches_date(self, date) -> bool:
+        if date.month not in self.months:
+            return False
+        day = date.day in self.days
+        weekday = (date.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment: datetime) -> datetime:
+        """Return the first matching minute strictly after moment."""
+        start = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        hours = sorted(self.hours)
+        minutes = sorted(self.minutes)
+
+        for offset in range(366 * 5):
+            date = start.date() + timedelta(days=offset)
+            if not self.matches_date(date):
+                continue
+            for hour in hours:
+                for minute in minutes:
+                    candidate = datetime(
+                        date.year, date.month, date.day, hour, minute
+                    )
+                    if candidate >= start:
+                        return candidate
+        raise ValueError(f"Cron expression never matches: {self.expression}")
+
+    def between(self, start: datetime, end: datetime) -> list[datetime]:
+        """Return matching minutes in (start, end]."""
+        moments = []
+        moment = self.next_after(start)
+        while moment <= end:
+            moments.append(moment)
+            moment = self.next_after(moment)
+        return moments
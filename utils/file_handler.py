@@ -1,32 +1,279 @@
+import asyncio
 import json
+import logging
+import os
+import struct
+from contextlib import contextmanager
+from os import getenv
 from pathlib import Path
+from typing import Callable, Iterator, Optional
 
-from database.article import Article
-from generators.config import session
+from sqlalchemy import select
 
+from database.orm import Article
+from database.session import unit_of_work
+from utils.hashtags import extract_hashtags
 
-def write_to_articles():
-    articles = session.query(Article).filter_by(is_posted=True).all()
+EXPORT_PATH = Path("recipes.jsonl")
+# Offset index entry: article id and offset of its line in the export
+INDEX_RECORD = struct.Struct("<qq")
+# Posted articles fetched at once while rebuilding the export
+REBUILD_BATCH = 500
 
-    all_articles = [
-        {
-            "name": article.name,
-            "photo": article.photo,
-            "photo_id": article.posted_photo,
-            "link": (
-                f"https://t.me/{article.posted_channel[1:]}/"
-                f"{article.posted_id}"
-            ),
-            "text": get_text(article.text),
-            "hashtags": get_hashtags(article.text),
-        }
-        for article in articles
-    ]
+_export = None
+_export_lock: Optional[asyncio.Lock] = None
 
-    Path("recipes.json").write_text(
-        json.dumps(all_articles, ensure_ascii=False, indent=4),
-        encoding="utf-8",
-    )
+
+def post_link(chat: str, message_id) -> str:
+    """Link to a post by the chat username (@name) or ID (-100...)."""
+    chat = str(chat)
+    if chat.startswith("-100"):
+        # Private channels are linked by their ID without the prefix
+        return f"https://t.me/c/{chat[4:]}/{message_id}"
+    return f"https://t.me/{chat.removeprefix('@')}/{message_id}"
+
+
+def article_record(article) -> dict:
+    return {
+        "id": article.id,
+        "name": article.name,
+        "photo": article.photo,
+        "photo_id": article.posted_photo,
+        "link": post_link(article.posted_channel, article.posted_id),
+        "text": get_text(article.text),
+        "hashtags": extract_hashtags(article.text),
+    }
+
+
+@contextmanager
+def atomic_file(path: Path) -> Iterator:
+    """
+    Open a temporary file next to `path` that replaces it on success.
+
+    Readers see either the old or the complete new file, never a
+    truncated one.
+    """
+    temp = path.with_name(f".{path.name}.tmp")
+    try:
+        with temp.open("wb") as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, path)
+    finally:
+        temp.unlink(missing_ok=True)
+
+
+class RecipeExport:
+    """
+    Append-only JSON Lines export of posted articles.
+
+    Each post appends one line to `path` and one fixed-size record (id,
+    offset) to the `.idx` file beside it, so exporting is O(1) per post
+    and an article's line can be read without scanning. A line cut by a
+    crash is dropped and lines missing from the index are re-indexed
+    when the export is opened.
+    """
+
+    def __init__(self, path: Path = EXPORT_PATH):
+        self.path = Path(path)
+        self.index_path = self.path.with_suffix(".idx")
+        self.offsets: dict[int, int] = {}
+        if self.path.exists():
+            self._recover()
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def _recover(self):
+        size = self._truncate_partial_line()
+
+        data = (
+            self.index_path.read_bytes() if self.index_path.exists() else b""
+        )
+        records = len(data) // INDEX_RECORD.size
+        valid = 0
+        for article_id, offset in INDEX_RECORD.iter_unpack(
+            data[: records * INDEX_RECORD.size]
+        ):
+            if offset >= size:
+                break
+            self.offsets[article_id] = offset
+            valid += 1
+
+        added = self._index_lines_after(max(self.offsets.values(), default=-1))
+        if added or valid * INDEX_RECORD.size != len(data):
+            logging.info("Re-indexing recipe export %s", self.path)
+            with atomic_file(self.index_path) as file:
+                for article_id, offset in self.offsets.items():
+                    file.write(INDEX_RECORD.pack(article_id, offset))
+
+    def _index_lines_after(self, offset: int) -> int:
+        """Index lines following the one at `offset` (-1 for all)."""
+        added = 0
+        with self.path.open("rb") as file:
+            if offset >= 0:
+                file.seek(offset)
+                file.readline()
+            while True:
+                offset = file.tell()
+                line = file.readline()
+                if not line:
+                    return added
+                self.offsets[json.loads(line)["id"]] = offset
+                added += 1
+
+    def _truncate_partial_line(self) -> int:
+        """Cut an unfinished last line and return the file size."""
+        with self.path.open("rb+") as file:
+            size = file.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - 65536)
+                file.seek(start)
+                chunk = file.read(end - start)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end != size:
+                logging.warning(
+                    "Dropping %s partial bytes of %s", size - end, self.path
+                )
+                file.truncate(end)
+            return end
+
+    def append(self, record: dict) -> bool:
+        """Export an article once, return False if it's already there."""
+        if record["id"] in self.offsets:
+            return False
+
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        with self.path.open("ab") as file:
+            offset = file.tell()
+            file.write(line)
+            file.flush()
+            os.fsync(file.fileno())
+        with self.index_path.open("ab") as file:
+            file.write(INDEX_RECORD.pack(record["id"], offset))
+        self.offsets[record["id"]] = offset
+        return True
+
+    def get(self, article_id: int) -> Optional[dict]:
+        offset = self.offsets.get(article_id)
+        if offset is None:
+            return None
+        with self.path.open("rb") as file:
+            file.seek(offset)
+            return json.loads(file.readline())
+
+    def lines(self) -> Iterator[bytes]:
+        with self.path.open("rb") as file:
+            yield from file
+
+    def write_snapshot(self, path: Optional[Path] = None):
+        """
+        Write the export as one JSON array, streaming line by line, to
+        `path` or to the .json file beside the export.
+        """
+        with atomic_file(path or self.path.with_suffix(".json")) as snapshot:
+            snapshot.write(b"[")
+            for index, line in enumerate(self.lines()):
+                snapshot.write(b",\n" if index else b"\n")
+                snapshot.write(line.rstrip(b"\n"))
+            snapshot.write(b"\n]\n")
+
+    @contextmanager
+    def rebuild(self) -> Iterator[Callable[[dict], None]]:
+        """
+        Yield a function writing records into a new export that replaces
+        the current one only when the block completes.
+        """
+        offsets = {}
+        with atomic_file(self.path) as file:
+
+            def write(record: dict):
+                offsets[record["id"]] = file.tell()
+                file.write(
+                    json.dumps(record, ensure_ascii=False).encode("utf-8")
+                    + b"\n"
+                )
+
+            yield write
+            # Without an index the new export is re-indexed if we stop here
+            self.index_path.unlink(missing_ok=True)
+
+        with atomic_file(self.index_path) as file:
+            for article_id, offset in offsets.items():
+                file.write(INDEX_RECORD.pack(article_id, offset))
+        self.offsets = offsets
+
+
+def get_recipe_export() -> RecipeExport:
+    global _export
+    if _export is None:
+        _export = RecipeExport(Path(getenv("recipes_export") or EXPORT_PATH))
+    return _export
+
+
+def export_lock() -> asyncio.Lock:
+    global _export_lock
+    if _export_lock is None:
+        _export_lock = asyncio.Lock()
+    return _export_lock
+
+
+def snapshot_enabled() -> bool:
+    return (getenv("recipes_snapshot") or "1") == "1"
+
+
+async def rebuild_export():
+    """
+    Export all posted articles again, streaming them from the database,
+    and write the JSON snapshot when recipes_snapshot is on.
+    """
+    async with export_lock():
+        export = await asyncio.to_thread(get_recipe_export)
+        async with unit_of_work(write=False) as session:
+            rows = await session.stream(
+                select(
+                    Article.id,
+                    Article.name,
+                    Article.photo,
+                    Article.posted_photo,
+                    Article.posted_channel,
+                    Article.posted_id,
+                    Article.text,
+                )
+                .where(Article.is_posted == True)  # noqa E712
+                .order_by(Article.posted_time, Article.id)
+                .execution_options(yield_per=REBUILD_BATCH)
+            )
+            with export.rebuild() as write:
+                async for row in rows:
+                    write(article_record(row))
+
+        logging.info(
+            "Rebuilt recipe export of %s articles", len(export.offsets)
+        )
+        if snapshot_enabled():
+            await asyncio.to_thread(export.write_snapshot)
+
+
+async def export_article(article: Article):
+    """
+    Append a posted article to the export. The JSON snapshot is only
+    rewritten by rebuild_export, a rewrite per post grows with the export.
+    """
+    export = await asyncio.to_thread(get_recipe_export)
+    if not export.exists():
+        # First run or a deleted export, the article is part of the rebuild
+        await rebuild_export()
+        return
+
+    async with export_lock():
+        await asyncio.to_thread(export.append, article_record(article))
 
 
 def get_text(text):
@@ -43,14 +290,3 @@ def get_text(text):
         text = text.strip()
 
     return text
-
-
-def get_hashtags(text):
-    hashtags = []
-
-    for word in text.split():
-        if word.startswith("#"):
-            if not word[1:] in hashtags:
-                hashtags.append(word[1:])
-
-    return hashtags
@@ -0,0 +1,11 @@
+import re
+
+# A tag ends at the first character that can't be part of a word, so
+# "#tag|", "#tag." and "#tag</b>" all give "tag". "&#39;" (a character
+# reference) and all-digit "#123" aren't tags.
+HASHTAG = re.compile(r"(?<![&\w/])#(\w*[^\W\d_]\w*)")
+
+
+def extract_hashtags(text: str) -> list[str]:
+    """Hashtags of a text without "#", in order of appearance, once each."""
+    return list(dict.fromkeys(HASHTAG.findall(text or "")))
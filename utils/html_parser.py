@@ -1,140 +1,524 @@
+import codecs
+import json
 import logging
 import re
 import urllib.parse
-from io import BytesIO
+from html.parser import HTMLParser
+from os import getenv
+from typing import Optional
 
-import aiohttp
-from bs4 import BeautifulSoup
-from PIL import Image
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
 
+from utils.check_image import get_cached_image
+from utils.concurrency import map_limited
+from utils.http_client import get_session
+from utils.image_cache import get_image_cache
+from utils.image_header import UnsupportedImage, parse_image_size
+from utils.page_cache import CachedPage, get_page_cache
 
-async def get_image_size(url):
+
+PROBE_RANGE = 16 * 1024
+PROBE_LIMIT = 64 * 1024
+CHUNK_SIZE = 16 * 1024
+# Bytes searched for a <meta> charset, as in the HTML prescan
+PRESCAN_BYTES = 1024
+META_CHARSET = re.compile(
+    rb"""<meta[^>]+?charset\s*=\s*["']?\s*([\w.:-]+)""", re.IGNORECASE
+)
+BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# Sections whose images are never the recipe photo
+SKIP_TAGS = {"nav", "aside", "footer", "header"}
+SKIP_CLASSES = {"sidebar", "related", "recommend", "promo", "ads", "comments"}
+CONTENT_TAGS = {"article", "main", "figure"}
+SKIP_IMAGE = re.compile(r"avatar|icon|logo")
+VOID_TAGS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+    "meta", "param", "source", "track", "wbr",
+}
+# Base score of images named by page metadata
+STRUCTURED_SCORE = {"json-ld": 10, "og:image": 8}
+
+
+async def probe_image_size(url: str) -> Optional[tuple[int, int]]:
+    """
+    Read image dimensions from the first kilobytes of the response.
+
+    Asks for a byte range and stops reading (closing the connection) as
+    soon as the header is parsed. Returns None when the header could not
+    be read within PROBE_LIMIT bytes or the format is not supported.
+    """
+    headers = {"Range": f"bytes=0-{PROBE_RANGE - 1}"}
+    async with get_session().get(url, headers=headers) as response:
+        if response.status not in (200, 206):
+            return None
+
+        buffer = bytearray()
+        try:
+            async for chunk in response.content.iter_chunked(4096):
+                buffer += chunk
+                size = parse_image_size(bytes(buffer))
+                if size or len(buffer) >= PROBE_LIMIT:
+                    return size
+        except UnsupportedImage as e:
+            logging.debug("Can't probe image %s: %s", url, e)
+        finally:
+            if not response.content.at_eof():
+                response.close()
+    return None
+
+
+async def get_image_size(url, probe: bool = True):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    image_data = await response.read()
-                    image = Image.open(BytesIO(image_data))
-                    return image.size[0]
+        cached = await get_image_cache().get(url)
+        if cached:
+            return cached.width
+
+        if probe:
+            size = await probe_image_size(url)
+            if size:
+                return size[0]
+
+        image = await get_cached_image(url)
+        return image.width
     except Exception as e:
         logging.warning(f"Can't load image {url}: {e}")
     return 0
 
 
-def extract_image_candidates(soup: BeautifulSoup) -> dict:
+def _int(value) -> Optional[int]:
+    match = re.match(r"\s*(\d+)", str(value or ""))
+    return int(match[1]) if match else None
+
+
+def parse_srcset(srcset: str) -> tuple[Optional[str], Optional[int]]:
+    """Return the widest URL of a srcset and its width descriptor."""
+    best, best_width = None, None
+    for item in srcset.split(","):
+        parts = item.split()
+        if not parts:
+            continue
+        width = None
+        if len(parts) > 1 and parts[1].endswith("w"):
+            width = _int(parts[1])
+        if best is None or (width or 0) > (best_width or 0):
+            best, best_width = parts[0], width
+    return best, best_width
+
+
+def recipe_images(data) -> list[tuple[str, Optional[int]]]:
+    """Find (url, width) of Recipe.image in parsed JSON-LD."""
+    if isinstance(data, list):
+        return [image for item in data for image in recipe_images(item)]
+    if not isinstance(data, dict):
+        return []
+    if "@graph" in data:
+        return recipe_images(data["@graph"])
+
+    types = data.get("@type")
+    if "Recipe" not in (types if isinstance(types, list) else [types]):
+        return []
+
+    images = []
+    values = data.get("image")
+    for value in values if isinstance(values, list) else [values]:
+        if isinstance(value, str):
+            images.append((value, None))
+        elif isinstance(value, dict):
+            url = value.get("url") or value.get("contentUrl")
+            if isinstance(url, str):
+                images.append((url, _int(value.get("width"))))
+    return images
+
+
+class CandidateCollector:
     """
-    Extract image candidates from an HTML document.
-    Returns a dictionary of image candidates with metadata and score.
+    Collect image candidates in a single pass over parser events.
+
+    Works with any tokenizer calling start/end/data (html.parser or an
+    lxml target parser), so no DOM is built. Images named by JSON-LD
+    Recipe.image and og:image come first. With `structured_first` the
+    page is read no further than <body> once <head> named one of them.
     """
-    for tag in soup.select((
-        "nav, aside, footer, header, .sidebar, "
-        ".related, .recommend, .promo, .ads, .comments"
-    )):
-        tag.decompose()
 
-    images = []
-    position = 0
+    def __init__(self, structured_first: bool = True):
+        self.structured_first = structured_first
+        self.structured: list[dict] = []
+        self.images: list[dict] = []
+        self.stack: list[dict] = []
+        # Open <p> and <figcaption> elements collecting their text
+        self.texts: list[dict] = []
+        self.skip_depth = 0
+        self.content_depth = 0
+        self.position = 0
+        self.script: Optional[list[str]] = None
+        self.done = False
 
-    for img in soup.find_all("img"):
-        position += 1
+    def _add_structured(self, src, width, source: str):
+        if src and all(image["src"] != src for image in self.structured):
+            self.structured.append({
+                "src": src,
+                "alt": "",
+                "caption": "",
+                "near_text": "",
+                "position": 0,
+                "score": STRUCTURED_SCORE[source],
+                "source": source,
+                "width": width,
+            })
 
-        src = img.get("src")
+    def _meta(self, attrs: dict):
+        name = attrs.get("property") or attrs.get("name")
+        if name in ("og:image", "og:image:url", "og:image:secure_url"):
+            self._add_structured(attrs.get("content"), None, "og:image")
+        elif name == "og:image:width" and self.structured:
+            last = self.structured[-1]
+            if last["source"] == "og:image" and not last["width"]:
+                last["width"] = _int(attrs.get("content"))
+
+    def _json_ld(self, text: str):
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return
+        for src, width in recipe_images(data):
+            self._add_structured(src, width, "json-ld")
+
+    def _image(self, attrs: dict):
+        if self.skip_depth:
+            return
+        self.position += 1
+
+        src, width = parse_srcset(attrs.get("srcset") or "")
+        src = src or attrs.get("src") or attrs.get("data-src")
         if not src:
-            continue
+            return
 
-        alt = img.get("alt", "").lower()
-        classes = " ".join(img.get("class", [])).lower()
+        alt = (attrs.get("alt") or "").lower()
+        classes = (attrs.get("class") or "").lower()
+        if SKIP_IMAGE.search(alt + classes):
+            return
 
-        if re.search(r"avatar|icon|logo", alt + classes):
-            continue
+        parent = self.stack[-1] if self.stack else None
+        image = {
+            "src": src,
+            "alt": alt,
+            "caption": "",
+            "near_text": "",
+            "position": self.position,
+            "score": 0,
+            "source": "img",
+            "width": width,
+            "in_article": bool(self.content_depth),
+            "area": (_int(attrs.get("width")) or 0)
+            * (_int(attrs.get("height")) or 0),
+        }
+        if parent and parent["tag"] == "figure":
+            parent["images"].append(image)
+        for element in reversed(self.stack):
+            if element["tag"] == "p":
+                element["images"].append(image)
+                break
+        self.images.append(image)
 
-        parent_tags = [p.name for p in img.parents if hasattr(p, "name")]
-        in_article = any(
-            t in parent_tags
-            for t in (
-                "article",
-                "main",
-                "figure",
-            )
-        )
-
-        caption = ""
-        if img.parent.name == "figure":
-            figcaption = img.parent.find("figcaption")
-            if figcaption:
-                caption = figcaption.get_text(strip=True)
-
-        near_text = ""
-        p = img.find_parent("p")
-        if p:
-            near_text = p.get_text(strip=True)
-
-        width = img.get("width")
-        height = img.get("height")
-
-        score = 0
-        if in_article:
-            score += 3
-        if caption:
-            score += 2
-        if len(near_text) > 120:
-            score += 2
-        if width and height:
-            try:
-                if int(width) * int(height) > 300_000:
-                    score += 2
-            except ValueError:
-                pass
-
-        images.append(
-            {
-                "src": src,
-                "alt": alt,
-                "caption": caption,
-                "near_text": near_text[:300],
-                "position": position,
-                "score": score,
-            }
-        )
+    def start(self, tag: str, attrs: dict):
+        if self.done:
+            return
+        tag = tag.lower()
+        if tag == "body" and self.structured_first and self.structured:
+            self.done = True
+            return
 
-    images.sort(key=lambda x: x["score"], reverse=True)
+        if tag == "meta":
+            self._meta(attrs)
+        elif tag == "img":
+            self._image(attrs)
+        elif tag == "script" and "ld+json" in (attrs.get("type") or ""):
+            self.script = []
+        if tag in VOID_TAGS:
+            return
 
-    return images
+        classes = set((attrs.get("class") or "").lower().split())
+        element = {
+            "tag": tag,
+            "skip": tag in SKIP_TAGS or bool(classes & SKIP_CLASSES),
+            "content": tag in CONTENT_TAGS,
+            "text": [],
+            "images": [],
+            "caption": "",
+        }
+        self.skip_depth += element["skip"]
+        self.content_depth += element["content"]
+        if tag in ("p", "figcaption") and not self.skip_depth:
+            self.texts.append(element)
+        self.stack.append(element)
+
+    def end(self, tag: str):
+        if self.done:
+            return
+        tag = tag.lower()
+        if tag == "script" and self.script is not None:
+            self._json_ld("".join(self.script))
+            self.script = None
+        if tag in VOID_TAGS or all(e["tag"] != tag for e in self.stack):
+            return
+
+        # Unclosed elements inside `tag` are closed with it
+        while True:
+            element = self.stack.pop()
+            self._close(element)
+            if element["tag"] == tag:
+                return
+
+    def _close(self, element: dict):
+        self.skip_depth -= element["skip"]
+        self.content_depth -= element["content"]
+        # Text collectors are a subsequence of the stack
+        if self.texts and self.texts[-1] is element:
+            self.texts.pop()
+        text = "".join(piece.strip() for piece in element["text"])
+
+        if element["tag"] == "p":
+            for image in element["images"]:
+                image["near_text"] = text
+        elif element["tag"] == "figcaption":
+            for parent in reversed(self.stack):
+                if parent["tag"] == "figure":
+                    parent["caption"] = text
+                    break
+        elif element["tag"] == "figure":
+            for image in element["images"]:
+                image["caption"] = element["caption"]
+
+    def data(self, text: str):
+        if self.script is not None:
+            self.script.append(text)
+            return
+        for element in self.texts:
+            element["text"].append(text)
+
+    def close(self):
+        while self.stack:
+            self._close(self.stack.pop())
+
+    def candidates(self) -> list[dict]:
+        """Return structured candidates, then images by score."""
+        images = []
+        for image in self.images:
+            score = 0
+            if image.pop("in_article"):
+                score += 3
+            if image["caption"]:
+                score += 2
+            if len(image["near_text"]) > 120:
+                score += 2
+            if image.pop("area") > 300_000:
+                score += 2
+            image["score"] = score
+            image["near_text"] = image["near_text"][:300]
+            images.append(image)
+        images.sort(key=lambda x: x["score"], reverse=True)
 
+        seen = {image["src"] for image in self.structured}
+        return self.structured + [
+            image for image in images if image["src"] not in seen
+        ]
 
-async def get_html(url: str):
+
+class _StdlibParser(HTMLParser):
+    def __init__(self, collector: CandidateCollector):
+        super().__init__(convert_charrefs=True)
+        self.collector = collector
+
+    def handle_starttag(self, tag, attrs):
+        self.collector.start(tag, {k: v or "" for k, v in attrs})
+
+    def handle_endtag(self, tag):
+        self.collector.end(tag)
+
+    def handle_data(self, data):
+        self.collector.data(data)
+
+    def close(self):
+        super().close()
+        self.collector.close()
+
+
+def make_parser(collector: CandidateCollector):
+    """
+    Return a parser feeding `collector`: lxml's C tokenizer when it is
+    installed (html_backend "auto" or "lxml"), else html.parser.
+    """
+    backend = getenv("html_backend") or "auto"
+    if etree is not None and backend in ("auto", "lxml"):
+        return etree.HTMLParser(target=collector)
+    return _StdlibParser(collector)
+
+
+def extract_image_candidates(
+    html: str,
+    structured_first: bool = True,
+) -> list[dict]:
+    """
+    Extract image candidates from an HTML document.
+    Returns a list of image candidates with metadata and score.
+    """
+    collector = CandidateCollector(structured_first)
+    parser = make_parser(collector)
+    parser.feed(html)
+    parser.close()
+    return collector.candidates()
+
+
+def html_max_bytes() -> int:
+    return int(getenv("html_max_kb") or 1024) * 1024
+
+
+def extractor_options() -> tuple[bool, int, str]:
+    """Extractor settings and their key in the page cache."""
+    structured_first = (getenv("html_structured_first") or "1") == "1"
+    limit = html_max_bytes()
+    return structured_first, limit, f"{int(structured_first)}:{limit}"
+
+
+async def cached_candidates(page: CachedPage) -> Optional[list[dict]]:
+    """
+    Candidates of a cached page for the current settings. They are
+    extracted again from the stored body when the settings changed, which
+    needs the whole page unless only the cap on its size was raised.
+    """
+    structured_first, limit, options = extractor_options()
+    if page.options == options and page.candidates is not None:
+        return page.candidates
+    if not page.complete or len(page.body) > limit:
+        return None
+
+    candidates = extract_image_candidates(page.text(), structured_first)
+    await get_page_cache().set_candidates(page.url, options, candidates)
+    return candidates
+
+
+def page_charset(head: bytes, header: Optional[str]) -> str:
+    """
+    Encoding of a page from its first bytes: a BOM, then the charset of
+    the Content-Type header, then a <meta> charset, then utf-8.
+    """
+    for bom, charset in BOMS:
+        if head.startswith(bom):
+            return charset
+    if header:
+        return header
+    match = META_CHARSET.search(head[:PRESCAN_BYTES])
+    return match.group(1).decode("ascii") if match else "utf-8"
+
+
+def make_decoder(charset: str) -> codecs.IncrementalDecoder:
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                soup = BeautifulSoup(await response.text(), "html.parser")
-                return soup
+        return codecs.getincrementaldecoder(charset)(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+async def fetch_candidates(url: str) -> Optional[list[dict]]:
+    """
+    Stream a page into the extractor, reading at most html_max_bytes().
+    Stops downloading as soon as the collector has what it needs.
+
+    Pages and their candidates are cached: fresh ones are served without
+    a request, stale ones are revalidated with a conditional request.
+    """
+    structured_first, limit, options = extractor_options()
+    cache = get_page_cache()
+    page = await cache.get(url)
+    candidates = await cached_candidates(page) if page else None
+    if candidates is not None and page.fresh:
+        logging.debug("Using cached page %s", url)
+        return candidates
+
+    collector = CandidateCollector(structured_first)
+    parser = make_parser(collector)
+
+    try:
+        async with get_session().get(
+            url, headers=page.validators() if candidates is not None else {}
+        ) as response:
+            if response.status == 304 and candidates is not None:
+                logging.debug("Cached page %s is not modified", url)
+                await cache.revalidated(url, response.headers)
+                return candidates
+            if response.status >= 400:
+                logging.warning("Can't load %s: %s", url, response.status)
+                return
+
+            body = bytearray()
+            charset = decoder = None
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                chunk = chunk[: limit - len(body)]
+                body += chunk
+                if decoder is None:
+                    # Decoding waits for the bytes a <meta> charset is in
+                    if len(body) < min(PRESCAN_BYTES, limit):
+                        continue
+                    charset = page_charset(body, response.charset)
+                    decoder = make_decoder(charset)
+                    chunk = bytes(body)
+                parser.feed(decoder.decode(chunk))
+                if collector.done or len(body) >= limit:
+                    break
+            if decoder is None:
+                charset = page_charset(body, response.charset)
+                parser.feed(make_decoder(charset).decode(bytes(body)))
+            # A page cut at the cap counts as incomplete
+            complete = response.content.at_eof() and len(body) < limit
+            if not response.content.at_eof():
+                response.close()
     except Exception as e:
         logging.error(e)
         return
 
+    parser.close()
+    candidates = collector.candidates()
+    await cache.put(
+        url,
+        response.headers,
+        bytes(body),
+        charset,
+        complete,
+        options,
+        candidates,
+    )
+    return candidates
+
 
 async def get_images_by_url(url: str):
-    html = await get_html(url)
-    if not html:
+    images = await fetch_candidates(url)
+    if not images:
         return
-    images = extract_image_candidates(html)
 
-    normal_images = []
-    for image in images:
+    async def probe(image):
         src = image["src"]
         if src.startswith("/_next/image"):
-            continue
-        if src.startswith("/"):
-            src = urllib.parse.urljoin(url, src)
-        try:
-            size = await get_image_size(src)
-            if size >= 600:
-                normal_image = image.copy()
-                normal_image["src"] = src
-                normal_image["size"] = size
-                normal_image["score"] += size // 100
-                normal_images.append(normal_image)
-        except Exception as e:
-            logging.debug("Failed to get size for %s: %s", src, e)
+            return
+        src = urllib.parse.urljoin(url, src)
+
+        # Widths from srcset or structured data need no probing
+        size = image["width"] or await get_image_size(src)
+        if size >= 600:
+            normal_image = image.copy()
+            normal_image["src"] = src
+            normal_image["size"] = size
+            normal_image["score"] += size // 100
+            return normal_image
+
+    normal_images = [
+        image for image in await map_limited(probe, images, "probe") if image
+    ]
     normal_images.sort(key=lambda x: x["score"], reverse=True)
     return normal_images
@@ -0,0 +1,89 @@
+import logging
+from os import getenv
+
+import aiohttp
+
+# Per-pool defaults: (total timeout, connect timeout, limit per host)
+POOL_SETTINGS = {
+    "default": (30, 10, 8),
+    "openai": (180, 15, 16),
+    "telegram": (60, 10, 4),
+}
+
+_sessions: dict[str, aiohttp.ClientSession] = {}
+_stats = {"connections": 0, "requests": 0}
+
+
+def _setting(pool: str, name: str, default: float) -> float:
+    value = getenv(f"http_{pool}_{name}") or getenv(f"http_{name}")
+    return float(value) if value else default
+
+
+async def _on_request_start(session, context, params):
+    _stats["requests"] += 1
+
+
+async def _on_connection_create_end(session, context, params):
+    _stats["connections"] += 1
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    return trace_config
+
+
+def _create_session(pool: str) -> aiohttp.ClientSession:
+    total, connect, per_host = POOL_SETTINGS.get(
+        pool, POOL_SETTINGS["default"]
+    )
+
+    connector = aiohttp.TCPConnector(
+        limit=int(_setting(pool, "limit", 100)),
+        limit_per_host=int(_setting(pool, "limit_per_host", per_host)),
+        ttl_dns_cache=int(_setting(pool, "dns_ttl", 300)),
+        keepalive_timeout=_setting(pool, "keepalive", 60),
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=_setting(pool, "timeout", total),
+        connect=_setting(pool, "connect_timeout", connect),
+    )
+    logging.debug("Creating HTTP pool %s", pool)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        trace_configs=[_trace_config()],
+    )
+
+
+def get_session(pool: str = "default") -> aiohttp.ClientSession:
+    """
+    Return the shared keep-alive session for a pool, creating it lazily.
+
+    Sessions are owned by this module and must not be closed by callers,
+    use close_sessions() on shutdown instead.
+    """
+    session = _sessions.get(pool)
+    if session is None or session.closed:
+        session = _create_session(pool)
+        _sessions[pool] = session
+    return session
+
+
+async def close_sessions():
+    for pool, session in list(_sessions.items()):
+        if not session.closed:
+            await session.close()
+        logging.debug("Closed HTTP pool %s", pool)
+    _sessions.clear()
+
+
+def get_stats() -> dict:
+    """Return counters of opened connections and sent requests."""
+    return dict(_stats)
+
+
+def reset_stats():
+    for key in _stats:
+        _stats[key] = 0
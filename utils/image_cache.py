@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import time
+from io import BytesIO
+from os import getenv
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from PIL import Image
+
+from utils.store import SQLiteStore
+
+
+class CachedImage(NamedTuple):
+    data: bytes
+    width: int
+    height: int
+    digest: str
+
+
+class ImageCache(SQLiteStore):
+    """
+    Content-addressed on-disk image store.
+
+    Image bytes are stored once per sha256 digest, URLs point to digests.
+    Entries expire after `ttl` seconds and the least recently used blobs
+    are evicted when the total size exceeds `max_bytes`. Lookups, file
+    I/O and decoding run in the store's worker thread.
+    """
+
+    def __init__(self, folder: str, max_bytes: int, ttl: float):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        super().__init__(
+            self.folder / "index.sqlite3",
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_blobs_accessed
+                ON blobs (accessed_at);
+            CREATE INDEX IF NOT EXISTS ix_urls_digest ON urls (digest);
+            """,
+        )
+
+    def _path(self, digest: str) -> Path:
+        return self.folder / digest[:2] / digest
+
+    @staticmethod
+    def _dimensions(data: bytes) -> tuple[int, int]:
+        try:
+            with Image.open(BytesIO(data)) as image:
+                return image.size
+        except Exception as e:
+            logging.debug("Can't read image size: %s", e)
+            return 0, 0
+
+    async def get(self, url: str) -> Optional[CachedImage]:
+        return await self.run(self._get, url)
+
+    async def put(self, url: str, data: bytes) -> CachedImage:
+        return await self.run(self._put, url, data)
+
+    def _get(self, url: str) -> Optional[CachedImage]:
+        row = self.db.execute(
+            "SELECT b.digest, b.width, b.height, u.fetched_at "
+            "FROM urls u JOIN blobs b ON b.digest = u.digest "
+            "WHERE u.url = ?",
+            (url,),
+        ).fetchone()
+        if not row:
+            return None
+
+        digest, width, height, fetched_at = row
+        if time.time() - fetched_at > self.ttl:
+            return None
+
+        try:
+            data = self._path(digest).read_bytes()
+        except FileNotFoundError:
+            self._delete_blob(digest)
+            self.db.commit()
+            return None
+
+        self.db.execute(
+            "UPDATE blobs SET accessed_at = ? WHERE digest = ?",
+            (time.time(), digest),
+        )
+        self.db.commit()
+        return CachedImage(data, width, height, digest)
+
+    def _put(self, url: str, data: bytes) -> CachedImage:
+        digest = hashlib.sha256(data).hexdigest()
+        now = time.time()
+
+        row = self.db.execute(
+            "SELECT width, height FROM blobs WHERE digest = ?", (digest,)
+        ).fetchone()
+        if row and self._path(digest).exists():
+            width, height = row
+        else:
+            width, height = self._dimensions(data)
+            path = self._path(digest)
+            path.parent.mkdir(exist_ok=True)
+            path.write_bytes(data)
+
+        self.db.execute(
+            "INSERT OR REPLACE INTO blobs "
+            "(digest, size, width, height, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (digest, len(data), width, height, now),
+        )
+        self.db.execute(
+            "INSERT OR REPLACE INTO urls (url, digest, fetched_at) "
+            "VALUES (?, ?, ?)",
+            (url, digest, now),
+        )
+        self._evict()
+        self.db.commit()
+        return CachedImage(data, width, height, digest)
+
+    def _delete_blob(self, digest: str):
+        self._path(digest).unlink(missing_ok=True)
+        self.db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        self.db.execute("DELETE FROM urls WHERE digest = ?", (digest,))
+
+    def _evict(self):
+        (total,) = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+
+        rows = self.db.execute(
+            "SELECT digest, size FROM blobs ORDER BY accessed_at"
+        ).fetchall()
+        for digest, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._delete_blob(digest)
+            total -= size
+            logging.debug("Evicted cached image %s", digest)
+
+
+_cache: Optional[ImageCache] = None
+
+
+def get_image_cache() -> ImageCache:
+    global _cache
+    if _cache is None:
+        _cache = ImageCache(
+            getenv("image_cache_dir") or "cache/images",
+            int(getenv("image_cache_mb") or 256) * 1024 * 1024,
+            float(getenv("image_cache_ttl") or 7 * 24 * 3600),
+        )
+    return _cache
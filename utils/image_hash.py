@@ -0,0 +1,146 @@
+from io import BytesIO
+from os import getenv
+from typing import NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+# Side of the grayscale image pHash transforms, and of the kept block
+PHASH_SIZE = 32
+HASH_SIDE = 8
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    # Orthonormal DCT-II, so dct(a) = D @ a @ D.T
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / size)
+
+
+DCT = _dct_matrix(PHASH_SIZE)
+
+
+class ImageHashes(NamedTuple):
+    # Unsigned 64-bit hashes
+    dhash: int
+    phash: int
+
+
+def _pack(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def image_hashes(image: bytes) -> ImageHashes:
+    """
+    Compute the dHash and pHash of an image.
+
+    dHash compares neighbouring pixels of a 9x8 grayscale copy, pHash
+    compares the lowest 8x8 DCT frequencies of a 32x32 copy with their
+    median. Both survive rescaling and recompression, so copies of a
+    photo at other sizes or from other CDNs differ by a few bits.
+    """
+    with Image.open(BytesIO(image)) as img:
+        # JPEGs are decoded at 1/8 scale when that's still large enough
+        img.draft("L", (PHASH_SIZE, PHASH_SIZE))
+        gray = img.convert("L")
+
+    small = np.asarray(
+        gray.resize((HASH_SIDE + 1, HASH_SIDE), Image.Resampling.BOX),
+        dtype=np.int16,
+    )
+    dhash = _pack(small[:, 1:] > small[:, :-1])
+
+    pixels = np.asarray(
+        gray.resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.BOX),
+        dtype=np.float64,
+    )
+    low = (DCT @ pixels @ DCT.T)[:HASH_SIDE, :HASH_SIDE]
+    # The DC term only holds the average brightness
+    phash = _pack(low > np.median(low.ravel()[1:]))
+    return ImageHashes(dhash, phash)
+
+
+def to_signed(value: int) -> int:
+    """Store an unsigned 64-bit hash in a signed SQLite INTEGER."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value: int) -> int:
+    return value % (1 << 64)
+
+
+def hash_distance() -> int:
+    """Most differing bits of both hashes for images to be the same."""
+    return int(getenv("image_hash_distance") or 10)
+
+
+class HashIndex:
+    """
+    Hashes of many images kept in contiguous uint64 arrays.
+
+    A lookup XORs the query with every stored hash and counts the set
+    bits in one vectorized pass, about a millisecond per 100k images.
+    """
+
+    def __init__(self):
+        self.keys: list = []
+        self.dhashes = np.empty(1024, dtype=np.uint64)
+        self.phashes = np.empty(1024, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, hashes: ImageHashes):
+        size = len(self.keys)
+        if size == len(self.dhashes):
+            # Doubling keeps appends amortized O(1)
+            self.dhashes = np.resize(self.dhashes, size * 2)
+            self.phashes = np.resize(self.phashes, size * 2)
+        self.dhashes[size] = hashes.dhash
+        self.phashes[size] = hashes.phash
+        self.keys.append(key)
+
+    def find(self, hashes: ImageHashes, distance: int) -> Optional[object]:
+        """Key of the closest image within `distance` bits, or None."""
+        size = len(self.keys)
+        if not size:
+            return None
+
+        dhash = np.uint64(hashes.dhash)
+        phash = np.uint64(hashes.phash)
+        dhash_distance = np.bitwise_count(self.dhashes[:size] ^ dhash)
+        phash_distance = np.bitwise_count(self.phashes[:size] ^ phash)
+        # Both hashes must agree, dHash alone confuses plain backgrounds
+        total = np.where(
+            (dhash_distance <= distance) & (phash_distance <= distance),
+            dhash_distance.astype(np.int32) + phash_distance,
+            np.iinfo(np.int32).max,
+        )
+        best = int(np.argmin(total))
+        if total[best] == np.iinfo(np.int32).max:
+            return None
+        return self.keys[best]
+
+
+def group_duplicates(
+    hashes: list[Optional[ImageHashes]], distance: int
+) -> list[list[int]]:
+    """
+    Group indexes of near-duplicate images, in order of first appearance.
+    Images without hashes are alone in their group.
+    """
+    groups = []
+    index = HashIndex()
+    for position, image_hashes in enumerate(hashes):
+        group = None
+        if image_hashes is not None:
+            group = index.find(image_hashes, distance)
+        if group is None:
+            group = len(groups)
+            groups.append([])
+            if image_hashes is not None:
+                index.add(group, image_hashes)
+        groups[group].append(position)
+    return groups
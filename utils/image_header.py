@@ -0,0 +1,95 @@
+import struct
+from typing import Optional
+
+JPEG_SOF_MARKERS = {
+    0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF,
+}
+JPEG_STANDALONE_MARKERS = {0x01, 0xD8, *range(0xD0, 0xD8)}
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+def _png_size(data: bytes) -> Optional[tuple[int, int]]:
+    if len(data) < 24:
+        return None
+    return struct.unpack(">II", data[16:24])
+
+
+def _gif_size(data: bytes) -> Optional[tuple[int, int]]:
+    if len(data) < 10:
+        return None
+    return struct.unpack("<HH", data[6:10])
+
+
+def _webp_size(data: bytes) -> Optional[tuple[int, int]]:
+    if len(data) < 30:
+        return None
+
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L":
+        (bits,) = struct.unpack("<I", data[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return width, height
+    raise UnsupportedImage(f"Unknown WebP chunk {chunk!r}")
+
+
+def _jpeg_size(data: bytes) -> Optional[tuple[int, int]]:
+    position = 2
+    while True:
+        # Skip fill bytes before the marker code
+        while position < len(data) and data[position] == 0xFF:
+            position += 1
+        if position >= len(data):
+            return None
+
+        marker = data[position]
+        position += 1
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+
+        if position + 2 > len(data):
+            return None
+        (length,) = struct.unpack(">H", data[position:position + 2])
+
+        if marker in JPEG_SOF_MARKERS:
+            if position + 7 > len(data):
+                return None
+            height, width = struct.unpack(
+                ">HH", data[position + 3:position + 7]
+            )
+            return width, height
+
+        position += length
+        if position >= len(data):
+            return None
+        if data[position] != 0xFF:
+            raise UnsupportedImage("Broken JPEG marker sequence")
+
+
+def parse_image_size(data: bytes) -> Optional[tuple[int, int]]:
+    """
+    Read (width, height) from the first bytes of a PNG, JPEG, WebP or GIF.
+
+    Returns None while more bytes are needed and raises UnsupportedImage
+    for any other format, so callers can feed a growing buffer.
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return _png_size(data)
+    if data.startswith(b"\xff\xd8"):
+        return _jpeg_size(data)
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return _gif_size(data)
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return _webp_size(data)
+    if len(data) < 12:
+        return None
+    raise UnsupportedImage("Unknown image format")
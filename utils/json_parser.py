@@ -1,5 +1,9 @@
 import json
 import logging
+from contextlib import aclosing
+from typing import AsyncIterator
+
+from agents.gpt import IncompleteAnswer
 
 
 def parse_text(text: str, default=None) -> list:
@@ -9,3 +13,35 @@ def parse_text(text: str, default=None) -> list:
     except Exception as e:
         logging.warning(e)
         return default
+
+
+async def parse_json_stream(chunks: AsyncIterator[str], default=None):
+    """
+    Parse a streamed JSON answer, stopping as soon as a complete object
+    or array has arrived. The rest of the stream is not awaited, an
+    answer cut off before that gives `default`.
+    """
+    decoder = json.JSONDecoder()
+    text = ""
+    async with aclosing(chunks):
+        try:
+            async for chunk in chunks:
+                text += chunk
+                valid_json = text.replace("\\n", "").replace("\n", "")
+                starts = (valid_json.find("{"), valid_json.find("["))
+                start = min(
+                    (index for index in starts if index >= 0), default=-1
+                )
+                if start < 0:
+                    continue
+                try:
+                    value, _ = decoder.raw_decode(valid_json, start)
+                    return value
+                except ValueError:
+                    continue
+        except IncompleteAnswer as e:
+            # A cut JSON answer is no better than none
+            logging.warning(e)
+            return default
+
+    return parse_text(text, default)
@@ -0,0 +1,332 @@
+import json
+import logging
+import re
+import time
+import urllib.parse
+import zlib
+from email.utils import parsedate_to_datetime
+from os import getenv
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from utils.store import SQLiteStore
+
+# Query parameters that don't change the page
+TRACKING_PARAM = re.compile(r"utm_\w+|fbclid|gclid|yclid|_openstat")
+DEFAULT_PORTS = {"http": 80, "https": 443}
+MAX_AGE = re.compile(r"(?:^|,)\s*max-age\s*=\s*\"?(\d+)", re.IGNORECASE)
+
+
+def canonical_url(url: str) -> str:
+    """
+    Normalize a page URL for use as a cache key: lowercase scheme and
+    host, no default port, fragment or tracking parameters, sorted query.
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (name, value)
+        for name, value in urllib.parse.parse_qsl(
+            parts.query, keep_blank_values=True
+        )
+        if not TRACKING_PARAM.fullmatch(name)
+    )
+    return urllib.parse.urlunsplit((
+        scheme,
+        host,
+        parts.path or "/",
+        urllib.parse.urlencode(query),
+        "",
+    ))
+
+
+def expires_at(headers, now: float, ttl: float) -> Optional[float]:
+    """
+    Moment until which a response may be used without revalidation, or
+    None when it must not be stored. `ttl` applies when the server gives
+    no freshness information.
+    """
+    cache_control = headers.get("Cache-Control", "").lower()
+    if "no-store" in cache_control:
+        return None
+    if "no-cache" in cache_control:
+        return now
+
+    max_age = MAX_AGE.search(cache_control)
+    if max_age:
+        return now + int(max_age.group(1))
+
+    if "Expires" in headers:
+        try:
+            expires = parsedate_to_datetime(headers["Expires"]).timestamp()
+            date = parsedate_to_datetime(headers["Date"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            # An invalid Expires means "already expired"
+            return now
+        return now + max(expires - date, 0)
+    return now + ttl
+
+
+class CachedPage(NamedTuple):
+    url: str
+    body: bytes
+    charset: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    expires_at: float
+    # False when reading stopped before the end of the page
+    complete: bool
+    # Extractor settings the candidates were collected with
+    options: Optional[str]
+    candidates: Optional[list[dict]]
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    def validators(self) -> dict[str, str]:
+        """Headers of a conditional request revalidating this page."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def text(self) -> str:
+        try:
+            return self.body.decode(self.charset or "utf-8", "replace")
+        except LookupError:
+            return self.body.decode("utf-8", "replace")
+
+
+class PageCache(SQLiteStore):
+    """
+    On-disk HTTP cache of recipe pages.
+
+    Bodies are stored zlib-compressed with their ETag and Last-Modified,
+    along with the image candidates extracted from them. Fresh pages are
+    served without a request, stale ones are revalidated with a
+    conditional request. The least recently used pages are evicted when
+    the compressed bodies exceed `max_bytes`. Queries and (de)compression
+    run in the store's worker thread.
+    """
+
+    def __init__(self, folder: str, max_bytes: int, ttl: float):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        super().__init__(
+            self.folder / "index.sqlite3",
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                charset TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                expires_at REAL NOT NULL,
+                complete INTEGER NOT NULL,
+                options TEXT,
+                candidates TEXT,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_pages_accessed
+                ON pages (accessed_at);
+            """,
+        )
+
+    async def get(self, url: str) -> Optional[CachedPage]:
+        return await self.run(self._get, url)
+
+    async def put(
+        self,
+        url: str,
+        headers,
+        body: bytes,
+        charset: Optional[str],
+        complete: bool,
+        options: str,
+        candidates: list[dict],
+    ) -> bool:
+        """Store a response unless its headers forbid it."""
+        return await self.run(
+            self._put,
+            url,
+            headers,
+            body,
+            charset,
+            complete,
+            options,
+            candidates,
+        )
+
+    async def revalidated(self, url: str, headers):
+        """Extend a page after a 304 Not Modified response."""
+        await self.run(self._revalidated, url, headers)
+
+    async def set_candidates(
+        self, url: str, options: str, candidates: list[dict]
+    ):
+        await self.run(self._set_candidates, url, options, candidates)
+
+    async def delete(self, url: str):
+        await self.run(self._delete, url)
+
+    def _get(self, url: str) -> Optional[CachedPage]:
+        url = canonical_url(url)
+        row = self.db.execute(
+            "SELECT body, charset, etag, last_modified, expires_at, "
+            "complete, options, candidates FROM pages WHERE url = ?",
+            (url,),
+        ).fetchone()
+        if not row:
+            return None
+
+        body, charset, etag, last_modified, expires, complete = row[:6]
+        options, candidates = row[6:]
+        try:
+            body = zlib.decompress(body)
+            candidates = json.loads(candidates) if candidates else None
+        except (zlib.error, ValueError) as e:
+            logging.warning("Dropping broken cached page %s: %s", url, e)
+            self.db.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self.db.commit()
+            return None
+
+        self.db.execute(
+            "UPDATE pages SET accessed_at = ? WHERE url = ?",
+            (time.time(), url),
+        )
+        self.db.commit()
+        return CachedPage(
+            url,
+            body,
+            charset,
+            etag,
+            last_modified,
+            expires,
+            bool(complete),
+            options,
+            candidates,
+        )
+
+    def _put(
+        self,
+        url: str,
+        headers,
+        body: bytes,
+        charset: Optional[str],
+        complete: bool,
+        options: str,
+        candidates: list[dict],
+    ) -> bool:
+        now = time.time()
+        expires = expires_at(headers, now, self.ttl)
+        if expires is None:
+            self._delete(url)
+            return False
+        if not headers.get("ETag") and not headers.get("Last-Modified"):
+            if expires <= now:
+                # Can't be revalidated nor served, not worth storing
+                self._delete(url)
+                return False
+
+        data = zlib.compress(body)
+        self.db.execute(
+            "INSERT OR REPLACE INTO pages (url, body, size, charset, etag, "
+            "last_modified, expires_at, complete, options, candidates, "
+            "accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                canonical_url(url),
+                data,
+                len(data),
+                charset,
+                headers.get("ETag"),
+                headers.get("Last-Modified"),
+                expires,
+                complete,
+                options,
+                json.dumps(candidates, ensure_ascii=False),
+                now,
+            ),
+        )
+        self._evict()
+        self.db.commit()
+        return True
+
+    def _revalidated(self, url: str, headers):
+        expires = expires_at(headers, time.time(), self.ttl)
+        if expires is None:
+            self._delete(url)
+            return
+        # A 304 may carry updated validators
+        self.db.execute(
+            "UPDATE pages SET expires_at = ?, "
+            "etag = COALESCE(?, etag), "
+            "last_modified = COALESCE(?, last_modified) "
+            "WHERE url = ?",
+            (
+                expires,
+                headers.get("ETag"),
+                headers.get("Last-Modified"),
+                canonical_url(url),
+            ),
+        )
+        self.db.commit()
+
+    def _set_candidates(
+        self, url: str, options: str, candidates: list[dict]
+    ):
+        self.db.execute(
+            "UPDATE pages SET options = ?, candidates = ? WHERE url = ?",
+            (
+                options,
+                json.dumps(candidates, ensure_ascii=False),
+                canonical_url(url),
+            ),
+        )
+        self.db.commit()
+
+    def _delete(self, url: str):
+        self.db.execute(
+            "DELETE FROM pages WHERE url = ?", (canonical_url(url),)
+        )
+        self.db.commit()
+
+    def _evict(self):
+        (total,) = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM pages"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+
+        rows = self.db.execute(
+            "SELECT url, size FROM pages ORDER BY accessed_at"
+        ).fetchall()
+        for url, size in rows:
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM pages WHERE url = ?", (url,))
+            total -= size
+            logging.debug("Evicted cached page %s", url)
+
+
+_cache: Optional[PageCache] = None
+
+
+def get_page_cache() -> PageCache:
+    global _cache
+    if _cache is None:
+        _cache = PageCache(
+            getenv("page_cache_dir") or "cache/pages",
+            int(getenv("page_cache_mb") or 64) * 1024 * 1024,
+            float(getenv("page_cache_ttl") or 24 * 3600),
+        )
+    return _cache
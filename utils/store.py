@@ -0,0 +1,28 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+class SQLiteStore:
+    """
+    Base of the on-disk caches: a sqlite3 index used from one worker
+    thread.
+
+    Subclasses keep their queries and file I/O in synchronous methods and
+    call them through run(), so the event loop never blocks on disk and
+    the connection is never used by two threads at once.
+    """
+
+    def __init__(self, path: Path, schema: str):
+        self.executor = ThreadPoolExecutor(
+            1, thread_name_prefix=type(self).__name__
+        )
+        # Only the worker uses the connection after this
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(schema)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        )
@@ -0,0 +1,108 @@
+import asyncio
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from os import getenv
+from typing import NamedTuple, Optional
+
+from PIL import Image
+
+# Formats Pillow can save a vision input in, by their env value
+FORMATS = {"jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP", "png": "PNG"}
+
+
+class ThumbnailTarget(NamedTuple):
+    # Largest width of the thumbnail, narrower images keep their width
+    width: int
+    format: str
+    quality: int
+
+
+def thumbnail_target() -> ThumbnailTarget:
+    image_format = (getenv("thumbnail_format") or "jpeg").lower()
+    if image_format not in FORMATS:
+        raise ValueError(f"Unsupported thumbnail_format {image_format!r}")
+    return ThumbnailTarget(
+        int(getenv("thumbnail_width") or 120),
+        FORMATS[image_format],
+        int(getenv("thumbnail_quality") or 85),
+    )
+
+
+def make_thumbnail(image: bytes, target: ThumbnailTarget) -> bytes:
+    """
+    Shrink an image to the target width and encode it.
+
+    JPEGs are decoded in draft mode, where libjpeg scales by 1/2, 1/4 or
+    1/8 while decoding the DCT blocks, so a large photo is never decoded
+    at full resolution. The remaining reduction is done by thumbnail().
+    """
+    with Image.open(BytesIO(image)) as img:
+        # Height doesn't bound the thumbnail, only the width does
+        box = (target.width, max(img.height, 1))
+        if img.format == "JPEG":
+            scale = target.width / img.width
+            img.draft("RGB", (target.width, round(img.height * scale)))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.thumbnail(box, Image.Resampling.LANCZOS)
+
+        output = BytesIO()
+        img.save(output, format=target.format, quality=target.quality)
+        return output.getvalue()
+
+
+def image_tokens(image: bytes) -> int:
+    """
+    Input tokens a vision model charges for an image at high detail: it
+    is fit into 2048x2048, its short side cut to 768, and costs 85 plus
+    170 per 512px tile.
+    """
+    with Image.open(BytesIO(image)) as img:
+        width, height = img.size
+    scale = min(1, 2048 / max(width, height, 1))
+    scale *= min(1, 768 / max(min(width, height) * scale, 1))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 85 + 170 * tiles
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def thumbnail_workers() -> int:
+    return int(getenv("thumbnail_workers") or min(os.cpu_count() or 1, 4))
+
+
+def get_thumbnail_pool() -> Optional[ProcessPoolExecutor]:
+    """Return the shared process pool, None when workers are disabled."""
+    global _pool
+    workers = thumbnail_workers()
+    if workers > 0 and _pool is None:
+        _pool = ProcessPoolExecutor(workers)
+    return _pool
+
+
+def close_thumbnail_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+async def run_in_pool(func, *args):
+    """
+    Run CPU-bound image work off the event loop, in the process pool or,
+    with thumbnail_workers=0, in a thread.
+    """
+    pool = get_thumbnail_pool()
+    if pool is None:
+        return await asyncio.to_thread(func, *args)
+    return await asyncio.get_running_loop().run_in_executor(
+        pool, func, *args
+    )
+
+
+async def thumbnail(image: bytes) -> bytes:
+    """Prepare an image for the vision model, see make_thumbnail."""
+    return await run_in_pool(make_thumbnail, image, thumbnail_target())